@@ -1,306 +1,466 @@
 import os
-import io
-import base64
+import json
+import time
+import uuid
+import functools
+import threading
 import streamlit as st
-from openai import OpenAI
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from pipeline import (
+    ALLOWED_EXTENSIONS,
+    DEFAULT_SECTION_CONCURRENCY,
+    Speculation,
+    speculation_key,
+    reference_style_from_summary,
+    split_references,
+    generate_job_summary,
+    generate_structure_from_summary,
+    generate_content_from_structure,
+    regenerate_changed_sections,
+    rewrite_sections,
+    generate_references_from_content,
+    generate_references_from_index,
+    generate_final_document_with_citations,
+)
+from artifact_store import StoredFile, get_artifact_store
+from reference_index import (
+    MIN_REFERENCE_YEAR,
+    REFERENCE_FILE_EXTENSIONS,
+    extract_keywords,
+    get_reference_index,
+    load_references,
+    reference_count,
+    style_key,
+)
+import jobs
+import scheduler
+import telemetry
+import validation
 
 api_key = st.secrets.get("OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY")
 if not api_key:
     st.error("OPENAI_API_KEY is not set. Please add it in Streamlit Secrets.")
     st.stop()
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# The shared client in pipeline.py reads the key from the environment.
+os.environ["OPENAI_API_KEY"] = api_key
 
-# -------- Agent 1: Job Summary --------
-SUMMARY_PROMPT = """
-You are an AI assistant specialized in understanding writing tasks and producing a structured Job Summary, not the full content itself. Read the user’s instructions and any extracted text from attachments (e.g., PDFs, DOCX) to identify what needs to be written, including topic, word count or length, reference style (APA, MLA, Harvard, etc.), and writing style or document type (essay, report, PPT, proposal, article, dissertation, thesis, etc.). If a detail is not explicitly given but can be reasonably inferred, infer it; if it cannot be inferred confidently, mark it as “Not specified.” Always respond in this exact format: Topic: <short topic or title>; Word Count: <number of words or If word count is not mentioned in the Job card, then by default print "1500">; Reference Style: <style or If Reference Style is not mentioned in the Job card, then by default print "Harvard">; Writing Style: <type or "Report">; Job Summary: <10–20 sentences clearly describing what needs to be written, the main themes to cover, target audience or level if known, and any important constraints such as tone or structure>. Do not add extra sections, do not explain your reasoning, and do not write the actual assignment—only provide a clear, concise, implementation-ready Job Summary that another writer or AI could directly follow.
-"""
+# ---------- Streamlit UI ----------
 
-# -------- Agent 2: Structure with word breakdown --------
-STRUCTURE_PROMPT = """
-You are an AI assistant specialized in creating academic writing structures (detailed outlines) for writing tasks. Your input is always the full output of a Job Summary agent, which includes at least: Topic, Word Count, Reference Style, Writing Style, and Job Summary (and may also include extra instructions). Your job is to design a clear, logically ordered, academically appropriate structure with word counts for each section and subsection, so that another writer or AI could directly draft the final document. Strictly follow all instructions and requirements from the Job Summary and ensure that every key theme, focus area, or constraint is reflected in the structure. Use academic writing conventions that match the Writing Style (e.g., essays with introduction/body/conclusion; reports with sections such as introduction, methodology, analysis, conclusion; dissertations/thesis with chapters such as introduction, literature review, methodology, results, discussion, conclusion; PPTs as slide-based academic sections, etc.). Handle Word Count as follows: always use only word counts and never pages, lines, slides, or any other length unit; if a specific word count is given, treat it as the target total and allocate section word counts so they sum to approximately that total (with minor acceptable variation); if a range is given, internally pick a reasonable midpoint and allocate based on that; if the word count is described in pages or similar, internally convert to an approximate word count and output only word counts; if Word Count is “Not specified,” infer a reasonable total based on the Writing Style and academic context, then allocate accordingly. Respect the Reference Style by including a final “References” or “Bibliography” section with an appropriate word count whenever references are expected for that type of task. Ensure a coherent hierarchy with numbered sections and, where useful, subsections, each with a clear academic-style heading and an explicit word count (e.g., “Section Title – X words”). Begin by stating the title (using the Topic) and the total word count, then list the sections in order. Do not write any actual content of the sections, only the structure and word counts. Do not explain your reasoning, do not add extra metadata fields, and do not mention any unit other than words.sub points must shows the word counts in word breakdown and the sum of sub points word count must match with the main points total word count
-"""
+# Steps run as background jobs (see jobs.py), in pipeline order. Their job
+# ids are mirrored in the page URL so a reload or a new tab reconnects.
+JOB_STAGES = ["summary", "structure", "content", "update", "references", "final"]
+JOB_LABELS = {
+    "summary": "summary generation",
+    "structure": "structure generation",
+    "content": "content generation",
+    "update": "section regeneration",
+    "references": "reference generation",
+    "final": "final document generation",
+}
+JOB_POLL_SECONDS = 1.0
+# Background work of sessions inactive for this long (closed or forgotten
+# tabs) is dropped; their stage outputs stay in the artifact store.
+SESSION_IDLE_MINUTES = float(os.environ.get("SESSION_IDLE_MINUTES", "30"))
+
+
+def artifact(name):
+    """
+    The text of stage output ``name`` ("" if there is none). Session state
+    only holds artifact ids; the texts live in the artifact store.
+    """
+    artifact_id = st.session_state["artifacts"].get(name)
+    if not artifact_id:
+        return ""
+    return get_artifact_store().get_text(artifact_id) or ""
 
-# -------- Agent 3: Content generation from structure --------
-CONTENT_PROMPT = """
-You are an AI assistant specialized in academic content writing. Your input is the full output of a Structure-Making Agent, which includes the title, total word count, and a numbered list of sections and subsections with individual word counts, all derived from a Job Summary. Your task is to transform this structure into complete, polished content that strictly follows all instructions, rules, and constraints implied by both the structure and the underlying task (topic, writing style, level, focus areas, tone, etc.). You must: (1) preserve the given headings and their order exactly as provided; (2) write cohesive, formal, academic prose under each section/subsection that clearly addresses the intent of its heading and the overall task; (3) follow the specified word counts closely for each section and subsection, aiming to be as close as reasonably possible to the target for each one and to the overall total; (4) maintain consistency in voice, tense, and perspective as implied by the task; and (5) ensure logical flow between sections with appropriate transitions and internal coherence. Must follow the exact word count that is mentioned, but sometimes you can provide 5% More or less in the contents as word counts. Do not modify or invent new sections, do not change the title, and do not contradict any explicit requirements from the task (such as focus, scope, or audience). When writing the content, do not include any reference list, bibliography, or citations of any kind (no in-text citations, no author-year, no numbers in brackets, and no “References” section), even if the structure or task mentions a reference style; treat that aspect as handled elsewhere. Do not explain your reasoning or describe your process; output only the final written content organized under the given headings.
-"""
 
-# -------- Agent 4: References + in-text citations list --------
-REFERENCES_PROMPT = """
-You are an AI assistant specialized in generating academic reference lists and corresponding in-text citation formats. Your input will be: (1) the full content produced by a content-creation agent, (2) the specified reference style (e.g., APA, MLA, Chicago, Harvard, IEEE, etc.), and (3) the approximate total word count of the content. Your task is to create an original, topic-related reference list that strictly follows the given reference style and is based on the themes, concepts, and topics present in the content. All references you provide must be to real, credible, and verifiable sources published after 2021 (i.e., from 2022 onwards). For every 1000 words of content, generate approximately 7 references (rounding reasonably to the nearest whole number) and ensure that all references are directly relevant to the subject matter of the content. Present the references as a properly formatted “Reference List” ordered alphabetically (A–Z) by the first author’s surname, strictly conforming to the rules of the specified reference style. After the alphabetical reference list, provide a separate “Citation List” that contains the in-text citation format for each reference above (e.g., for Harvard and APA: Author, Year; for MLA: Author page; for IEEE: [number], etc.), covering all references already listed. In-text Citation rules: For Harvard, APA, APA7,  IEEE Referencing (If one, two, or three authors are present in the Reference, then use the Surname of Each Author first, then a comma, and then the year in a Single bracket). Like example: ‘Hermes, A. and Riedl, R., 2021, July. Dimensions of retail customer experience and its outcomes: a literature review and directions for future research. If you notice here, two authors are present, so the in-text citation will be “(Hermes and Riedl, 2021)”. If 4 or more authors are present, then use the first author's surname, then et al., then a comma, and then the year. For example: “Pappas, A., Fumagalli, E., Rouziou, M. and Bolander, W., 2023. More than machines: The role of the future retail salesperson in enhancing the customer experience. Journal of Retailing, 99(4), pp.518-531.”. If you notice here 4 authors are present, so the intext citation will be (Pappas et al. 2023). In IEEE, all are the same but in Number Format like [1], [2], etc. Do not include any explanation, analysis, or extra text beyond the reference list and the citation list. Do not rewrite or summarize the original content. Your entire output must consist only of the formatted reference list followed by the citation list.
-"""
+def set_artifact(name, text):
+    if text:
+        st.session_state["artifacts"][name] = get_artifact_store().put_text(text)
+    else:
+        st.session_state["artifacts"].pop(name, None)
+
 
-# -------- Agent 5: Final document with citations inserted --------
-FINALIZE_PROMPT = """
-You are an AI assistant specialized in finalizing academic documents by inserting in-text citations and appending an existing reference list. Your inputs are: (1) a complete piece of content with no citations or reference list, (2) a formatted reference list, (3) a citation list that specifies the correct in-text citation format for each reference, and (4) the reference style to follow (e.g., APA, MLA, Chicago, Harvard, IEEE, etc.). Your task is to cite all existing references from the citation list within the content and then append the full reference list at the end of the document, strictly following the given reference style. You must not rewrite, expand, shorten, reorder, or otherwise change any of the existing content, headings, or wording; you may only insert in-text citations at appropriate locations and add the reference list at the end. Don't cite in the Introduction, Conclusion parts, and if available, Abstract and Executive summary; in those parts, don't add in-text citations. Do not add new references, do not remove any existing references, and do not invent sources. Ensure that every reference from the provided reference list is cited at least once in the body using the corresponding in-text format from the citation list, and that all in-text citations match entries in the reference list. Maintain the original structure and formatting of the content as much as possible, only adding the necessary citation markers and the final reference list section. As output, return the full content with the in-text citations properly inserted and the complete reference list appended at the end, and do not include any explanations, notes, or extra commentary.
+def drop_artifacts(*names):
+    for name in names:
+        st.session_state["artifacts"].pop(name, None)
 
-"""
 
-ALLOWED_EXTENSIONS = [
-    "doc", "docx", "pdf",
-    "png", "jpg", "jpeg",
-    "pptx", "csv", "xlsx", "xlx",
-]
+@st.cache_resource(show_spinner=False)
+def session_registry():
+    """
+    Per-session objects too large or too live for session state (running
+    speculations), shared across reruns and keyed by session id together
+    with the time the session was last active.
+    """
+    return {"lock": threading.Lock(), "sessions": {}}
 
-# ---------- helper: text extraction ----------
 
-def extract_text_from_upload(uploaded_file) -> str:
+def touch_session():
     """
-    Best-effort text extraction from different file types.
+    Mark this session active and drop the background work of sessions idle
+    for more than SESSION_IDLE_MINUTES.
     """
-    filename = uploaded_file.name
-    name_lower = filename.lower()
-    ext = os.path.splitext(name_lower)[1]
-
-    data = uploaded_file.getvalue()
-
-    try:
-        if ext == ".pdf":
-            from PyPDF2 import PdfReader
-            reader = PdfReader(io.BytesIO(data))
-            parts = []
-            for page in reader.pages:
-                text = page.extract_text() or ""
-                parts.append(text)
-            return "\n".join(parts).strip()
-
-        elif ext == ".docx":
-            from docx import Document
-            doc = Document(io.BytesIO(data))
-            parts = [para.text for para in doc.paragraphs]
-            return "\n".join(parts).strip()
-
-        elif ext == ".pptx":
-            from pptx import Presentation
-            prs = Presentation(io.BytesIO(data))
-            parts = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        parts.append(shape.text)
-            return "\n".join(parts).strip()
-
-        elif ext in [".csv"]:
-            import pandas as pd
-            df = pd.read_csv(io.BytesIO(data))
-            return df.to_csv(index=False)
-
-        elif ext in [".xlsx", ".xlx", ".xls"]:
-            import pandas as pd
-            df = pd.read_excel(io.BytesIO(data))
-            return df.to_csv(index=False)
-
-        elif ext == ".doc":
-            return (
-                "[.doc file detected. Automatic extraction is limited. "
-                "Please convert to .docx or PDF for better results.]"
-            )
+    registry = session_registry()
+    now = time.time()
+    with registry["lock"]:
+        sessions = registry["sessions"]
+        entry = sessions.setdefault(st.session_state["session_id"], {"speculations": {}})
+        entry["seen"] = now
+        idle = [
+            sessions.pop(session_id)
+            for session_id, e in list(sessions.items())
+            if now - e["seen"] > SESSION_IDLE_MINUTES * 60
+        ]
+    for e in idle:
+        for speculation in e["speculations"].values():
+            speculation.discard()
+
+
+def session_speculations():
+    return session_registry()["sessions"][st.session_state["session_id"]]["speculations"]
+
+
+def stage_fragment(fn):
+    """
+    Run a pipeline stage as a fragment: editing its widgets re-executes only
+    that stage. Starting a job still reruns the whole app (``submit_job``).
+    """
+    @st.fragment
+    @functools.wraps(fn)
+    def run():
+        touch_session()
+        fn()
 
-        else:
-            try:
-                return data.decode("utf-8", errors="ignore")
-            except Exception:
-                return (
-                    f"[Could not automatically extract text from {filename}. "
-                    f"Please provide instructions in the text box.]"
-                )
+    return run
 
-    except ImportError as ie:
-        return (
-            f"[Missing Python library to parse {filename}: {ie}. "
-            "Install required libraries (PyPDF2, python-docx, python-pptx, pandas, openpyxl).]"
-        )
-    except Exception as e:
-        return f"[Error while reading {filename}: {e}]"
 
+# Values derived from long texts, memoized on the artifact id (the content
+# hash) so a rerun does not rescan a text that has not changed.
+@st.cache_data(max_entries=256, show_spinner=False)
+def artifact_word_count(artifact_id):
+    return len((get_artifact_store().get_text(artifact_id) or "").split()) if artifact_id else 0
 
-# ---------- Agent 1: generate job summary ----------
 
-def generate_job_summary(instruction_text, uploaded_files, model="gpt-4.1-mini"):
-    attachment_text_blocks = []
-    image_contents = []
+@st.cache_data(max_entries=256, show_spinner=False)
+def artifact_reference_style(artifact_id):
+    return reference_style_from_summary(get_artifact_store().get_text(artifact_id) or "")
 
-    for uf in uploaded_files:
-        filename = uf.name
-        ext = os.path.splitext(filename.lower())[1]
 
-        # Images -> input_image
-        if ext in [".png", ".jpg", ".jpeg"]:
-            raw = uf.getvalue()
-            mime = "image/png" if ext == ".png" else "image/jpeg"
-            b64 = base64.b64encode(raw).decode("utf-8")
-            image_contents.append(
-                {
-                    "type": "input_image",
-                    "image_url": f"data:{mime};base64,{b64}",
-                }
-            )
-        else:
-            text = extract_text_from_upload(uf)
-            if text:
-                attachment_text_blocks.append(
-                    f"----- File: {filename} -----\n{text}"
-                )
+@st.cache_data(max_entries=256, show_spinner=False)
+def artifact_reference_split(artifact_id):
+    return split_references(get_artifact_store().get_text(artifact_id) or "")
 
-    base_instruction = (instruction_text or "").strip()
-    if not base_instruction:
-        base_instruction = (
-            "The instructions for the writing task are in the following extracted "
-            "file contents. Please infer all possible details about the assignment."
-        )
 
-    all_attachments_text = "\n\n".join(attachment_text_blocks).strip()
-    if all_attachments_text:
-        combined_text = (
-            base_instruction
-            + "\n\nBelow is the extracted text from the uploaded files:\n\n"
-            + all_attachments_text
-        )
-    else:
-        combined_text = base_instruction
-
-    content_items = [{"type": "input_text", "text": combined_text}]
-    content_items.extend(image_contents)
-
-    messages = [
-        {
-            "role": "user",
-            "content": content_items,
-        }
-    ]
-
-    response = client.responses.create(
-        model=model,
-        instructions=SUMMARY_PROMPT,
-        input=messages,
-    )
+@st.cache_data(max_entries=256, show_spinner=False)
+def artifact_keywords(artifact_id):
+    return extract_keywords(get_artifact_store().get_text(artifact_id) or "")
 
-    return response.output_text
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def validation_report(structure_id, content_id, final_id, citation_list):
+    store = get_artifact_store()
+    return validation.validate(
+        structure_text=(store.get_text(structure_id) or "") if structure_id else "",
+        content_text=(store.get_text(content_id) or "") if content_id else "",
+        final_text=(store.get_text(final_id) or "") if final_id else "",
+        citation_list=citation_list,
+    )
 
-# ---------- Agent 2: generate structure from summary ----------
 
-def generate_structure_from_summary(job_summary_text, model="gpt-4.1-mini"):
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": job_summary_text}
-            ],
-        }
-    ]
+def start_speculation(stage, key, fn, *args, **kwargs):
+    """
+    In speculative mode, start ``fn`` for the next ``stage`` in the
+    background. Replaces any earlier speculation for that stage.
+    """
+    previous = session_speculations().pop(stage, None)
+    if previous is not None:
+        previous.discard()
+    if st.session_state.get("speculative"):
+        session_speculations()[stage] = Speculation(key, fn, *args, **kwargs)
 
-    response = client.responses.create(
-        model=model,
-        instructions=STRUCTURE_PROMPT,
-        input=messages,
-    )
 
-    return response.output_text
+def pending_speculation(stage, key):
+    """
+    The speculation for ``stage`` if it was started from the input ``key``
+    describes. One started from different input (the text was edited since)
+    is discarded.
+    """
+    speculation = session_speculations().get(stage)
+    if speculation is not None and speculation.key != key:
+        session_speculations().pop(stage).discard()
+        return None
+    return speculation
 
 
-# ---------- Agent 3: generate content from structure ----------
+def with_speculation(stage, key, fn):
+    """
+    ``fn``, answered by the matching speculation for ``stage`` when there is
+    one. A speculation that failed falls back to calling ``fn``.
+    """
+    speculation = pending_speculation(stage, key)
+    if speculation is None:
+        return fn
+    del session_speculations()[stage]
+    speculation.adopt()
+
+    def run(*args, on_text=None, **kwargs):
+        try:
+            return speculation.result(on_text=on_text)
+        except jobs.JobCancelled:
+            raise
+        except Exception:
+            return fn(*args, on_text=on_text, **kwargs)
+
+    return run
+
+
+def speculation_note(stage, key, label):
+    speculation = pending_speculation(stage, key)
+    if speculation is None:
+        return
+    if speculation.future.done():
+        st.caption(f"⚡ The {label} is ready and will be used if you continue without editing.")
+    else:
+        st.caption(
+            f"⚡ The {label} is being prepared in the background; it will be used if you "
+            "continue without editing."
+        )
 
-def generate_content_from_structure(structure_text, model="gpt-4.1-mini"):
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": structure_text}
-            ],
-        }
-    ]
 
-    response = client.responses.create(
-        model=model,
-        instructions=CONTENT_PROMPT,
-        input=messages,
+def submit_job(stage, key, fn, *args, **kwargs):
+    """
+    Run ``fn(*args, **kwargs)`` for ``stage`` as a background job, or join
+    the identical one already running, and remember it in the session and
+    the URL.
+    """
+    job_id = jobs.get_runner().submit(
+        stage,
+        key,
+        fn,
+        *args,
+        session_id=st.session_state["session_id"],
+        reuse=not st.session_state.get("regenerate", False),
+        **kwargs,
     )
+    st.session_state["jobs"][stage] = job_id
+    st.session_state["job_messages"].pop(stage, None)
+    st.query_params[stage] = job_id
+    # Later steps are replaced once this one finishes.
+    for later in JOB_STAGES[JOB_STAGES.index(stage) + 1:]:
+        st.query_params.pop(later, None)
+    st.rerun()
+
+
+def on_summary(result, restoring):
+    result = json.loads(result)
+    summary_text = result["summary"]
+    set_artifact("job_summary", summary_text)
+    set_artifact("image_report", json.dumps(result["image_report"]) if result["image_report"] else "")
+    drop_artifacts("structure", "content", "references", "final_document")
+    if not restoring:
+        use_cache = not st.session_state.get("regenerate", False)
+        start_speculation(
+            "structure",
+            speculation_key("structure", summary_text, use_cache=use_cache),
+            generate_structure_from_summary,
+            summary_text,
+            use_cache=use_cache,
+        )
 
-    return response.output_text
 
+def on_structure(structure_text, restoring):
+    set_artifact("structure", structure_text)
+    drop_artifacts("content", "references", "final_document")
+    if not restoring:
+        use_cache = not st.session_state.get("regenerate", False)
+        parallel = st.session_state.get("parallel_sections", False)
+        max_workers = st.session_state.get("section_concurrency", DEFAULT_SECTION_CONCURRENCY)
+        start_speculation(
+            "content",
+            speculation_key(
+                "content", structure_text, parallel=parallel,
+                max_workers=max_workers, use_cache=use_cache,
+            ),
+            generate_content_from_structure,
+            structure_text,
+            parallel=parallel,
+            max_workers=max_workers,
+            use_cache=use_cache,
+        )
 
-# ---------- Agent 4: generate references & in-text citations list ----------
 
-def generate_references_from_content(content_text, reference_style, total_words, model="gpt-4.1"):
-    combined = (
-        f"Reference style: {reference_style}\n"
-        f"Approximate total word count: {total_words}\n\n"
-        f"Content:\n{content_text}"
+def on_content(content_text, restoring):
+    set_artifact("content", content_text)
+    artifacts = st.session_state["artifacts"]
+    artifacts["content_structure"] = st.session_state["job_inputs"].get(
+        "content", artifacts.get("structure")
     )
+    drop_artifacts("references", "final_document")
 
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": combined}
-            ],
-        }
-    ]
 
-    response = client.responses.create(
-        model=model,
-        instructions=REFERENCES_PROMPT,
-        input=messages,
+def on_update(result, restoring):
+    result = json.loads(result)
+    changes = result["changes"]
+    artifacts = st.session_state["artifacts"]
+    artifacts["content_structure"] = st.session_state["job_inputs"].get(
+        "update", artifacts.get("structure")
     )
-
-    return response.output_text
-
-
-# ---------- Agent 5: finalize document with in-text citations + reference list ----------
-
-def generate_final_document_with_citations(
-    content_text,
-    reference_list,
-    citation_list,
-    reference_style,
-    model="gpt-4.1"
-):
-    combined = (
-        f"Reference style: {reference_style}\n\n"
-        "=== CONTENT (NO CITATIONS) ===\n"
-        f"{content_text}\n\n"
-        "=== REFERENCE LIST ===\n"
-        f"{reference_list}\n\n"
-        "=== CITATION LIST ===\n"
-        f"{citation_list}\n"
+    if changes["added"] or changes["changed"] or changes["removed"]:
+        set_artifact("content", result["content"])
+        drop_artifacts("final_document")
+        # New or dropped sections change what needs referencing.
+        if changes["added"] or changes["removed"]:
+            drop_artifacts("references")
+    st.session_state["job_messages"]["update"] = (
+        "success",
+        f"Rewrote {len(changes['added']) + len(changes['changed'])} section(s), "
+        f"kept {len(changes['kept'])}, removed {len(changes['removed'])}.",
     )
 
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": combined}
-            ],
-        }
-    ]
 
-    response = client.responses.create(
-        model=model,
-        instructions=FINALIZE_PROMPT,
-        input=messages,
-    )
+def on_references(refs_text, restoring):
+    set_artifact("references", refs_text)
+    drop_artifacts("final_document")
 
-    return response.output_text
 
+def on_final(final_doc, restoring):
+    set_artifact("final_document", final_doc)
+
+
+JOB_HANDLERS = {
+    "summary": on_summary,
+    "structure": on_structure,
+    "content": on_content,
+    "update": on_update,
+    "references": on_references,
+    "final": on_final,
+}
+
+
+def job_summary_job(*args, **kwargs):
+    # The image stats travel with the summary, so a reused or restored job
+    # still has them.
+    report = {}
+    summary_text = generate_job_summary(*args, report=report, **kwargs)
+    return json.dumps({"summary": summary_text, "image_report": report})
+
+
+def regenerate_sections_job(*args, **kwargs):
+    # Job results are stored as text.
+    content_text, changes = regenerate_changed_sections(*args, **kwargs)
+    return json.dumps({"content": content_text, "changes": changes})
+
+
+def rewrite_sections_job(*args, **kwargs):
+    content_text, changes = rewrite_sections(*args, **kwargs)
+    return json.dumps({"content": content_text, "changes": changes})
+
+
+def collect_jobs(restoring=False):
+    """
+    Apply the results of this session's background jobs that have ended, in
+    pipeline order. ``restoring`` is set when a new session picks up the
+    jobs named in the URL.
+    """
+    runner = jobs.get_runner()
+    for stage in JOB_STAGES:
+        job_id = st.session_state["jobs"].get(stage)
+        if job_id is None:
+            continue
+        job = runner.get(job_id)
+        if job is not None and job["status"] in jobs.ACTIVE_STATUSES:
+            continue
+        del st.session_state["jobs"][stage]
+        if job is not None and job["status"] == jobs.DONE:
+            JOB_HANDLERS[stage](job["result"], restoring)
+            continue
+        st.query_params.pop(stage, None)
+        if job is not None and job["status"] == jobs.FAILED and not restoring:
+            st.session_state["job_messages"][stage] = (
+                "error", f"Something went wrong during {JOB_LABELS[stage]}: {job['error']}"
+            )
+
+
+def show_job(stage, height=300):
+    """
+    The running job of ``stage`` (if any) and the outcome message of its
+    last one.
+    """
+    kind, message = st.session_state["job_messages"].pop(stage, (None, None))
+    if kind == "error":
+        st.error(message)
+    elif kind == "success":
+        st.success(message)
+    if stage in st.session_state["jobs"]:
+        job_progress(stage, height)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(stage, height):
+    """
+    Live view of a running job, refreshed on its own; the whole page reruns
+    once the job has ended so its result is applied.
+    """
+    touch_session()
+    runner = jobs.get_runner()
+    job_id = st.session_state["jobs"].get(stage)
+    job = runner.get(job_id) if job_id else None
+    if job is None or job["status"] not in jobs.ACTIVE_STATUSES:
+        st.rerun()
+
+    queue = scheduler.get_scheduler().status(st.session_state["session_id"])
+    if queue is not None:
+        st.caption(
+            f"⏳ Waiting for the API rate limit: position {queue['position']} in the queue, "
+            f"{queue['waiting']} request(s) from this session, about {queue['eta_seconds']:.0f}s."
+        )
+    elif job["status"] == jobs.QUEUED:
+        st.caption("⏳ Waiting for a free worker...")
+    else:
+        st.caption(
+            f"✍️ {JOB_LABELS[stage].capitalize()} is running in the background. You can keep "
+            "working, or close this tab and reopen the same URL later."
+        )
+    with st.container(height=height):
+        st.markdown(job["partial"])
+    if st.button("Cancel", key=f"cancel_{stage}"):
+        runner.cancel(job_id)
 
-# ---------- Streamlit UI ----------
 
 st.set_page_config(page_title="Click To Assignment", page_icon="📝", layout="centered")
 
 st.title("📝 Click To Assignment (Summary → Structure → Content → References → Final)")
 
-# Session state for all stages
-if "job_summary" not in st.session_state:
-    st.session_state["job_summary"] = ""
-if "structure" not in st.session_state:
-    st.session_state["structure"] = ""
-if "content" not in st.session_state:
-    st.session_state["content"] = ""
-if "references" not in st.session_state:
-    st.session_state["references"] = ""
-if "final_document" not in st.session_state:
-    st.session_state["final_document"] = ""
+# Session state for all stages: artifact ids of the stage outputs
+# (job_summary, structure, content, references, final_document and the
+# structure the content was written from) and of the uploaded files.
+if "artifacts" not in st.session_state:
+    st.session_state["artifacts"] = {}
+if "uploads" not in st.session_state:
+    st.session_state["uploads"] = []
+if "upload_generation" not in st.session_state:
+    st.session_state["upload_generation"] = 0
+if "run_id" not in st.session_state:
+    st.session_state["run_id"] = st.query_params.get("run") or uuid.uuid4().hex[:12]
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+if "job_inputs" not in st.session_state:
+    st.session_state["job_inputs"] = {}
+if "job_messages" not in st.session_state:
+    st.session_state["job_messages"] = {}
+restoring_jobs = "jobs" not in st.session_state
+if restoring_jobs:
+    # A new session (reload, new tab) picks up the jobs named in the URL.
+    st.session_state["jobs"] = {s: st.query_params[s] for s in JOB_STAGES if s in st.query_params}
+
+# Model calls made during this script run are traced under the session's run
+# and queued under the session.
+telemetry.set_current_run(st.session_state["run_id"])
+scheduler.set_session(st.session_state["session_id"])
+touch_session()
+collect_jobs(restoring=restoring_jobs)
 
 st.write(
     "Step 1: Generate a **Job Summary** from your brief and files.\n\n"
@@ -309,6 +469,27 @@ st.write(
     "Step 4: Generate a **Reference List & Citation List** from the content.\n\n"
     "Step 5: Insert **in-text citations** and append the **reference list** to create the final document."
 )
+st.caption(
+    "Each step runs in the background and its output appears as it is written. You can "
+    "keep editing, or close the tab and reopen the same URL to pick up a running step. "
+    "Use **Cancel** to stop a generation that is going wrong."
+)
+
+regenerate = st.checkbox(
+    "♻️ Regenerate (ignore cached responses)",
+    value=False,
+    key="regenerate",
+    help="Identical requests are normally answered from a local cache. "
+         "Tick this to force a fresh model call.",
+)
+st.checkbox(
+    "⚡ Prepare the next step in the background",
+    value=False,
+    key="speculative",
+    help="As soon as the Job Summary or structure is ready, the next step starts in the "
+         "background and is used if you continue without editing. Edits discard it, so "
+         "this can cost an extra model call.",
+)
 
 # ---------- Step 1: Summary generation ----------
 with st.form("job_summary_form"):
@@ -318,19 +499,41 @@ with st.form("job_summary_form"):
         height=120,
     )
 
+    # A new key after each submission clears the uploader; the files are
+    # kept in the artifact store instead of the browser session.
     files = st.file_uploader(
         "Upload attachments",
         type=ALLOWED_EXTENSIONS,
         accept_multiple_files=True,
         help="You can upload DOC, DOCX, PDF, PNG, JPG, JPEG, PPTX, CSV, XLSX, XLX files.",
+        key=f"uploads_{st.session_state['upload_generation']}",
     )
+    keep_uploads = False
+    if st.session_state["uploads"]:
+        keep_uploads = st.checkbox(
+            "Use the files attached last time: "
+            + ", ".join(name for name, _ in st.session_state["uploads"]),
+            value=True,
+            help="Files uploaded above replace them.",
+        )
 
     submitted_summary = st.form_submit_button("① Generate Job Summary")
 
 if submitted_summary:
+    if files:
+        store = get_artifact_store()
+        ctx = get_script_run_ctx()
+        st.session_state["uploads"] = [(f.name, store.put_bytes(f.getvalue())) for f in files]
+        for f in files:
+            ctx.uploaded_file_mgr.remove_file(ctx.session_id, f.file_id)
+        st.session_state["upload_generation"] += 1
+    elif not keep_uploads:
+        st.session_state["uploads"] = []
+    uploads = [StoredFile(name, artifact_id) for name, artifact_id in st.session_state["uploads"]]
+
     # Allow: instructions only, files only, or both.
     has_instruction = bool(instruction and instruction.strip())
-    has_files = bool(files)
+    has_files = bool(uploads)
 
     if not has_instruction and not has_files:
         st.error("Please either upload at least one file or enter some instructions.")
@@ -339,120 +542,310 @@ if submitted_summary:
             st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
         else:
             try:
-                with st.spinner("Generating Job Summary..."):
-                    summary_text = generate_job_summary(instruction, files or [])
-                st.session_state["job_summary"] = summary_text
-                st.session_state["structure"] = ""
-                st.session_state["content"] = ""
-                st.session_state["references"] = ""
-                st.session_state["final_document"] = ""
+                # A new brief starts a new pipeline run in the trace.
+                st.session_state["run_id"] = uuid.uuid4().hex[:12]
+                st.query_params["run"] = st.session_state["run_id"]
+                telemetry.set_current_run(st.session_state["run_id"])
+                for speculation in session_speculations().values():
+                    speculation.discard()
+                session_speculations().clear()
+                submit_job(
+                    "summary",
+                    jobs.job_key(
+                        "summary",
+                        instruction,
+                        st.session_state["uploads"],
+                        not regenerate,
+                    ),
+                    job_summary_job,
+                    instruction,
+                    uploads,
+                    use_cache=not regenerate,
+                )
             except Exception as e:
                 st.error(f"Something went wrong during summary generation: {e}")
+show_job("summary")
 
 # ---------- Show Job Summary + Step 2 ----------
-if st.session_state["job_summary"]:
+@stage_fragment
+def summary_stage():
     st.subheader("📌 Job Summary (Agent 1 output)")
+    image_report = json.loads(artifact("image_report") or "{}")
+    if image_report.get("images"):
+        saved = image_report["bytes_before"] - image_report["bytes_after"]
+        st.caption(
+            f"🖼️ Sent {image_report['sent']} of {image_report['images']} image(s) "
+            f"({image_report['duplicates']} duplicate(s) dropped): "
+            f"{image_report['bytes_before'] / 1e6:.1f} MB → {image_report['bytes_after'] / 1e6:.1f} MB, "
+            f"saved {max(saved, 0) / 1e6:.1f} MB before base64 encoding."
+        )
     edited_summary = st.text_area(
         "You can edit the Job Summary before generating the structure (optional):",
-        value=st.session_state["job_summary"],
+        value=artifact("job_summary"),
         height=250,
     )
-    st.session_state["job_summary"] = edited_summary
+    set_artifact("job_summary", edited_summary)
+    structure_key = speculation_key("structure", edited_summary, use_cache=not regenerate)
+    speculation_note("structure", structure_key, "structure")
 
     if st.button("② Generate Detailed Structure (with word breakdown)"):
         if not os.environ.get("OPENAI_API_KEY"):
             st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
         else:
             try:
-                with st.spinner("Generating structure from Job Summary..."):
-                    structure_text = generate_structure_from_summary(
-                        st.session_state["job_summary"]
-                    )
-                st.session_state["structure"] = structure_text
-                st.session_state["content"] = ""
-                st.session_state["references"] = ""
-                st.session_state["final_document"] = ""
+                submit_job(
+                    "structure",
+                    jobs.job_key("structure", structure_key),
+                    with_speculation("structure", structure_key, generate_structure_from_summary),
+                    edited_summary,
+                    use_cache=not regenerate,
+                )
             except Exception as e:
                 st.error(f"Something went wrong during structure generation: {e}")
 
+
+if artifact("job_summary"):
+    summary_stage()
+    show_job("structure")
+
 # ---------- Show Structure + Step 3 ----------
-if st.session_state["structure"]:
+@stage_fragment
+def structure_stage():
     st.subheader("📚 Detailed Structure (Agent 2 output)")
     edited_structure = st.text_area(
         "You can edit the structure before generating the content (optional):",
-        value=st.session_state["structure"],
+        value=artifact("structure"),
         height=350,
     )
-    st.session_state["structure"] = edited_structure
+    set_artifact("structure", edited_structure)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        parallel_sections = st.checkbox(
+            "Write sections in parallel",
+            value=False,
+            key="parallel_sections",
+            help="Writes each numbered section of the structure at the same time "
+                 "and joins them in order. Much faster for long documents.",
+        )
+    with col2:
+        section_concurrency = st.number_input(
+            "Max sections at once",
+            min_value=1,
+            max_value=16,
+            value=DEFAULT_SECTION_CONCURRENCY,
+            key="section_concurrency",
+            disabled=not parallel_sections,
+        )
+
+    content_key = speculation_key(
+        "content", edited_structure, parallel=parallel_sections,
+        max_workers=section_concurrency, use_cache=not regenerate,
+    )
+    speculation_note("content", content_key, "content")
 
     if st.button("③ Generate Full Academic Content"):
         if not os.environ.get("OPENAI_API_KEY"):
             st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
         else:
             try:
-                with st.spinner("Generating content from structure..."):
-                    content_text = generate_content_from_structure(
-                        st.session_state["structure"]
-                    )
-                st.session_state["content"] = content_text
-                st.session_state["references"] = ""
-                st.session_state["final_document"] = ""
+                st.session_state["job_inputs"]["content"] = st.session_state["artifacts"].get("structure")
+                submit_job(
+                    "content",
+                    jobs.job_key("content", content_key),
+                    with_speculation("content", content_key, generate_content_from_structure),
+                    edited_structure,
+                    parallel=parallel_sections,
+                    max_workers=section_concurrency,
+                    use_cache=not regenerate,
+                )
             except Exception as e:
                 st.error(f"Something went wrong during content generation: {e}")
 
+    # Offer a partial update when the structure was edited after step ③.
+    artifacts = st.session_state["artifacts"]
+    if (
+        artifacts.get("content")
+        and artifacts.get("content_structure")
+        and artifacts["content_structure"] != artifacts.get("structure")
+        and artifact("content_structure").strip() != edited_structure.strip()
+    ):
+        st.info("The structure has changed since the content was generated.")
+        if st.button("↻ Update only the changed sections"):
+            if not os.environ.get("OPENAI_API_KEY"):
+                st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
+            else:
+                try:
+                    st.session_state["job_inputs"]["update"] = artifacts.get("structure")
+                    submit_job(
+                        "update",
+                        jobs.job_key(
+                            "update",
+                            artifacts["content_structure"],
+                            artifacts.get("structure"),
+                            artifacts["content"],
+                            section_concurrency,
+                            not regenerate,
+                        ),
+                        regenerate_sections_job,
+                        artifact("content_structure"),
+                        edited_structure,
+                        artifact("content"),
+                        max_workers=section_concurrency,
+                        use_cache=not regenerate,
+                    )
+                except Exception as e:
+                    st.error(f"Something went wrong during section regeneration: {e}")
+
+
+if artifact("structure"):
+    structure_stage()
+    show_job("content", height=400)
+    show_job("update", height=400)
+
 # ---------- Show content + Step 4 ----------
-if st.session_state["content"]:
+@stage_fragment
+def content_stage():
     st.subheader("📖 Final Academic Content (Agent 3 output)")
     edited_content = st.text_area(
         "You can edit the content before generating references (optional):",
-        value=st.session_state["content"],
+        value=artifact("content"),
         height=400,
     )
-    st.session_state["content"] = edited_content
+    set_artifact("content", edited_content)
 
     st.markdown("### 📚 Step 4: Generate Reference List & In-text Citation List")
 
-    default_word_count = len(edited_content.split()) if edited_content.strip() else 0
-
     col1, col2 = st.columns(2)
     with col1:
-        reference_style = st.text_input("Reference style", value="Harvard", key="ref_style_step4")
+        reference_style = st.text_input(
+            "Reference style",
+            value=artifact_reference_style(st.session_state["artifacts"].get("job_summary")),
+            key="ref_style_step4",
+        )
     with col2:
         total_words = st.number_input(
             "Approximate total word count",
             min_value=0,
-            value=default_word_count,
+            value=artifact_word_count(st.session_state["artifacts"].get("content")),
             key="wc_step4",
         )
 
+    reference_source = st.radio(
+        "Reference source",
+        ["Generate with the model", "Local reference index"],
+        key="reference_source",
+        horizontal=True,
+        help="The local reference index holds sources imported from BibTeX, RIS or CSL-JSON "
+             "exports. References are then chosen from it by matching the content's themes, "
+             "so every reference is a stored record.",
+    )
+    use_index = reference_source == "Local reference index"
+    format_with_model = False
+    if use_index:
+        index = get_reference_index()
+        with st.expander(
+            f"📥 Reference index: {index.count(MIN_REFERENCE_YEAR)} source(s) from "
+            f"{MIN_REFERENCE_YEAR} onwards"
+        ):
+            reference_files = st.file_uploader(
+                "Import BibTeX, RIS or CSL-JSON exports",
+                type=REFERENCE_FILE_EXTENSIONS,
+                accept_multiple_files=True,
+                key="reference_files",
+            )
+            if reference_files and st.button("Import into the index"):
+                for f in reference_files:
+                    try:
+                        records = load_references(f.name, f.getvalue())
+                        added = index.add(records)
+                        st.success(f"{f.name}: {len(records)} source(s), {added} new.")
+                    except ValueError as e:
+                        st.error(f"Could not import {f.name}: {e}")
+
+        matches = index.search(
+            artifact_keywords(st.session_state["artifacts"].get("content")),
+            limit=reference_count(total_words),
+        )
+        with st.expander(f"🔎 {len(matches)} matching source(s)"):
+            st.dataframe(
+                [
+                    {"Year": r.get("year"), "Title": r.get("title"), "Venue": r.get("container"), "Id": r["id"]}
+                    for r in matches
+                ],
+                hide_index=True,
+            )
+        if style_key(reference_style):
+            format_with_model = st.checkbox(
+                "Let the model format the matched sources",
+                value=False,
+                key="format_with_model",
+                help=f"{reference_style} is formatted locally without a model call by default.",
+            )
+        else:
+            format_with_model = True
+            st.caption(f"There is no local formatter for {reference_style}; the model will format the matched sources.")
+
     if st.button("④ Generate References & Citation List"):
         if not os.environ.get("OPENAI_API_KEY"):
             st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
+        elif use_index:
+            try:
+                submit_job(
+                    "references",
+                    jobs.job_key(
+                        "references",
+                        st.session_state["artifacts"].get("content"),
+                        reference_style,
+                        total_words,
+                        "index",
+                        [r["id"] for r in matches],
+                        format_with_model,
+                        not regenerate,
+                    ),
+                    generate_references_from_index,
+                    edited_content,
+                    reference_style,
+                    total_words,
+                    format_with_model=format_with_model,
+                    use_cache=not regenerate,
+                )
+            except Exception as e:
+                st.error(f"Something went wrong during reference generation: {e}")
         else:
             try:
-                with st.spinner("Generating references and in-text citations..."):
-                    refs_text = generate_references_from_content(
-                        st.session_state["content"],
+                submit_job(
+                    "references",
+                    jobs.job_key(
+                        "references",
+                        st.session_state["artifacts"].get("content"),
                         reference_style,
                         total_words,
-                    )
-                st.session_state["references"] = refs_text
-                st.session_state["final_document"] = ""
+                        not regenerate,
+                    ),
+                    generate_references_from_content,
+                    edited_content,
+                    reference_style,
+                    total_words,
+                    use_cache=not regenerate,
+                )
             except Exception as e:
                 st.error(f"Something went wrong during reference generation: {e}")
 
+
+if artifact("content"):
+    content_stage()
+    show_job("references")
+
 # ---------- Show references + Step 5 ----------
-if st.session_state["references"]:
+@stage_fragment
+def references_stage():
     st.subheader("📚 Reference List & Citation List (Agent 4 output)")
-    refs_raw = st.session_state["references"]
+    # Keyed by the references artifact so new references replace the lists.
+    refs_id = st.session_state["artifacts"]["references"]
 
     # Try to auto-split into Reference List and Citation List using the heading
-    default_ref_list = refs_raw
-    default_cit_list = ""
-    if "Citation List" in refs_raw:
-        head, tail = refs_raw.split("Citation List", 1)
-        default_ref_list = head.strip()
-        default_cit_list = "Citation List" + tail.strip()
+    default_ref_list, default_cit_list = artifact_reference_split(refs_id)
 
     st.markdown("You can adjust the Reference List and Citation List before finalizing (optional):")
 
@@ -466,14 +859,22 @@ if st.session_state["references"]:
         "Reference List",
         value=default_ref_list,
         height=250,
-        key="ref_list_text",
+        key=f"ref_list_{refs_id[:12]}",
     )
 
     citation_list_text = st.text_area(
         "Citation List",
         value=default_cit_list,
         height=250,
-        key="cit_list_text",
+        key=f"cit_list_{refs_id[:12]}",
+    )
+
+    compact_citations = st.checkbox(
+        "Place citations locally (faster)",
+        value=False,
+        key="compact_citations",
+        help="The model only returns where each citation goes; the app inserts them "
+             "and appends the reference list without re-writing the document.",
     )
 
     if st.button("⑤ Generate Final Document with Citations"):
@@ -481,22 +882,184 @@ if st.session_state["references"]:
             st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
         else:
             try:
-                with st.spinner("Inserting in-text citations and appending reference list..."):
-                    final_doc = generate_final_document_with_citations(
-                        content_text=st.session_state["content"],
-                        reference_list=reference_list_text,
-                        citation_list=citation_list_text,
-                        reference_style=reference_style_final,
-                    )
-                st.session_state["final_document"] = final_doc
+                submit_job(
+                    "final",
+                    jobs.job_key(
+                        "final",
+                        st.session_state["artifacts"].get("content"),
+                        reference_list_text,
+                        citation_list_text,
+                        reference_style_final,
+                        compact_citations,
+                        not regenerate,
+                    ),
+                    generate_final_document_with_citations,
+                    content_text=artifact("content"),
+                    reference_list=reference_list_text,
+                    citation_list=citation_list_text,
+                    reference_style=reference_style_final,
+                    use_cache=not regenerate,
+                    compact=compact_citations,
+                )
             except Exception as e:
                 st.error(f"Something went wrong during final document generation: {e}")
 
+
+if artifact("references"):
+    references_stage()
+    show_job("final", height=400)
+
 # ---------- Show final document ----------
-if st.session_state["final_document"]:
+if artifact("final_document"):
     st.subheader("✅ Final Document with In-text Citations and Reference List (Agent 5 output)")
     st.text_area(
         "Final document (copy-paste friendly)",
-        value=st.session_state["final_document"],
+        value=artifact("final_document"),
         height=500,
     )
+
+# ---------- Validation ----------
+WORD_STATUS_LABELS = {
+    "ok": "✅ on target",
+    "short": "🔻 short",
+    "long": "🔺 long",
+    "missing": "❌ missing",
+    "no target": "–",
+}
+
+
+@stage_fragment
+def validation_stage():
+    st.subheader("🧪 Validation report")
+    artifacts = st.session_state["artifacts"]
+    refs_id = artifacts.get("references")
+    citation_list = ""
+    if refs_id:
+        # The Citation List as edited in step 5, if it was.
+        citation_list = st.session_state.get(
+            f"cit_list_{refs_id[:12]}", artifact_reference_split(refs_id)[1]
+        )
+    report = validation_report(
+        artifacts.get("structure"),
+        artifacts.get("content"),
+        artifacts.get("final_document"),
+        citation_list,
+    )
+    st.caption(f"Checked locally in {report['seconds'] * 1000:.0f} ms, without model calls.")
+
+    if report["sections"]:
+        tolerance = f"±{validation.WORD_COUNT_TOLERANCE:.0%}"
+        total = report["total"]
+        st.markdown(
+            f"**Word counts** (target {tolerance}): {total['words']:,} words"
+            + (f" of {total['target']:,}" if total["target"] else "")
+            + f" — {WORD_STATUS_LABELS[total['status']]}"
+        )
+        st.dataframe(
+            [
+                {
+                    "Section": f"{r['number']} {r['title']}".strip(),
+                    "Target": r["target"],
+                    "Words": r["words"],
+                    "Deviation": f"{r['deviation']:+.0%}" if r["deviation"] is not None else "",
+                    "Status": WORD_STATUS_LABELS[r["status"]],
+                }
+                for r in report["sections"]
+            ],
+            hide_index=True,
+        )
+        off_target = [r["title"] for r in report["sections"] if r["status"] in ("short", "long", "missing")]
+        if off_target:
+            titles = st.multiselect(
+                "Sections to rewrite",
+                [r["title"] for r in report["sections"]],
+                default=off_target,
+                key=f"rewrite_titles_{artifacts['content'][:12]}",
+            )
+            if titles and st.button("✏️ Rewrite only these sections"):
+                if not os.environ.get("OPENAI_API_KEY"):
+                    st.error("OPENAI_API_KEY is not set. Please set it in your environment.")
+                else:
+                    try:
+                        max_workers = st.session_state.get("section_concurrency", DEFAULT_SECTION_CONCURRENCY)
+                        st.session_state["job_inputs"]["update"] = artifacts.get("structure")
+                        submit_job(
+                            "update",
+                            jobs.job_key(
+                                "rewrite",
+                                artifacts.get("structure"),
+                                artifacts["content"],
+                                sorted(titles),
+                                max_workers,
+                            ),
+                            rewrite_sections_job,
+                            artifact("structure"),
+                            artifact("content"),
+                            titles,
+                            max_workers=max_workers,
+                        )
+                    except Exception as e:
+                        st.error(f"Something went wrong during section regeneration: {e}")
+
+    if report["citations"]:
+        used = sum(1 for c in report["citations"] if c["uses"])
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Citations used", f"{used} / {len(report['citations'])}")
+        col2.metric("Uncited", len(report["uncited"]))
+        col3.metric("Not in the list", len(report["unknown"]))
+        col4.metric("Misplaced", len(report["misplaced"]))
+        if report["uncited"]:
+            st.warning("Never cited: " + "; ".join(report["uncited"]))
+        if report["unknown"]:
+            st.warning(
+                "Cited but not in the Citation List: " + "; ".join(report["unknown"])
+                + ". Add them to the lists in step 5 or remove them from the document."
+            )
+        for m in report["misplaced"]:
+            st.warning(f"Citations in {m['section'] or 'the opening'}: " + "; ".join(m["citations"]))
+        if report["uncited"] or report["misplaced"]:
+            if st.button(
+                "🩹 Fix citations locally",
+                help="Removes citations from the Introduction, Conclusion and summaries and adds "
+                     "the uncited ones to body paragraphs, without a model call.",
+            ):
+                try:
+                    fixed = validation.fix_citations(artifact("final_document"), citation_list)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    set_artifact("final_document", fixed)
+                    st.rerun()
+    elif artifacts.get("final_document") and not citation_list.strip():
+        st.caption("There is no Citation List to check the final document against.")
+
+
+if artifact("content"):
+    validation_stage()
+
+# ---------- Performance trace ----------
+trace_records = telemetry.run_records(st.session_state["run_id"])
+if trace_records:
+    with st.expander("⏱️ Performance trace (this run)"):
+        total_cost = sum(r["cost_usd"] or 0 for r in trace_records)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Model calls", len(trace_records))
+        col2.metric(
+            "Tokens in / out",
+            f"{sum(r['input_tokens'] or 0 for r in trace_records):,} / "
+            f"{sum(r['output_tokens'] or 0 for r in trace_records):,}",
+        )
+        col3.metric("Estimated cost", f"${total_cost:.4f}")
+
+        st.markdown("**By stage**")
+        st.dataframe(telemetry.summarize_by_stage(trace_records), hide_index=True)
+        st.markdown("**Calls**")
+        st.dataframe(trace_records, hide_index=True)
+        st.download_button(
+            "Download trace (JSON lines)",
+            data="\n".join(json.dumps(r, ensure_ascii=False) for r in trace_records),
+            file_name=f"trace-{st.session_state['run_id']}.jsonl",
+            mime="application/x-ndjson",
+        )
+        if telemetry.TRACE_DIR:
+            st.caption(f"All runs are also appended to `{telemetry.TRACE_DIR}/agent_calls-<date>.jsonl`.")
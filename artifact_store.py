@@ -0,0 +1,170 @@
+import os
+import time
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(".cache", "artifacts"))
+# Artifacts nobody has read or written for this long are deleted.
+ARTIFACT_TTL_HOURS = float(os.environ.get("ARTIFACT_TTL_HOURS", "72"))
+# Decompressed artifacts kept in memory, shared by all sessions.
+ARTIFACT_MEMORY_BYTES = int(os.environ.get("ARTIFACT_MEMORY_BYTES", str(64 * 1024 * 1024)))
+ARTIFACT_COMPRESSION_LEVEL = 6
+# Expired artifacts are looked for at most this often.
+ARTIFACT_PRUNE_INTERVAL_SECONDS = 3600
+# Reading an artifact renews its TTL at most this often.
+ARTIFACT_TOUCH_INTERVAL_SECONDS = 600
+
+
+def artifact_id(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of stage outputs and uploads: each artifact is
+    zlib-compressed into ``root/<2 hex>/<sha256>`` and identified by the
+    SHA-256 of its bytes, so sessions hold short ids instead of the data and
+    identical artifacts are stored once.
+
+    Recently used artifacts stay decompressed in a bounded in-memory LRU.
+    Files are written atomically and expire ``ttl_hours`` after they were
+    last used. Safe to share between threads and Streamlit sessions.
+    """
+
+    def __init__(self, root=ARTIFACT_DIR, ttl_hours=ARTIFACT_TTL_HOURS, memory_bytes=ARTIFACT_MEMORY_BYTES):
+        self.root = root
+        self.ttl_seconds = ttl_hours * 3600
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, artifact_id):
+        return os.path.join(self.root, artifact_id[:2], artifact_id[2:])
+
+    def _remember(self, artifact_id, data):
+        with self._lock:
+            if artifact_id in self._memory:
+                self._memory.move_to_end(artifact_id)
+                return
+            if len(data) > self.memory_bytes:
+                return
+            self._memory[artifact_id] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _touch(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > ARTIFACT_TOUCH_INTERVAL_SECONDS:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def put_bytes(self, data: bytes) -> str:
+        """
+        Store ``data`` and return its id. Storing the same bytes again only
+        renews the existing artifact.
+        """
+        key = artifact_id(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so a reader never sees a half-written file.
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, ARTIFACT_COMPRESSION_LEVEL))
+            os.replace(tmp_path, path)
+        self._remember(key, data)
+        self._maybe_prune()
+        return key
+
+    def put_text(self, text: str) -> str:
+        return self.put_bytes(text.encode("utf-8"))
+
+    def get_bytes(self, artifact_id):
+        """
+        The bytes stored under ``artifact_id``, or None if there are none
+        (never stored, or expired).
+        """
+        with self._lock:
+            data = self._memory.get(artifact_id)
+            if data is not None:
+                self._memory.move_to_end(artifact_id)
+        path = self._path(artifact_id)
+        if data is not None:
+            self._touch(path)
+            return data
+        try:
+            with open(path, "rb") as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            return None
+        self._touch(path)
+        self._remember(artifact_id, data)
+        return data
+
+    def get_text(self, artifact_id):
+        data = self.get_bytes(artifact_id)
+        return None if data is None else data.decode("utf-8")
+
+    def _maybe_prune(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < ARTIFACT_PRUNE_INTERVAL_SECONDS:
+                return
+            self._last_prune = now
+        self.prune(now)
+
+    def prune(self, now=None):
+        """
+        Delete artifacts unused for longer than the TTL. Returns how many
+        were deleted.
+        """
+        cutoff = (now or time.time()) - self.ttl_seconds
+        deleted = 0
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        deleted += 1
+                except OSError:
+                    pass
+        return deleted
+
+
+class StoredFile:
+    """
+    An upload kept in the artifact store, with the interface of Streamlit's
+    ``UploadedFile`` that the pipeline uses (``name`` and ``getvalue()``).
+    The bytes are only loaded when read.
+    """
+
+    def __init__(self, name, artifact_id, store=None):
+        self.name = name
+        self.artifact_id = artifact_id
+        self._store = store
+
+    def getvalue(self):
+        data = (self._store or get_artifact_store()).get_bytes(self.artifact_id)
+        if data is None:
+            raise FileNotFoundError(f"Upload {self.name} is no longer available; please upload it again.")
+        return data
+
+
+@lru_cache(maxsize=None)
+def get_artifact_store():
+    """
+    Process-wide artifact store shared by all sessions.
+    """
+    return ArtifactStore()
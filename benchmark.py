@@ -0,0 +1,506 @@
+import io
+import math
+import os
+import re
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from collections import OrderedDict
+
+from mock_responses_server import MockResponsesServer
+
+# Everything below runs against MockResponsesServer, so no API key or network
+# access is needed. The pipeline modules are imported inside main() because
+# they read their settings (cache path, trace directory) at import time.
+
+STRUCTURE_FIXTURE = """Title: The Impact of Hybrid Working on Employee Wellbeing in UK Financial Services
+Total word count: 8,000 words
+
+1. Introduction – 800 words
+1.1 Background to the study – 300 words
+1.2 Research aim and objectives – 250 words
+1.3 Structure of the dissertation – 250 words
+
+2. Literature Review – 2,000 words
+2.1 Defining hybrid working – 400 words
+2.2 Theories of employee wellbeing – 600 words
+2.3 Hybrid working and wellbeing outcomes – 700 words
+2.4 Research gap – 300 words
+
+3. Methodology – 1,200 words
+3.1 Research philosophy and approach – 300 words
+3.2 Data collection – 400 words
+3.3 Sampling and analysis – 350 words
+3.4 Ethical considerations – 150 words
+
+4. Findings – 1,500 words
+4.1 Survey results – 800 words
+4.2 Interview themes – 700 words
+
+5. Discussion – 1,400 words
+5.1 Interpreting the findings – 800 words
+5.2 Implications for managers – 600 words
+
+6. Conclusion and Recommendations – 900 words
+6.1 Conclusion – 500 words
+6.2 Recommendations and future research – 400 words
+
+7. References – 200 words
+"""
+
+SUMMARY_FIXTURE = (
+    "Topic: The Impact of Hybrid Working on Employee Wellbeing in UK Financial Services; "
+    "Word Count: 8000; Reference Style: Harvard; Writing Style: Dissertation; "
+    "Job Summary: A master's level dissertation examining how hybrid working arrangements "
+    "affect employee wellbeing in UK financial services firms, combining a literature review "
+    "with survey and interview evidence and closing with recommendations for managers."
+)
+
+BRIEF_FIXTURE = (
+    "Module: MSc Human Resource Management dissertation. Write an 8,000 word dissertation "
+    "on hybrid working and employee wellbeing in UK financial services. Use Harvard "
+    "referencing with sources published after 2021. Include a literature review, a mixed "
+    "methods methodology, findings, discussion and recommendations. "
+)
+
+_SENTENCES = [
+    "Hybrid working has changed how employees in financial services organise their time.",
+    "Research on wellbeing highlights autonomy, workload and social connection as key drivers.",
+    "Managers play a central role in translating flexible policies into daily practice.",
+    "Survey respondents reported fewer commuting hours but longer periods of screen time.",
+    "Interview participants described both greater flexibility and a blurring of boundaries.",
+    "These patterns are consistent with job demands and resources theory.",
+    "Organisations that invested in line manager training reported stronger engagement.",
+    "The evidence therefore suggests that outcomes depend on how hybrid work is implemented.",
+]
+
+_REFERENCE_AUTHORS = [
+    "Adams", "Baker", "Clarke", "Davies", "Evans", "Foster", "Green", "Hughes",
+    "Iqbal", "Jones", "Khan", "Lewis", "Morgan", "Nolan", "Owen", "Patel",
+]
+
+
+def prose(words, seed=0):
+    """
+    Deterministic academic-sounding filler of roughly ``words`` words.
+    """
+    sentences = []
+    count = 0
+    index = seed
+    while count < words:
+        sentence = _SENTENCES[index % len(_SENTENCES)]
+        sentences.append(sentence)
+        count += len(sentence.split())
+        index += 1
+    paragraphs = [" ".join(sentences[i:i + 5]) for i in range(0, len(sentences), 5)]
+    return "\n\n".join(paragraphs)
+
+
+def references_fixture(count):
+    authors = [_REFERENCE_AUTHORS[i % len(_REFERENCE_AUTHORS)] for i in range(count)]
+    years = [2022 + i % 3 for i in range(count)]
+    reference_list = "\n".join(
+        f"{name}, A. and Smith, B., {year}. Hybrid work and wellbeing study {i + 1}. "
+        f"Journal of Organisational Studies, {10 + i}(2), pp.1-20."
+        for i, (name, year) in enumerate(zip(authors, years))
+    )
+    citation_list = "\n".join(
+        f"({name} and Smith, {year})" for name, year in zip(authors, years)
+    )
+    return f"Reference List\n{reference_list}\n\nCitation List\n{citation_list}"
+
+
+def make_responder(pipeline, scale):
+    """
+    Canned outputs for the five agents, picked by the request's prompt.
+    Generated prose is ``scale`` times the target word count so a full run
+    stays quick while keeping realistic proportions between sections.
+    """
+
+    def input_text(body):
+        for message in body.get("input", []):
+            for item in message.get("content", []):
+                if item.get("type") == "input_text":
+                    return item.get("text", "")
+        return ""
+
+    def section_text(section):
+        words = max(20, int((section["words"] or 300) * scale))
+        return f"{section['number']}. {section['title']}\n\n{prose(words, int(section['number']))}"
+
+    def respond(body):
+        instructions = body.get("instructions") or ""
+        text = input_text(body)
+        if instructions == pipeline.SUMMARY_PROMPT:
+            return SUMMARY_FIXTURE
+        if instructions == pipeline.CONDENSE_PROMPT:
+            return "- " + BRIEF_FIXTURE
+        if instructions == pipeline.STRUCTURE_PROMPT:
+            return STRUCTURE_FIXTURE
+        if instructions == pipeline.SECTION_CONTENT_PROMPT:
+            block = text.split("=== SECTION TO WRITE ===", 1)[-1]
+            _, sections = pipeline.parse_structure_sections(block)
+            return section_text(sections[0]) if sections else prose(100)
+        if instructions == pipeline.CONTENT_PROMPT:
+            _, sections = pipeline._writable_sections(text)
+            return "\n\n".join(section_text(s) for s in sections)
+        if instructions == pipeline.REFERENCES_PROMPT:
+            match = re.search(r"Approximate total word count: (\d+)", text)
+            words = int(match.group(1)) if match else 1000
+            return references_fixture(max(1, round(words / 1000 * 7)))
+        if instructions == pipeline.FINALIZE_PROMPT:
+            content = text.split("=== CONTENT (NO CITATIONS) ===", 1)[-1]
+            content, _, rest = content.partition("=== REFERENCE LIST ===")
+            reference_list = rest.partition("=== CITATION LIST ===")[0]
+            return f"{content.strip()}\n\nReferences\n{reference_list.strip()}"
+        if instructions == pipeline.CITATION_PLACEMENT_PROMPT:
+            sentence_ids = re.findall(r"\[(S\d+\.\d+)\]", text)
+            citation_ids = re.findall(r"^(C\d+):", text, re.MULTILINE)
+            insertions = [
+                {"sentence": sentence_id, "citation": citation_ids[i % len(citation_ids)]}
+                for i, sentence_id in enumerate(sentence_ids[::3])
+            ] if citation_ids else []
+            return json.dumps({"insertions": insertions})
+        return prose(100)
+
+    return respond
+
+
+class _Upload:
+    """
+    The part of Streamlit's ``UploadedFile`` the pipeline uses.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+
+def make_attachments(seed, rows=5000):
+    """
+    A DOCX brief and a CSV data file. ``seed`` changes the bytes so each
+    run misses the extraction cache.
+    """
+    import docx
+
+    document = docx.Document()
+    document.add_heading("Dissertation brief", level=1)
+    for i in range(40):
+        document.add_paragraph(BRIEF_FIXTURE + f"(Paragraph {i + 1}, variant {seed}.)")
+    docx_bytes = io.BytesIO()
+    document.save(docx_bytes)
+
+    rng = random.Random(seed)
+    csv_bytes = io.StringIO()
+    writer = csv.writer(csv_bytes)
+    writer.writerow(["respondent", "department", "days_remote", "wellbeing_score", "submitted"])
+    departments = ["Retail Banking", "Insurance", "Wealth", "Operations", "IT"]
+    for i in range(rows):
+        writer.writerow([
+            i + 1,
+            rng.choice(departments),
+            rng.randint(0, 5),
+            round(rng.uniform(1, 10), 1),
+            f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        ])
+    return [
+        _Upload("brief.docx", docx_bytes.getvalue()),
+        _Upload("survey.csv", csv_bytes.getvalue().encode("utf-8")),
+    ]
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile; None for an empty list.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_pipeline(pipeline, server, files, stream, use_cache, max_workers):
+    """
+    One pass through the five agents (plus the compact finalizer), as the
+    UI would call them. Returns {stage: (seconds, bytes sent to the API)}.
+    """
+    on_text = (lambda text: None) if stream else None
+    stages = OrderedDict()
+
+    def stage(name, fn, *args, **kwargs):
+        before = server.stats()["bytes_received"]
+        result, seconds = timed(fn, *args, on_text=on_text, use_cache=use_cache, **kwargs)
+        stages[name] = (seconds, server.stats()["bytes_received"] - before)
+        return result
+
+    summary = stage("summary", pipeline.generate_job_summary, BRIEF_FIXTURE, files)
+    structure = stage("structure", pipeline.generate_structure_from_summary, summary)
+    content = stage(
+        "content", pipeline.generate_content_from_structure, structure,
+        parallel=True, max_workers=max_workers,
+    )
+    total_words = len(content.split())
+    references = stage(
+        "references", pipeline.generate_references_from_content, content, "Harvard", total_words
+    )
+    reference_list, _, citation_list = references.partition("Citation List")
+    stage(
+        "final", pipeline.generate_final_document_with_citations,
+        content, reference_list.strip(), citation_list.strip(), "Harvard",
+    )
+    stage(
+        "final.compact", pipeline.generate_final_document_with_citations,
+        content, reference_list.strip(), citation_list.strip(), "Harvard", compact=True,
+    )
+    return stages
+
+
+def bench_local(pipeline, extraction, runs):
+    """
+    Timings of the parts that never touch the network, in milliseconds.
+    """
+    results = OrderedDict()
+
+    cold, warm = [], []
+    for run in range(runs):
+        files = [(f.name, f.getvalue()) for f in make_attachments(10_000 + run, rows=20_000)]
+        cold.append(timed(extraction.extract_texts, files)[1])
+        warm.append(timed(extraction.extract_texts, files)[1])
+    results["extraction (cold)"] = cold
+    results["extraction (cached)"] = warm
+
+    results["parse_structure_sections"] = [
+        timed(pipeline.parse_structure_sections, STRUCTURE_FIXTURE)[1] for _ in range(200)
+    ]
+
+    _, sections = pipeline._writable_sections(STRUCTURE_FIXTURE)
+    content = "\n\n".join(
+        f"{s['number']}. {s['title']}\n\n{prose(s['words'], int(s['number']))}" for s in sections
+    )
+    citations = pipeline.parse_citation_list(references_fixture(56).partition("Citation List")[2])
+    lines = pipeline._classify_content_lines(content)
+    numbered = pipeline._numbered_citable_content(lines)
+    sentence_ids = re.findall(r"\[(S\d+\.\d+)\]", numbered)
+    insertions = [(sid, i % len(citations)) for i, sid in enumerate(sentence_ids[::3])]
+    results["apply_citation_insertions"] = [
+        timed(pipeline.apply_citation_insertions, content, citations, insertions, "References")[1]
+        for _ in range(20)
+    ]
+
+    brief = BRIEF_FIXTURE * 20_000
+    results["chunk_text (large brief)"] = [
+        timed(pipeline.chunk_text, brief, pipeline.SUMMARY_CHUNK_TOKENS)[1] for _ in range(runs)
+    ]
+
+    messages = [{"role": "user", "content": [{"type": "input_text", "text": content}]}]
+    results["make_cache_key"] = [
+        timed(pipeline.make_cache_key, pipeline.CONTENT_PROMPT, "gpt-4.1-mini", messages)[1]
+        for _ in range(50)
+    ]
+    cache = pipeline.get_response_cache()
+    key = pipeline.make_cache_key(pipeline.CONTENT_PROMPT, "gpt-4.1-mini", messages)
+    cache.put(key, content)
+    results["response cache get (hit)"] = [timed(cache.get, key)[1] for _ in range(50)]
+
+    return OrderedDict((name, [s * 1000 for s in values]) for name, values in results.items())
+
+
+def format_table(headers, rows):
+    widths = [
+        max(len(str(h)), *(len(str(r[i])) for r in rows)) if rows else len(str(h))
+        for i, h in enumerate(headers)
+    ]
+    lines = ["  ".join(str(h).ljust(w) for h, w in zip(headers, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for row in rows:
+        lines.append("  ".join(str(c).ljust(w) for c, w in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def _fmt(value, digits=3):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline offline against a local mock Responses API."
+    )
+    parser.add_argument("--runs", type=int, default=5, help="end-to-end runs per measurement")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds before the first byte")
+    parser.add_argument("--tps", type=float, default=2000.0, help="mock output tokens per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of mock requests that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scale", type=float, default=0.1,
+        help="mock output length as a fraction of each section's target word count",
+    )
+    parser.add_argument("--workers", default="1,2,4,8", help="section concurrency levels to compare")
+    parser.add_argument("--no-stream", action="store_true", help="call the agents without on_text")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+    workers = [int(w) for w in args.workers.split(",") if w.strip()]
+
+    scratch = tempfile.mkdtemp(prefix="pipeline-bench-")
+    os.environ["OPENAI_API_KEY"] = "sk-benchmark"
+    os.environ["RESPONSE_CACHE_PATH"] = os.path.join(scratch, "responses.sqlite3")
+    os.environ["PIPELINE_TRACE_DIR"] = ""
+
+    import pipeline
+    import extraction
+    import telemetry
+
+    server = MockResponsesServer(
+        latency=args.latency,
+        tokens_per_second=args.tps,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        responder=make_responder(pipeline, args.scale),
+    ).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+
+    results = {"settings": vars(args), "stages": {}, "end_to_end": {}, "scaling": [], "local_ms": {}}
+    stage_seconds = OrderedDict()
+    stage_bytes = OrderedDict()
+    end_to_end = []
+    failures = 0
+    try:
+        print(f"Mock Responses API on {server.base_url}; {args.runs} run(s)...", file=sys.stderr)
+        last_files = None
+        for run in range(args.runs):
+            telemetry.set_current_run(f"bench-{run}")
+            last_files = make_attachments(run)
+            try:
+                stages = run_pipeline(
+                    pipeline, server, last_files, not args.no_stream,
+                    use_cache=False, max_workers=pipeline.DEFAULT_SECTION_CONCURRENCY,
+                )
+            except Exception as e:
+                failures += 1
+                print(f"  run {run} failed: {e}", file=sys.stderr)
+                continue
+            for name, (seconds, sent) in stages.items():
+                stage_seconds.setdefault(name, []).append(seconds)
+                stage_bytes.setdefault(name, []).append(sent)
+            end_to_end.append(sum(seconds for seconds, _ in stages.values()))
+
+        cached = None
+        if last_files is not None:
+            telemetry.set_current_run("bench-cached")
+            try:
+                cached = run_pipeline(
+                    pipeline, server, last_files, not args.no_stream,
+                    use_cache=True, max_workers=pipeline.DEFAULT_SECTION_CONCURRENCY,
+                )
+            except Exception as e:
+                print(f"  cached run failed: {e}", file=sys.stderr)
+
+        print("Concurrency scaling...", file=sys.stderr)
+        baseline = None
+        for count in workers:
+            try:
+                _, seconds = timed(
+                    pipeline.generate_content_from_structure, STRUCTURE_FIXTURE,
+                    parallel=True, max_workers=count, use_cache=False,
+                )
+            except Exception as e:
+                failures += 1
+                print(f"  {count} worker(s) failed: {e}", file=sys.stderr)
+                continue
+            baseline = baseline or seconds
+            results["scaling"].append(
+                {"workers": count, "seconds": seconds, "speedup": baseline / seconds}
+            )
+
+        print("Local timings...", file=sys.stderr)
+        local = bench_local(pipeline, extraction, args.runs)
+    finally:
+        server.stop()
+
+    call_records = [
+        r for run in range(args.runs) for r in telemetry.run_records(f"bench-{run}")
+    ]
+    server_stats = server.stats()
+
+    stage_rows = []
+    for name, values in stage_seconds.items():
+        mean_bytes = sum(stage_bytes[name]) / len(stage_bytes[name])
+        hit = cached.get(name) if cached else None
+        results["stages"][name] = {
+            "p50_seconds": percentile(values, 50),
+            "p95_seconds": percentile(values, 95),
+            "mean_bytes_sent": mean_bytes,
+            "cached_seconds": hit[0] if hit else None,
+            "cached_bytes_sent": hit[1] if hit else None,
+        }
+        stage_rows.append([
+            name,
+            _fmt(percentile(values, 50)),
+            _fmt(percentile(values, 95)),
+            f"{mean_bytes / 1024:.1f}",
+            _fmt(hit[0] if hit else None, 4),
+        ])
+    results["end_to_end"] = {
+        "runs": len(end_to_end),
+        "failed_runs": failures,
+        "p50_seconds": percentile(end_to_end, 50),
+        "p95_seconds": percentile(end_to_end, 95),
+        "cached_seconds": sum(s for s, _ in cached.values()) if cached else None,
+        "model_calls": len(call_records),
+        "call_errors": sum(r["status"] == "error" for r in call_records),
+        "retries": sum(max(0, (r.get("attempts") or 1) - 1) for r in call_records),
+        "server": server_stats,
+    }
+    results["local_ms"] = {
+        name: {"p50": percentile(values, 50), "p95": percentile(values, 95), "samples": len(values)}
+        for name, values in local.items()
+    }
+
+    e2e = results["end_to_end"]
+    print()
+    print(format_table(
+        ["stage", "p50 s", "p95 s", "KiB sent", "cached s"],
+        stage_rows + [[
+            "end to end", _fmt(e2e["p50_seconds"]), _fmt(e2e["p95_seconds"]),
+            f"{sum(sum(v) / len(v) for v in stage_bytes.values()) / 1024:.1f}" if stage_bytes else "-",
+            _fmt(e2e["cached_seconds"], 4),
+        ]],
+    ))
+    print()
+    print(format_table(
+        ["section workers", "seconds", "speedup"],
+        [[s["workers"], _fmt(s["seconds"]), f"{s['speedup']:.2f}x"] for s in results["scaling"]],
+    ))
+    print()
+    print(format_table(
+        ["local step", "p50 ms", "p95 ms", "samples"],
+        [[name, _fmt(v["p50"]), _fmt(v["p95"]), v["samples"]] for name, v in results["local_ms"].items()],
+    ))
+    print()
+    print(
+        f"Runs: {e2e['runs']} ok, {failures} failed. Model calls: {e2e['model_calls']} "
+        f"({e2e['call_errors']} failed, {e2e['retries']} retries). Mock server: {server_stats['requests']} requests, "
+        f"{server_stats['errors']} injected errors, {server_stats['bytes_received'] / 1024:.0f} KiB received."
+    )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
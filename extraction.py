@@ -0,0 +1,556 @@
+import os
+import io
+import re
+import csv
+import datetime
+import hashlib
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Parsing runs in worker processes: PDF/XLSX parsers are pure Python, so
+# threads would not run them in parallel, and a separate process keeps a
+# slow file off the Streamlit script thread.
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", min(4, os.cpu_count() or 1)))
+EXTRACTION_TIMEOUT_SECONDS = float(os.environ.get("EXTRACTION_TIMEOUT_SECONDS", "60"))
+EXTRACTION_CACHE_ENTRIES = int(os.environ.get("EXTRACTION_CACHE_ENTRIES", "128"))
+
+# Image uploads are downscaled to IMAGE_MAX_SIDE pixels on the longest side
+# and re-encoded before they are base64-encoded for the vision model.
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "2048"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+# Images whose 256-bit difference hashes differ in at most this many bits
+# are treated as the same photo. Different pages of the same printed brief
+# typically differ in 70+ bits, a rescaled copy in under 10.
+IMAGE_DUPLICATE_DISTANCE = 10
+
+# Spreadsheets are summarized rather than dumped: per sheet, a schema with
+# per-column statistics and the first SHEET_SAMPLE_ROWS rows.
+SHEET_SAMPLE_ROWS = int(os.environ.get("SHEET_SAMPLE_ROWS", "20"))
+SHEET_MAX_COLUMNS = 60
+COLUMN_MAX_DISTINCT = 1000
+
+
+def extract_text(filename: str, data: bytes) -> str:
+    """
+    Best-effort text extraction from different file types.
+    """
+    name_lower = filename.lower()
+    ext = os.path.splitext(name_lower)[1]
+
+    try:
+        if ext == ".pdf":
+            from PyPDF2 import PdfReader
+            reader = PdfReader(io.BytesIO(data))
+            parts = []
+            for page in reader.pages:
+                text = page.extract_text() or ""
+                parts.append(text)
+            # Blank line between pages so long briefs can be chunked per page.
+            return "\n\n".join(parts).strip()
+
+        elif ext == ".docx":
+            from docx import Document
+            doc = Document(io.BytesIO(data))
+            parts = [para.text for para in doc.paragraphs]
+            return "\n".join(parts).strip()
+
+        elif ext == ".pptx":
+            from pptx import Presentation
+            prs = Presentation(io.BytesIO(data))
+            parts = []
+            for slide in prs.slides:
+                for shape in slide.shapes:
+                    if hasattr(shape, "text"):
+                        parts.append(shape.text)
+            return "\n".join(parts).strip()
+
+        elif ext in [".csv"]:
+            return profile_csv(filename, data)
+
+        elif ext in [".xlsx", ".xlx", ".xls"]:
+            return profile_workbook(filename, data)
+
+        elif ext == ".doc":
+            return (
+                "[.doc file detected. Automatic extraction is limited. "
+                "Please convert to .docx or PDF for better results.]"
+            )
+
+        else:
+            try:
+                return data.decode("utf-8", errors="ignore")
+            except Exception:
+                return (
+                    f"[Could not automatically extract text from {filename}. "
+                    f"Please provide instructions in the text box.]"
+                )
+
+    except ImportError as ie:
+        return (
+            f"[Missing Python library to parse {filename}: {ie}. "
+            "Install required libraries (PyPDF2, python-docx, python-pptx, pandas, openpyxl).]"
+        )
+    except Exception as e:
+        return f"[Error while reading {filename}: {e}]"
+
+
+# ---------- spreadsheets ----------
+
+_DATE_TEXT_RE = re.compile(r"^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?$|^\d{1,2}/\d{1,2}/\d{2,4}$")
+# "1.234" or "-12.345.678,9": '.' groups thousands.
+_DOT_THOUSANDS_RE = re.compile(r"^-?\d{1,3}(\.\d{3})+(,\d+)?$")
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return f"{value:,.4g}" if abs(value) < 1000 else f"{value:,.2f}"
+    return f"{int(value):,}"
+
+
+class _ColumnProfile:
+    """
+    Running statistics for one column, updated one cell at a time so the
+    sheet never has to be held in memory. With ``decimal_comma`` (CSV files
+    delimited by ';'), text numbers with a ',' or '.'-grouped thousands
+    ("1.234.567") use ',' as the decimal separator; others such as "1.5"
+    still read '.' as the decimal point.
+    """
+
+    def __init__(self, name, decimal_comma=False):
+        self.name = name
+        self.decimal_comma = decimal_comma
+        self.values = 0
+        self.empty = 0
+        self.numbers = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.dates = 0
+        self.first_date = None
+        self.last_date = None
+        self.booleans = 0
+        self.counts = Counter()
+        self.too_many_distinct = False
+
+    def add(self, value):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            self.empty += 1
+            return
+        self.values += 1
+
+        if isinstance(value, bool):
+            self.booleans += 1
+        elif isinstance(value, (int, float)):
+            self._add_number(value)
+        elif isinstance(value, (datetime.date, datetime.time)):
+            self._add_date(value.isoformat())
+        else:
+            text = str(value).strip()
+            number = None
+            try:
+                if self.decimal_comma and ("," in text or _DOT_THOUSANDS_RE.match(text)):
+                    number = float(text.replace(".", "").replace(",", "."))
+                else:
+                    number = float(text.replace(",", ""))
+            except ValueError:
+                pass
+            if number is not None and number == number:
+                self._add_number(number)
+            elif _DATE_TEXT_RE.match(text):
+                self._add_date(text)
+            elif text.lower() in ("true", "false", "yes", "no"):
+                self.booleans += 1
+            value = text
+
+        if not self.too_many_distinct:
+            self.counts[value] += 1
+            if len(self.counts) > COLUMN_MAX_DISTINCT:
+                self.too_many_distinct = True
+                self.counts = Counter(dict(self.counts.most_common(10)))
+
+    def _add_number(self, number):
+        self.numbers += 1
+        self.total += number
+        self.minimum = number if self.minimum is None else min(self.minimum, number)
+        self.maximum = number if self.maximum is None else max(self.maximum, number)
+
+    def _add_date(self, text):
+        self.dates += 1
+        self.first_date = text if self.first_date is None else min(self.first_date, text)
+        self.last_date = text if self.last_date is None else max(self.last_date, text)
+
+    def dtype(self):
+        if not self.values:
+            return "empty"
+        for kind, count in (("number", self.numbers), ("date", self.dates), ("boolean", self.booleans)):
+            if count >= 0.95 * self.values:
+                return kind
+        return "text"
+
+    def describe(self) -> str:
+        kind = self.dtype()
+        distinct = f"{COLUMN_MAX_DISTINCT:,}+" if self.too_many_distinct else f"{len(self.counts):,}"
+        parts = [f"{self.values:,} values", f"{self.empty:,} empty", f"{distinct} distinct"]
+        if kind == "number":
+            parts.append(
+                f"min {_format_number(self.minimum)}, max {_format_number(self.maximum)}, "
+                f"mean {_format_number(self.total / self.numbers)}"
+            )
+        elif kind == "date":
+            parts.append(f"from {self.first_date} to {self.last_date}")
+        elif kind in ("text", "boolean") and (
+            self.too_many_distinct or len(self.counts) == self.values > 1
+        ):
+            examples = ", ".join(str(v)[:40] for v in list(self.counts)[:5])
+            parts.append(f"e.g. {examples}")
+        elif kind in ("text", "boolean") and self.counts:
+            top = ", ".join(f"{str(v)[:40]} ({n:,})" for v, n in self.counts.most_common(5))
+            parts.append(f"top: {top}")
+        return f"- {self.name} ({kind}): " + "; ".join(parts)
+
+
+def _profile_rows(sheet_name, rows, decimal_comma=False) -> str:
+    """
+    Profile an iterable of row tuples whose first non-empty row is the header.
+    """
+    header = None
+    profiles = []
+    sample = []
+    data_rows = 0
+    extra_columns = 0
+
+    for row in rows:
+        row = list(row or [])
+        while row and (row[-1] is None or str(row[-1]).strip() == ""):
+            row.pop()
+        if not row:
+            continue
+        if header is None:
+            header = [
+                str(cell).strip() if cell not in (None, "") else f"Column {i + 1}"
+                for i, cell in enumerate(row)
+            ]
+            profiles = [_ColumnProfile(name, decimal_comma) for name in header[:SHEET_MAX_COLUMNS]]
+            continue
+
+        data_rows += 1
+        if len(row) > len(header):
+            extra_columns = max(extra_columns, len(row) - len(header))
+        for profile, value in zip(profiles, row):
+            profile.add(value)
+        for profile in profiles[len(row):]:
+            profile.add(None)
+        if len(sample) < SHEET_SAMPLE_ROWS:
+            sample.append(["" if cell is None else cell for cell in row[:SHEET_MAX_COLUMNS]])
+
+    if header is None:
+        return f"Sheet: {sheet_name} (empty)"
+
+    lines = [f"Sheet: {sheet_name} — {data_rows:,} data rows × {len(header):,} columns"]
+    if len(header) > SHEET_MAX_COLUMNS:
+        lines.append(f"(only the first {SHEET_MAX_COLUMNS} columns are profiled)")
+    if extra_columns:
+        lines.append(f"({extra_columns} unnamed trailing column(s) ignored)")
+    lines.append("Columns:")
+    lines.extend(profile.describe() for profile in profiles)
+
+    if sample:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(header[:SHEET_MAX_COLUMNS])
+        writer.writerows(sample)
+        shown = "all" if len(sample) == data_rows else f"first {len(sample)} of {data_rows:,}"
+        lines.append(f"Sample rows ({shown}):")
+        lines.append(buffer.getvalue().rstrip("\n"))
+    return "\n".join(lines)
+
+
+def profile_csv(filename, data) -> str:
+    """
+    Compact profile of a CSV file, read row by row.
+    """
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", errors="replace", newline="")
+    head = text.read(65536)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(head, delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    # ';' as the delimiter usually means ',' is the decimal separator.
+    return _profile_rows(filename, csv.reader(text, dialect), decimal_comma=dialect.delimiter == ";")
+
+
+def profile_workbook(filename, data) -> str:
+    """
+    Compact profile of every sheet in a workbook. .xlsx files are streamed
+    with openpyxl in read-only mode; legacy .xls files go through pandas.
+    """
+    try:
+        from openpyxl import load_workbook
+        workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    except ImportError:
+        raise
+    except Exception:
+        workbook = None
+
+    if workbook is not None:
+        try:
+            return "\n\n".join(
+                _profile_rows(sheet.title, sheet.iter_rows(values_only=True))
+                for sheet in workbook.worksheets
+            )
+        finally:
+            workbook.close()
+
+    import pandas as pd
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None)
+    return "\n\n".join(
+        _profile_rows(
+            name,
+            ([None if pd.isna(v) else v for v in row] for row in frame.itertuples(index=False)),
+        )
+        for name, frame in sheets.items()
+    )
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class _ExtractionCache:
+    """
+    Bounded LRU of extracted text keyed by (SHA-256 of the bytes, extension).
+    Lives at module level, so it is shared by every rerun and session in
+    the server process.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, text):
+        with self._lock:
+            self._items[key] = text
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+_cache = _ExtractionCache(EXTRACTION_CACHE_ENTRIES)
+_pool = None
+_pool_lock = threading.Lock()
+_pool_unavailable = False
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool_unavailable:
+            return None
+        if _pool is None:
+            # "spawn" avoids forking a multi-threaded server process.
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, EXTRACTION_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _disable_pool():
+    """
+    Worker processes cannot start or keep dying in this environment: stop
+    using them and parse on the calling thread from now on.
+    """
+    global _pool, _pool_unavailable
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_unavailable = True
+
+
+def _retire_pool(pool):
+    """
+    Terminate the workers of ``pool`` (some are stuck on a file that timed
+    out) and let the next caller start a fresh pool. Other callers still
+    waiting on ``pool`` see BrokenProcessPool and parse inline.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _is_current_pool(pool):
+    with _pool_lock:
+        return _pool is pool
+
+
+def extract_texts(files, timeout=EXTRACTION_TIMEOUT_SECONDS):
+    """
+    Extract text from several ``(filename, data)`` pairs at once.
+
+    Results come from the shared cache when the same bytes were seen before;
+    the rest are parsed in parallel in the worker pool, all within one
+    ``timeout`` in seconds for the batch. A file not done by then gets a
+    bracketed placeholder instead of blocking the others, and is not cached;
+    the pool is then replaced so its stuck workers do not hold up later
+    calls. Returns the texts in input order.
+    """
+    results = [None] * len(files)
+    futures = {}
+    for index, (filename, data) in enumerate(files):
+        key = (file_digest(data), os.path.splitext(filename.lower())[1])
+        cached = _cache.get(key)
+        if cached is not None:
+            results[index] = cached
+            continue
+        pool = _get_pool()
+        if pool is None:
+            results[index] = extract_text(filename, data)
+            _cache.put(key, results[index])
+        else:
+            futures[index] = (key, pool, pool.submit(extract_text, filename, data))
+
+    _, not_done = wait([future for _, _, future in futures.values()], timeout=timeout)
+    for pool in {pool for _, pool, future in futures.values() if future in not_done}:
+        _retire_pool(pool)
+
+    for index, (key, pool, future) in futures.items():
+        filename, data = files[index]
+        if future in not_done:
+            results[index] = (
+                f"[Timed out after {timeout:.0f}s while reading {filename}. "
+                "The file may be damaged; please paste the key instructions in the text box.]"
+            )
+            continue
+        try:
+            results[index] = future.result()
+        except (BrokenProcessPool, OSError):
+            # A pool retired after another caller's timeout is not a reason
+            # to give up on worker processes altogether.
+            if _is_current_pool(pool):
+                _disable_pool()
+            results[index] = extract_text(filename, data)
+        _cache.put(key, results[index])
+    return results
+
+
+def _difference_hash(image, size=16) -> int:
+    """
+    Perceptual hash (size*size bits): compare neighbouring pixels of a small
+    greyscale thumbnail. Re-encoded or rescaled copies hash (nearly) alike.
+    """
+    from PIL import Image
+
+    pixels = image.convert("L").resize((size + 1, size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _encode_image(image, image_format, quality):
+    from PIL import Image
+
+    if image_format == "JPEG" and image.mode != "RGB":
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def preprocess_images(images, max_side=IMAGE_MAX_SIDE, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """
+    Shrink ``(filename, data)`` image uploads before they are sent.
+
+    Each image is rotated per its EXIF orientation, downscaled so its longest
+    side is at most ``max_side`` and re-encoded as ``image_format`` (JPEG or
+    WEBP); the original bytes are kept when they are already smaller.
+    Byte-identical and perceptually near-identical images are dropped.
+
+    Returns a list of ``(mime type, data)`` pairs and a report dict with the
+    counts and the bytes before and after.
+    """
+    report = {
+        "images": len(images),
+        "duplicates": 0,
+        "bytes_before": sum(len(data) for _, data in images),
+        "bytes_after": 0,
+    }
+    prepared = []
+    seen_digests = set()
+    seen_hashes = []
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        Image = None
+
+    for filename, data in images:
+        digest = file_digest(data)
+        if digest in seen_digests:
+            report["duplicates"] += 1
+            continue
+        seen_digests.add(digest)
+
+        ext = os.path.splitext(filename.lower())[1]
+        original = ("image/png" if ext == ".png" else "image/jpeg", data)
+        if Image is None:
+            prepared.append(original)
+            continue
+
+        try:
+            with Image.open(io.BytesIO(data)) as opened:
+                image = ImageOps.exif_transpose(opened)
+                image.load()
+        except Exception:
+            prepared.append(original)
+            continue
+
+        image_hash = _difference_hash(image)
+        if any(bin(image_hash ^ h).count("1") <= IMAGE_DUPLICATE_DISTANCE for h in seen_hashes):
+            report["duplicates"] += 1
+            continue
+        seen_hashes.append(image_hash)
+
+        resized = max(image.size) > max_side
+        if resized:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        try:
+            encoded = _encode_image(image, image_format, quality)
+        except Exception:
+            prepared.append(original)
+            continue
+        if resized or len(encoded) < len(data):
+            prepared.append((f"image/{image_format.lower()}", encoded))
+        else:
+            prepared.append(original)
+
+    report["sent"] = len(prepared)
+    report["bytes_after"] = sum(len(data) for _, data in prepared)
+    return prepared, report
@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pipeline import (
+    ALLOWED_EXTENSIONS,
+    DEFAULT_SECTION_CONCURRENCY,
+    generate_job_summary,
+    generate_structure_from_summary,
+    generate_content_from_structure,
+    generate_references_from_content,
+    generate_references_from_index,
+    generate_final_document_with_citations,
+    reference_style_from_summary,
+    split_references,
+)
+import scheduler
+import telemetry
+
+# Stage checkpoints written to each job's output directory, in order.
+STAGE_FILES = [
+    ("summary", "01_summary.md"),
+    ("structure", "02_structure.md"),
+    ("content", "03_content.md"),
+    ("references", "04_references.md"),
+    ("final", "05_final.md"),
+]
+# Jobs run at the same time in a batch.
+DEFAULT_JOB_WORKERS = 2
+# In a job directory, these files hold the instructions and job options;
+# every other file with an allowed extension is an attachment.
+INSTRUCTION_FILES = ("instructions.txt", "instructions.md", "brief.txt")
+JOB_OPTIONS_FILE = "job.json"
+
+
+class LocalFile:
+    """
+    A file on disk with the interface of Streamlit's ``UploadedFile`` that
+    the pipeline uses (``name`` and ``getvalue()``).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def _job_id(text):
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", str(text)).strip("-") or "job"
+
+
+def load_jobs(path):
+    """
+    Jobs from a JSONL file (one object per line with ``instructions`` and
+    ``attachments``, optionally ``id`` and the options of ``run_job``) or
+    from a directory with one sub-directory per job (see INSTRUCTION_FILES
+    and JOB_OPTIONS_FILE). Relative attachment paths are resolved against
+    the JSONL file's directory. Returns a list of job dicts.
+    """
+    jobs = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            job_dir = os.path.join(path, name)
+            if not os.path.isdir(job_dir):
+                continue
+            job = {"id": name, "instructions": "", "attachments": []}
+            options_path = os.path.join(job_dir, JOB_OPTIONS_FILE)
+            if os.path.exists(options_path):
+                with open(options_path, encoding="utf-8") as f:
+                    job.update(json.load(f))
+            for filename in sorted(os.listdir(job_dir)):
+                file_path = os.path.join(job_dir, filename)
+                ext = os.path.splitext(filename.lower())[1].lstrip(".")
+                if filename in INSTRUCTION_FILES:
+                    with open(file_path, encoding="utf-8") as f:
+                        job["instructions"] = (job["instructions"] + "\n\n" + f.read()).strip()
+                elif ext in ALLOWED_EXTENSIONS:
+                    job["attachments"].append(file_path)
+            job["id"] = _job_id(job["id"])
+            jobs.append(job)
+        return jobs
+
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: not valid JSON ({e})")
+            job["id"] = _job_id(job.get("id") or f"job-{line_number:04d}")
+            job["instructions"] = job.get("instructions") or ""
+            job["attachments"] = [
+                p if os.path.isabs(p) else os.path.join(base, p)
+                for p in job.get("attachments") or []
+            ]
+            jobs.append(job)
+    return jobs
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def _write_checkpoint(path, text):
+    # Write then rename, so a crash never leaves a half-written checkpoint.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def run_job(
+    job,
+    out_dir,
+    parallel=True,
+    max_workers=DEFAULT_SECTION_CONCURRENCY,
+    compact_citations=False,
+    use_reference_index=False,
+    use_cache=True,
+    log=None,
+):
+    """
+    Run one job through all five agents, checkpointing each stage's output
+    to ``out_dir/<job id>/``. Stages whose checkpoint already exists are
+    loaded instead of re-run, so a job that failed part-way resumes where
+    it stopped. Options in the job dict (``reference_style``, ``parallel``,
+    ``compact_citations``, ``use_reference_index``) override the arguments.
+    With ``use_reference_index`` the references come from the local
+    reference index (see reference_index.py) instead of the model.
+
+    Returns a result dict: ``id``, ``status`` ("done" or "failed"), the
+    stages ``completed`` and ``resumed``, the ``error`` if any and the
+    path of the ``final`` document.
+    """
+    job_dir = os.path.join(out_dir, job["id"])
+    os.makedirs(job_dir, exist_ok=True)
+    parallel = job.get("parallel", parallel)
+    compact_citations = job.get("compact_citations", compact_citations)
+    use_reference_index = job.get("use_reference_index", use_reference_index)
+    result = {"id": job["id"], "status": "done", "completed": [], "resumed": [], "error": None}
+
+    telemetry.set_current_run(f"headless-{job['id']}")
+    scheduler.set_session(f"headless-{job['id']}", priority=scheduler.BATCH)
+
+    outputs = {}
+
+    def generate_references(content):
+        style = job.get("reference_style") or reference_style_from_summary(outputs["summary"])
+        generate = generate_references_from_index if use_reference_index else generate_references_from_content
+        return generate(content, style, len(content.split()), use_cache=use_cache)
+
+    def generate_final(content):
+        style = job.get("reference_style") or reference_style_from_summary(outputs["summary"])
+        reference_list, citation_list = split_references(outputs["references"])
+        return generate_final_document_with_citations(
+            content_text=content,
+            reference_list=reference_list,
+            citation_list=citation_list,
+            reference_style=style,
+            use_cache=use_cache,
+            compact=compact_citations,
+        )
+
+    steps = {
+        "summary": lambda: generate_job_summary(
+            job["instructions"],
+            [LocalFile(p) for p in job["attachments"]],
+            use_cache=use_cache,
+        ),
+        "structure": lambda: generate_structure_from_summary(outputs["summary"], use_cache=use_cache),
+        "content": lambda: generate_content_from_structure(
+            outputs["structure"], parallel=parallel, max_workers=max_workers, use_cache=use_cache
+        ),
+        "references": lambda: generate_references(outputs["content"]),
+        "final": lambda: generate_final(outputs["content"]),
+    }
+
+    for stage, filename in STAGE_FILES:
+        path = os.path.join(job_dir, filename)
+        text = _read_checkpoint(path)
+        if text is not None:
+            outputs[stage] = text
+            result["resumed"].append(stage)
+            continue
+        try:
+            text = steps[stage]()
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = f"{stage}: {e}"
+            _write_checkpoint(os.path.join(job_dir, "error.txt"), traceback.format_exc())
+            break
+        _write_checkpoint(path, text)
+        outputs[stage] = text
+        result["completed"].append(stage)
+        if log is not None:
+            log(f"[{job['id']}] {stage} done")
+
+    if result["status"] == "done":
+        error_path = os.path.join(job_dir, "error.txt")
+        if os.path.exists(error_path):
+            os.remove(error_path)
+    result["final"] = os.path.join(job_dir, STAGE_FILES[-1][1]) if result["status"] == "done" else None
+    return result
+
+
+def run_batch(jobs, out_dir, workers=DEFAULT_JOB_WORKERS, log=None, **options):
+    """
+    Run ``jobs`` with up to ``workers`` at a time (see ``run_job`` for
+    ``options``). A failing job does not stop the others. Returns the
+    results in job order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(run_job, job, out_dir, log=log, **options): job["id"]
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["id"]] = result
+            if log is not None:
+                status = result["status"] if not result["error"] else f"failed at {result['error']}"
+                log(f"[{result['id']}] {status}")
+    return [results[job["id"]] for job in jobs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the Summary → Structure → Content → References → Final pipeline "
+                    "without the UI. Re-running with the same --out resumes unfinished jobs."
+    )
+    parser.add_argument("jobs", nargs="?", help="JSONL file of jobs, or a directory of job folders")
+    parser.add_argument("--instructions", help="run a single job with these instructions")
+    parser.add_argument("--attach", action="append", default=[], help="attachment for the single job")
+    parser.add_argument("--id", default="job", help="id (output folder) of the single job")
+    parser.add_argument("--out", default="runs", help="output directory (default: runs)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_JOB_WORKERS, help="jobs run at once")
+    parser.add_argument("--sequential-sections", action="store_true",
+                        help="write the content in one call instead of section by section")
+    parser.add_argument("--section-workers", type=int, default=DEFAULT_SECTION_CONCURRENCY)
+    parser.add_argument("--compact-citations", action="store_true",
+                        help="place citations locally instead of re-writing the document")
+    parser.add_argument("--reference-index", action="store_true",
+                        help="take the references from the local reference index")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached responses")
+    args = parser.parse_args(argv)
+
+    if bool(args.jobs) == bool(args.instructions or args.attach):
+        parser.error("give either a jobs file/directory or --instructions/--attach")
+    if not os.environ.get("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY is not set")
+
+    if args.jobs:
+        jobs = load_jobs(args.jobs)
+    else:
+        jobs = [{
+            "id": _job_id(args.id),
+            "instructions": args.instructions or "",
+            "attachments": [os.path.abspath(p) for p in args.attach],
+        }]
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    results = run_batch(
+        jobs,
+        args.out,
+        workers=args.workers,
+        log=log,
+        parallel=not args.sequential_sections,
+        max_workers=args.section_workers,
+        compact_citations=args.compact_citations,
+        use_reference_index=args.reference_index,
+        use_cache=not args.no_cache,
+    )
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    return 0 if all(r["status"] == "done" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
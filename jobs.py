@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(".cache", "jobs.sqlite3"))
+# Jobs (across all sessions) that run at the same time.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+# Finished jobs are kept this long so a reconnecting session can collect them.
+JOB_RETENTION_HOURS = float(os.environ.get("JOB_RETENTION_HOURS", "24"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_key(kind, *parts):
+    """
+    Content address of a job: the kind and everything that determines its
+    output. Identical submissions share one job.
+    """
+    payload = json.dumps([kind, *parts], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobStore:
+    """
+    Job records in a local SQLite file: kind, input key, owning session,
+    status, result or error, and timestamps. Jobs still queued or running
+    when the store is opened belonged to a process that has gone away and
+    are marked failed.
+    """
+
+    def __init__(self, path=JOB_STORE_PATH, retention_hours=JOB_RETENTION_HOURS):
+        self.path = path
+        self.retention_seconds = retention_hours * 3600
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " input_key TEXT NOT NULL,"
+                " session_id TEXT,"
+                " status TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_input_key ON jobs (input_key)")
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE status IN (?, ?)",
+                (FAILED, "Interrupted by a server restart.", time.time(), *ACTIVE_STATUSES),
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, kind, input_key, session_id=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, input_key, session_id, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, input_key, session_id, QUEUED, now, now),
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE updated_at < ? AND status NOT IN (?, ?)",
+                (now - self.retention_seconds, *ACTIVE_STATUSES),
+            )
+        return job_id
+
+    def update(self, job_id, status, result=None, error=None):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, result, error, time.time(), job_id),
+            )
+
+    def get(self, job_id):
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def latest(self, input_key):
+        """
+        The most recent job for ``input_key`` that is active or done.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE input_key = ? AND status IN (?, ?, ?)"
+                " ORDER BY created_at DESC LIMIT 1",
+                (input_key, *ACTIVE_STATUSES, DONE),
+            ).fetchone()
+        return dict(row) if row else None
+
+
+class JobRunner:
+    """
+    Runs agent calls on an in-process worker pool so they outlive the
+    Streamlit script run that started them: a rerun, a closed tab or a new
+    session can look a job up by id and collect its result.
+
+    While a job runs its partial output is kept in memory for polling; the
+    final result or error is written to the job store.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._partial = {}
+        self._cancelled = set()
+
+    def submit(self, kind, input_key, fn, *args, session_id=None, reuse=True, **kwargs):
+        """
+        Run ``fn(*args, on_text=..., **kwargs)`` as a job and return its id.
+        If a job with the same ``input_key`` is already queued or running,
+        its id is returned instead; with ``reuse`` a finished one is too.
+        The job runs with the caller's telemetry run and scheduler session.
+        """
+        with self._lock:
+            existing = self.store.latest(input_key)
+            if existing and (existing["status"] in ACTIVE_STATUSES or reuse):
+                return existing["id"]
+            job_id = self.store.create(kind, input_key, session_id)
+            self._partial[job_id] = ""
+        self._pool.submit(telemetry.bind_context(self._run), job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        if job_id in self._cancelled:
+            self._finish(job_id, CANCELLED)
+            return
+        self.store.update(job_id, RUNNING)
+
+        def on_text(text):
+            if job_id in self._cancelled:
+                raise JobCancelled()
+            self._partial[job_id] = text
+
+        try:
+            result = fn(*args, on_text=on_text, **kwargs)
+        except JobCancelled:
+            self._finish(job_id, CANCELLED)
+        except Exception as e:
+            self._finish(job_id, CANCELLED if job_id in self._cancelled else FAILED, error=str(e))
+        else:
+            self._finish(job_id, DONE, result=result)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self.store.update(job_id, status, result=result, error=error)
+        with self._lock:
+            self._partial.pop(job_id, None)
+            self._cancelled.discard(job_id)
+
+    def get(self, job_id):
+        """
+        The job record with its current ``partial`` output, or None.
+        """
+        job = self.store.get(job_id)
+        if job is not None:
+            job["partial"] = self._partial.get(job_id, "")
+        return job
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop. Streaming calls stop at their next chunk, parallel
+        sections included, and queued sections never start; a call already
+        waiting on a full response finishes first and is discarded.
+        """
+        with self._lock:
+            if job_id in self._partial:
+                self._cancelled.add(job_id)
+
+
+@lru_cache(maxsize=None)
+def get_runner():
+    """
+    Process-wide job runner shared by all sessions.
+    """
+    return JobRunner(JobStore())
@@ -0,0 +1,241 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Words sent per streamed delta event. Real deltas are usually one token;
+# a few words per event keeps the mock cheap at high tokens-per-second.
+WORDS_PER_DELTA = 3
+
+_FILLER = (
+    "The evidence suggests that organisational outcomes depend on how the "
+    "framework is applied in practice and how consistently it is evaluated "
+    "against the stated objectives of the study."
+).split()
+
+
+def default_responder(body):
+    """
+    Canned output for a ``/v1/responses`` request body: a JSON object with
+    no citation insertions for structured (``json_schema``) requests,
+    otherwise a paragraph of filler text.
+    """
+    text_format = (body.get("text") or {}).get("format") or {}
+    if text_format.get("type") == "json_schema":
+        return json.dumps({"insertions": []})
+    return " ".join(_FILLER * 4)
+
+
+class MockResponsesServer:
+    """
+    Local stand-in for the OpenAI Responses API (``POST /v1/responses``),
+    for benchmarking the pipeline without network access or cost.
+
+    Each request waits ``latency`` seconds before the first byte and then
+    produces output at ``tokens_per_second`` (one word counts as a token),
+    streamed as server-sent events when the request asks for ``stream``.
+    A fraction ``error_rate`` of requests fail instead, alternating between
+    a 429 with ``Retry-After`` and a 500, drawn from a ``seed``-ed RNG.
+    ``responder(body)`` returns the output text for a parsed request body.
+
+    Use as a context manager, or call ``start()`` / ``stop()``; the client
+    base URL is ``base_url``.
+    """
+
+    def __init__(self, latency=0.2, tokens_per_second=200.0, error_rate=0.0, seed=0,
+                 responder=default_responder, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.responder = responder
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server._handle(self)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("content-length") or 0)
+        raw = handler.rfile.read(length)
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += len(raw)
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+                status = 429 if self.errors % 2 else 500
+
+        if handler.path.rstrip("/") != "/v1/responses":
+            self._send_json(handler, 404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            self._send_json(handler, 400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+            return
+
+        time.sleep(self.latency)
+        if fail:
+            message = "Rate limit reached (mock)" if status == 429 else "Internal server error (mock)"
+            headers = {"retry-after": "1"} if status == 429 else {}
+            self._send_json(handler, status, {"error": {"message": message, "type": "server_error"}}, headers)
+            return
+
+        text = self.responder(body)
+        words = text.split(" ")
+        response = self._response_object(body, text, input_tokens=len(raw) // 4, output_tokens=len(words))
+
+        if not body.get("stream"):
+            time.sleep(len(words) / self.tokens_per_second)
+            self._send_json(handler, 200, response)
+            return
+
+        handler.send_response(200)
+        handler.send_header("content-type", "text/event-stream")
+        handler.send_header("connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        sequence = 0
+        for start in range(0, len(words), WORDS_PER_DELTA):
+            chunk = " ".join(words[start:start + WORDS_PER_DELTA])
+            if start + WORDS_PER_DELTA < len(words):
+                chunk += " "
+            time.sleep(min(WORDS_PER_DELTA, len(words) - start) / self.tokens_per_second)
+            self._send_event(handler, {
+                "type": "response.output_text.delta",
+                "item_id": response["output"][0]["id"],
+                "output_index": 0,
+                "content_index": 0,
+                "delta": chunk,
+                "logprobs": [],
+                "sequence_number": sequence,
+            })
+            sequence += 1
+        self._send_event(handler, {"type": "response.completed", "response": response, "sequence_number": sequence})
+
+    def _response_object(self, body, text, input_tokens, output_tokens):
+        with self._lock:
+            number = self.requests
+        return {
+            "id": f"resp_mock_{number}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "mock"),
+            "status": "completed",
+            "output": [
+                {
+                    "type": "message",
+                    "id": f"msg_mock_{number}",
+                    "role": "assistant",
+                    "status": "completed",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}],
+                }
+            ],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+        }
+
+    def _send_json(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("content-type", "application/json")
+        handler.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+        with self._lock:
+            self.bytes_sent += len(data)
+
+    def _send_event(self, handler, event):
+        data = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+        handler.wfile.write(data)
+        handler.wfile.flush()
+        with self._lock:
+            self.bytes_sent += len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI Responses API for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first byte")
+    parser.add_argument("--tps", type=float, default=200.0, help="output tokens per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockResponsesServer(
+        latency=args.latency,
+        tokens_per_second=args.tps,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Mock Responses API on {server.base_url} (set OPENAI_BASE_URL to this)")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
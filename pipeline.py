@@ -0,0 +1,1609 @@
+import os
+import re
+import time
+import json
+import base64
+import hashlib
+import random
+import threading
+import email.utils
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
+import httpx
+import openai
+from openai import OpenAI, DefaultHttpxClient
+
+from extraction import extract_texts, preprocess_images
+from response_cache import ResponseCache, make_cache_key
+import reference_index
+import scheduler
+import telemetry
+
+# -------- Agent 1: Job Summary --------
+SUMMARY_PROMPT = """
+You are an AI assistant specialized in understanding writing tasks and producing a structured Job Summary, not the full content itself. Read the user’s instructions and any extracted text from attachments (e.g., PDFs, DOCX) to identify what needs to be written, including topic, word count or length, reference style (APA, MLA, Harvard, etc.), and writing style or document type (essay, report, PPT, proposal, article, dissertation, thesis, etc.). If a detail is not explicitly given but can be reasonably inferred, infer it; if it cannot be inferred confidently, mark it as “Not specified.” Always respond in this exact format: Topic: <short topic or title>; Word Count: <number of words or If word count is not mentioned in the Job card, then by default print "1500">; Reference Style: <style or If Reference Style is not mentioned in the Job card, then by default print "Harvard">; Writing Style: <type or "Report">; Job Summary: <10–20 sentences clearly describing what needs to be written, the main themes to cover, target audience or level if known, and any important constraints such as tone or structure>. Do not add extra sections, do not explain your reasoning, and do not write the actual assignment—only provide a clear, concise, implementation-ready Job Summary that another writer or AI could directly follow.
+"""
+
+# -------- Agent 1 (large briefs): condense one part of the attachments --------
+CONDENSE_PROMPT = """
+You are an AI assistant that condenses one part of a long assignment brief or module handbook so that a Job Summary can be written from the condensed notes of all parts. Keep every detail that could matter for the writing task: the task itself, topic or question, required word count or length, reference style, document type, deadlines, learning outcomes, marking or assessment criteria, required sections, themes to cover, audience, tone, formatting rules and any other explicit constraints. Quote numbers, percentages and requirements exactly. Drop content that is irrelevant to the writing task, such as generic university policies, contact details, timetables and repeated boilerplate. If the part contains nothing relevant to the writing task, reply with "No task-relevant details." Respond with concise bullet points only, without explanations.
+"""
+
+# -------- Agent 2: Structure with word breakdown --------
+STRUCTURE_PROMPT = """
+You are an AI assistant specialized in creating academic writing structures (detailed outlines) for writing tasks. Your input is always the full output of a Job Summary agent, which includes at least: Topic, Word Count, Reference Style, Writing Style, and Job Summary (and may also include extra instructions). Your job is to design a clear, logically ordered, academically appropriate structure with word counts for each section and subsection, so that another writer or AI could directly draft the final document. Strictly follow all instructions and requirements from the Job Summary and ensure that every key theme, focus area, or constraint is reflected in the structure. Use academic writing conventions that match the Writing Style (e.g., essays with introduction/body/conclusion; reports with sections such as introduction, methodology, analysis, conclusion; dissertations/thesis with chapters such as introduction, literature review, methodology, results, discussion, conclusion; PPTs as slide-based academic sections, etc.). Handle Word Count as follows: always use only word counts and never pages, lines, slides, or any other length unit; if a specific word count is given, treat it as the target total and allocate section word counts so they sum to approximately that total (with minor acceptable variation); if a range is given, internally pick a reasonable midpoint and allocate based on that; if the word count is described in pages or similar, internally convert to an approximate word count and output only word counts; if Word Count is “Not specified,” infer a reasonable total based on the Writing Style and academic context, then allocate accordingly. Respect the Reference Style by including a final “References” or “Bibliography” section with an appropriate word count whenever references are expected for that type of task. Ensure a coherent hierarchy with numbered sections and, where useful, subsections, each with a clear academic-style heading and an explicit word count (e.g., “Section Title – X words”). Begin by stating the title (using the Topic) and the total word count, then list the sections in order. Do not write any actual content of the sections, only the structure and word counts. Do not explain your reasoning, do not add extra metadata fields, and do not mention any unit other than words.sub points must shows the word counts in word breakdown and the sum of sub points word count must match with the main points total word count
+"""
+
+# -------- Agent 3: Content generation from structure --------
+CONTENT_PROMPT = """
+You are an AI assistant specialized in academic content writing. Your input is the full output of a Structure-Making Agent, which includes the title, total word count, and a numbered list of sections and subsections with individual word counts, all derived from a Job Summary. Your task is to transform this structure into complete, polished content that strictly follows all instructions, rules, and constraints implied by both the structure and the underlying task (topic, writing style, level, focus areas, tone, etc.). You must: (1) preserve the given headings and their order exactly as provided; (2) write cohesive, formal, academic prose under each section/subsection that clearly addresses the intent of its heading and the overall task; (3) follow the specified word counts closely for each section and subsection, aiming to be as close as reasonably possible to the target for each one and to the overall total; (4) maintain consistency in voice, tense, and perspective as implied by the task; and (5) ensure logical flow between sections with appropriate transitions and internal coherence. Must follow the exact word count that is mentioned, but sometimes you can provide 5% More or less in the contents as word counts. Do not modify or invent new sections, do not change the title, and do not contradict any explicit requirements from the task (such as focus, scope, or audience). When writing the content, do not include any reference list, bibliography, or citations of any kind (no in-text citations, no author-year, no numbers in brackets, and no “References” section), even if the structure or task mentions a reference style; treat that aspect as handled elsewhere. Do not explain your reasoning or describe your process; output only the final written content organized under the given headings.
+"""
+
+# -------- Agent 3 (parallel mode): one section at a time --------
+SECTION_CONTENT_PROMPT = """
+You are an AI assistant specialized in academic content writing, working as one of several writers who each draft a single section of the same document at the same time. Your input contains the document title, the full structure (for context only), and the one section you must write. Write only that section: begin with its heading exactly as given (without the word count), keep its subsections and their order, and follow its word counts closely (you can provide 5% more or less). Write cohesive, formal, academic prose that fits the title and the overall structure, so that your section reads consistently with the sections written by the other writers and leads naturally into the sections that follow it. Do not write any other section, do not repeat the document title, and do not introduce or conclude the whole document unless your section is the introduction or conclusion. Do not include any reference list, bibliography, or citations of any kind (no in-text citations, no author-year, no numbers in brackets). Do not explain your reasoning or describe your process; output only the written section.
+"""
+
+# -------- Agent 4: References + in-text citations list --------
+REFERENCES_PROMPT = """
+You are an AI assistant specialized in generating academic reference lists and corresponding in-text citation formats. Your input will be: (1) the full content produced by a content-creation agent, (2) the specified reference style (e.g., APA, MLA, Chicago, Harvard, IEEE, etc.), and (3) the approximate total word count of the content. Your task is to create an original, topic-related reference list that strictly follows the given reference style and is based on the themes, concepts, and topics present in the content. All references you provide must be to real, credible, and verifiable sources published after 2021 (i.e., from 2022 onwards). For every 1000 words of content, generate approximately 7 references (rounding reasonably to the nearest whole number) and ensure that all references are directly relevant to the subject matter of the content. Present the references as a properly formatted “Reference List” ordered alphabetically (A–Z) by the first author’s surname, strictly conforming to the rules of the specified reference style. After the alphabetical reference list, provide a separate “Citation List” that contains the in-text citation format for each reference above (e.g., for Harvard and APA: Author, Year; for MLA: Author page; for IEEE: [number], etc.), covering all references already listed. In-text Citation rules: For Harvard, APA, APA7,  IEEE Referencing (If one, two, or three authors are present in the Reference, then use the Surname of Each Author first, then a comma, and then the year in a Single bracket). Like example: ‘Hermes, A. and Riedl, R., 2021, July. Dimensions of retail customer experience and its outcomes: a literature review and directions for future research. If you notice here, two authors are present, so the in-text citation will be “(Hermes and Riedl, 2021)”. If 4 or more authors are present, then use the first author's surname, then et al., then a comma, and then the year. For example: “Pappas, A., Fumagalli, E., Rouziou, M. and Bolander, W., 2023. More than machines: The role of the future retail salesperson in enhancing the customer experience. Journal of Retailing, 99(4), pp.518-531.”. If you notice here 4 authors are present, so the intext citation will be (Pappas et al. 2023). In IEEE, all are the same but in Number Format like [1], [2], etc. Do not include any explanation, analysis, or extra text beyond the reference list and the citation list. Do not rewrite or summarize the original content. Your entire output must consist only of the formatted reference list followed by the citation list.
+"""
+
+# -------- Agent 4 (reference index): format retrieved sources only --------
+REFERENCE_FORMAT_PROMPT = """
+You are an AI assistant specialized in formatting academic reference lists and in-text citations. Your input contains the reference style and a list of sources retrieved from a bibliographic database, one JSON record per line. Format exactly these sources and nothing else: do not add, drop, merge or invent sources, and do not change any author, title, year, venue, volume, issue, page or DOI; leave out details a record does not have. Present the references as a properly formatted "Reference List" that strictly conforms to the rules of the specified reference style (alphabetically A–Z by the first author's surname, or numbered in the given order for numeric styles such as IEEE). After the reference list, provide a separate "Citation List" with the in-text citation for each reference above, one per line. In-text Citation rules: for Harvard, APA and APA7, with one, two or three authors use the surname of each author, then a comma and the year in a single bracket, e.g. "(Hermes and Riedl, 2021)"; with four or more authors use the first author's surname followed by "et al.", a comma and the year, e.g. "(Pappas et al., 2023)"; in IEEE use the number, e.g. [1]. Do not include any explanation, analysis, or extra text. Your entire output must consist only of the formatted reference list followed by the citation list.
+"""
+
+# -------- Agent 5: Final document with citations inserted --------
+FINALIZE_PROMPT = """
+You are an AI assistant specialized in finalizing academic documents by inserting in-text citations and appending an existing reference list. Your inputs are: (1) a complete piece of content with no citations or reference list, (2) a formatted reference list, (3) a citation list that specifies the correct in-text citation format for each reference, and (4) the reference style to follow (e.g., APA, MLA, Chicago, Harvard, IEEE, etc.). Your task is to cite all existing references from the citation list within the content and then append the full reference list at the end of the document, strictly following the given reference style. You must not rewrite, expand, shorten, reorder, or otherwise change any of the existing content, headings, or wording; you may only insert in-text citations at appropriate locations and add the reference list at the end. Don't cite in the Introduction, Conclusion parts, and if available, Abstract and Executive summary; in those parts, don't add in-text citations. Do not add new references, do not remove any existing references, and do not invent sources. Ensure that every reference from the provided reference list is cited at least once in the body using the corresponding in-text format from the citation list, and that all in-text citations match entries in the reference list. Maintain the original structure and formatting of the content as much as possible, only adding the necessary citation markers and the final reference list section. As output, return the full content with the in-text citations properly inserted and the complete reference list appended at the end, and do not include any explanations, notes, or extra commentary.
+
+"""
+
+# -------- Agent 5 (compact mode): citation positions only --------
+CITATION_PLACEMENT_PROMPT = """
+You are an AI assistant specialized in placing in-text citations in academic documents. Your input contains the reference style, a numbered citation list (ids such as C1, C2, each followed by its in-text citation and the matching reference), and the body of a document in which every sentence that may receive a citation is prefixed with an id such as [S4.2]. Headings are shown for context only. Decide where each citation belongs: choose the sentences whose claims are best supported by each reference, cite every citation id at least once, spread citations sensibly across the document, and do not cite the same sentence more than twice. Return only the list of insertions, each with the sentence id (without brackets, e.g. S4.2) and the citation id (e.g. C3). Do not rewrite, summarize, or repeat any of the document text, and do not invent sentence ids or citation ids.
+"""
+
+ALLOWED_EXTENSIONS = [
+    "doc", "docx", "pdf",
+    "png", "jpg", "jpeg",
+    "pptx", "csv", "xlsx", "xlx",
+]
+
+# Agent 1 input budget. Briefs estimated above SUMMARY_TOKEN_BUDGET are
+# split into SUMMARY_CHUNK_TOKENS parts that are condensed in parallel first.
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "60000"))
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("SUMMARY_CHUNK_TOKENS", "12000"))
+SUMMARY_CONDENSE_CONCURRENCY = 4
+
+# Upper bound on simultaneous section requests in parallel content mode.
+DEFAULT_SECTION_CONCURRENCY = 4
+
+# Minimum delay between live UI refreshes while a response is streaming.
+STREAM_REFRESH_SECONDS = 0.1
+
+# Background threads for speculative next-stage calls (across all sessions).
+SPECULATION_WORKERS = int(os.environ.get("SPECULATION_WORKERS", "4"))
+
+# Local response cache (see response_cache.py); override via environment.
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(".cache", "responses.sqlite3"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("RESPONSE_CACHE_MAX_MB", "200"))
+RESPONSE_CACHE_TTL_HOURS = float(os.environ.get("RESPONSE_CACHE_TTL_HOURS", "72"))
+
+# Connection pool of the shared OpenAI client. Idle keep-alive connections
+# are reused by later calls, reruns and sessions instead of new TLS handshakes.
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_KEEPALIVE_CONNECTIONS", "16"))
+OPENAI_KEEPALIVE_SECONDS = 120.0
+OPENAI_CONNECT_TIMEOUT = 10.0
+
+# Read timeout per agent stage, in seconds: the longest wait for the next
+# byte of a streamed response, or for the whole answer without streaming.
+AGENT_TIMEOUTS = {
+    "summary": 120.0,
+    "summary.condense": 90.0,
+    "structure": 120.0,
+    "content": 600.0,
+    "content.section": 300.0,
+    "references": 180.0,
+    "final": 600.0,
+    "final.placement": 180.0,
+}
+DEFAULT_AGENT_TIMEOUT = 300.0
+
+# Retries of transient failures (429, 5xx, timeouts, dropped connections)
+# with exponential backoff and full jitter. A Retry-After from the server is
+# honoured; if it asks for more than RETRY_MAX_DELAY seconds the error is
+# raised instead of blocking the step.
+RETRY_ATTEMPTS = int(os.environ.get("OPENAI_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Tokens reserved with the scheduler for a call's output (and per attached
+# image) before its real usage is known.
+OUTPUT_TOKEN_RESERVE = 2000
+IMAGE_TOKEN_RESERVE = 1000
+
+# ---------- helper: text extraction ----------
+
+def extract_text_from_upload(uploaded_file) -> str:
+    """
+    Best-effort text extraction from different file types.
+    """
+    return extract_texts([(uploaded_file.name, uploaded_file.getvalue())])[0]
+
+
+# ---------- helper: structure parsing ----------
+
+# Top-level numbered headings such as "1. Introduction – 300 words",
+# "## 2) Literature Review (900 words)" or "Chapter 3: Methodology".
+# Subsection numbers like "1.1" are deliberately not matched.
+_SECTION_HEADING_RE = re.compile(
+    r"^\s*(?:#{1,6}\s*)?(?:\*\*|__)?\s*(?:(?:chapter|section|part)\s+)?"
+    r"(\d{1,2})(?!\d|\.\d)(?:[.):]|\s+[-–—:])?\s+(\S.*?)\s*$",
+    re.IGNORECASE,
+)
+_WORD_COUNT_RE = re.compile(r"(\d[\d,]*)\s*words?\b", re.IGNORECASE)
+_HEADING_WORD_COUNT_RE = re.compile(
+    r"[\s:–—-]*[(\[]?\s*(?:approx\.?|approximately|~)?\s*\d[\d,]*\s*words?\s*[)\]]?\s*$",
+    re.IGNORECASE,
+)
+_REFERENCE_HEADING_RE = re.compile(
+    r"^(?:references?|reference list|bibliography|works cited)\b", re.IGNORECASE
+)
+
+
+def _clean_heading(line: str) -> str:
+    """
+    Strip markdown markers and the trailing word count from a heading line.
+    """
+    heading = line.strip().lstrip("#").strip()
+    heading = heading.replace("**", "").replace("__", "").strip()
+    return _HEADING_WORD_COUNT_RE.sub("", heading).strip()
+
+
+def parse_structure_sections(structure_text):
+    """
+    Split an Agent 2 structure into its preamble (title, total word count)
+    and its top-level numbered sections, in order. Each section is a dict
+    with the section number, cleaned heading, title, word count (None when
+    not stated) and the raw block text including its subsections.
+    """
+    preamble_lines = []
+    sections = []
+
+    for line in (structure_text or "").splitlines():
+        match = _SECTION_HEADING_RE.match(line)
+        if match:
+            counts = _WORD_COUNT_RE.findall(line)
+            sections.append(
+                {
+                    "number": match.group(1),
+                    "heading": _clean_heading(line),
+                    "title": _clean_heading(match.group(2)),
+                    "words": int(counts[0].replace(",", "")) if counts else None,
+                    "lines": [line],
+                }
+            )
+        elif sections:
+            sections[-1]["lines"].append(line)
+        else:
+            preamble_lines.append(line)
+
+    for section in sections:
+        section["text"] = "\n".join(section.pop("lines")).strip()
+        if section["words"] is None:
+            sub_counts = _WORD_COUNT_RE.findall(section["text"])
+            if sub_counts:
+                section["words"] = sum(int(c.replace(",", "")) for c in sub_counts)
+
+    return "\n".join(preamble_lines).strip(), sections
+
+
+def _structure_title(preamble: str) -> str:
+    """
+    Best-effort document title from the structure preamble.
+    """
+    for line in preamble.splitlines():
+        cleaned = line.strip().lstrip("#").replace("**", "").strip()
+        if not cleaned or "word count" in cleaned.lower():
+            continue
+        if cleaned.lower().startswith("title:"):
+            cleaned = cleaned[len("title:"):].strip()
+        return cleaned
+    return ""
+
+
+# ---------- helper: model calls ----------
+
+def _stream_error_message(event) -> str:
+    error = getattr(event, "error", None) or getattr(
+        getattr(event, "response", None), "error", None
+    )
+    message = getattr(error, "message", None) or getattr(event, "message", None)
+    return message or f"Streaming failed ({event.type})."
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Process-wide OpenAI client on one pooled, keep-alive HTTP connection
+    pool. The API key (and optionally OPENAI_BASE_URL) are read from the
+    environment on first use. The SDK's own retries are off because
+    ``_run_agent`` retries with its own policy.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            timeout = httpx.Timeout(DEFAULT_AGENT_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            _client = OpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                timeout=timeout,
+                max_retries=0,
+                http_client=DefaultHttpxClient(
+                    timeout=timeout,
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+                    ),
+                ),
+            )
+        return _client
+
+
+def agent_timeout(stage):
+    return httpx.Timeout(
+        AGENT_TIMEOUTS.get(stage, DEFAULT_AGENT_TIMEOUT), connect=OPENAI_CONNECT_TIMEOUT
+    )
+
+
+def _retry_after_seconds(error):
+    """
+    Server-requested wait from ``retry-after-ms`` / ``Retry-After``
+    (seconds or an HTTP date), or None.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying after ``error`` on the given attempt
+    (0-based), or None if the call should not be retried.
+    """
+    if attempt + 1 >= RETRY_ATTEMPTS:
+        return None
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota will not recover by waiting.
+        if getattr(error, "code", None) == "insufficient_quota":
+            return None
+    elif isinstance(error, openai.APIStatusError):
+        if error.status_code not in (408, 409) and error.status_code < 500:
+            return None
+    elif not isinstance(error, openai.APIConnectionError):
+        return None
+
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        if retry_after > RETRY_MAX_DELAY:
+            return None
+        return retry_after + random.uniform(0, RETRY_BASE_DELAY / 4)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+@lru_cache(maxsize=None)
+def get_response_cache():
+    """
+    Process-wide response cache shared by all sessions.
+    """
+    return ResponseCache(
+        RESPONSE_CACHE_PATH,
+        max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+        ttl_seconds=RESPONSE_CACHE_TTL_HOURS * 3600,
+    )
+
+
+def _run_agent(
+    instructions, messages, model, on_text=None, use_cache=True, stage="agent", **params
+):
+    """
+    Single entry point for agent model calls. Without ``on_text`` this is a
+    plain ``responses.create``. With it the response is streamed and
+    ``on_text`` is called with the accumulated text as output arrives
+    (throttled to STREAM_REFRESH_SECONDS, plus once at the end).
+    Returns the full output text either way.
+
+    Identical calls are answered from the response cache. ``use_cache=False``
+    skips the lookup (a "regenerate") but still stores the fresh result.
+    Extra ``params`` (e.g. a structured ``text`` format) are passed through
+    to ``responses.create``.
+
+    Transient API errors are retried (see ``_retry_delay``) and each attempt
+    gets the read timeout of its ``stage`` from AGENT_TIMEOUTS. A retry of a
+    streamed call starts the output over, so ``on_text`` shows the new
+    attempt from the beginning.
+
+    Each attempt first waits its turn in the shared ``scheduler`` under the
+    model's rate limits; a 429 pauses the model for every session.
+
+    Every call, cached or not, is recorded by ``telemetry`` under ``stage``
+    and the current pipeline run, with the number of attempts it took and
+    the time spent queued.
+    """
+    call_timer = telemetry.CallTimer()
+    cache = get_response_cache()
+    cache_key = make_cache_key(instructions, model, messages, **params)
+    if use_cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if on_text is not None:
+                on_text(cached)
+            telemetry.record_call(
+                stage, model, call_timer.started_at, call_timer.elapsed(), cache_hit=True,
+                attempts=0, queued_seconds=0.0,
+            )
+            return cached
+
+    timeout = agent_timeout(stage)
+    gate = scheduler.get_scheduler()
+    reserved_tokens = _estimate_request_tokens(instructions, messages)
+    queued_seconds = 0.0
+    attempt = 0
+    while True:
+        queue_start = time.perf_counter()
+        gate.acquire(model, reserved_tokens)
+        queued_seconds += time.perf_counter() - queue_start
+        try:
+            text, usage = _call_model(
+                instructions, messages, model, on_text, call_timer, timeout=timeout, **params
+            )
+            break
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if isinstance(e, openai.RateLimitError):
+                # Hold back every session, not just this call.
+                gate.pause(model, delay if delay is not None else RETRY_BASE_DELAY)
+            if delay is None:
+                telemetry.record_call(
+                    stage,
+                    model,
+                    call_timer.started_at,
+                    call_timer.elapsed(),
+                    ttft_seconds=call_timer.ttft,
+                    streamed=on_text is not None,
+                    error=e,
+                    attempts=attempt + 1,
+                    queued_seconds=round(queued_seconds, 4),
+                )
+                raise
+            attempt += 1
+            call_timer.ttft = None
+            time.sleep(delay)
+    tokens = telemetry.usage_fields(usage)
+    if tokens["input_tokens"] is not None and tokens["output_tokens"] is not None:
+        gate.settle(model, reserved_tokens, tokens["input_tokens"] + tokens["output_tokens"])
+    telemetry.record_call(
+        stage,
+        model,
+        call_timer.started_at,
+        call_timer.elapsed(),
+        ttft_seconds=call_timer.ttft,
+        usage=usage,
+        streamed=on_text is not None,
+        attempts=attempt + 1,
+        queued_seconds=round(queued_seconds, 4),
+    )
+    cache.put(cache_key, text)
+    return text
+
+
+def _estimate_request_tokens(instructions, messages):
+    tokens = estimate_tokens(instructions) + OUTPUT_TOKEN_RESERVE
+    for message in messages:
+        for item in message.get("content", []):
+            if item.get("type") == "input_text":
+                tokens += estimate_tokens(item.get("text", ""))
+            elif item.get("type") == "input_image":
+                tokens += IMAGE_TOKEN_RESERVE
+    return tokens
+
+
+def _call_model(
+    instructions, messages, model, on_text, call_timer, timeout=openai.NOT_GIVEN, **params
+):
+    """
+    Returns the output text and the response ``usage``.
+    """
+    if on_text is None:
+        response = get_client().responses.create(
+            model=model,
+            instructions=instructions,
+            input=messages,
+            timeout=timeout,
+            **params,
+        )
+        return response.output_text, response.usage
+
+    parts = []
+    usage = None
+    last_refresh = 0.0
+    with get_client().responses.create(
+        model=model,
+        instructions=instructions,
+        input=messages,
+        stream=True,
+        timeout=timeout,
+        **params,
+    ) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                call_timer.mark_first_token()
+                parts.append(event.delta)
+                now = time.monotonic()
+                if now - last_refresh >= STREAM_REFRESH_SECONDS:
+                    last_refresh = now
+                    on_text("".join(parts))
+            elif event.type == "response.completed":
+                usage = event.response.usage
+            elif event.type in ("response.failed", "error"):
+                raise RuntimeError(_stream_error_message(event))
+
+    text = "".join(parts)
+    on_text(text)
+    return text, usage
+
+
+# ---------- helper: citation placement ----------
+
+CITATION_PLACEMENT_FORMAT = {
+    "type": "json_schema",
+    "name": "citation_insertions",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "insertions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "sentence": {"type": "string"},
+                        "citation": {"type": "string"},
+                    },
+                    "required": ["sentence", "citation"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["insertions"],
+        "additionalProperties": False,
+    },
+}
+
+# Sections that must never receive in-text citations.
+_NO_CITATION_HEADING_RE = re.compile(
+    r"^(?:introduction|conclusions?|concluding remarks|abstract|executive summary)\b",
+    re.IGNORECASE,
+)
+_NUMBERED_HEADING_RE = re.compile(
+    r"^(?:(?:chapter|section|part)\s+)?(\d{1,2}(?:\.\d+)*)[.):]?\s+(\S.*)$",
+    re.IGNORECASE,
+)
+_CITATION_TOKEN_RE = re.compile(r"\([^()]*\d{4}[a-z]?[^()]*\)|\[\d+(?:[,–-]\s*\d+)*\]")
+_NAME_ONLY_CITATION_RE = re.compile(r"\([^()]*[^\W\d][^()]*\)")
+_LIST_MARKER_RE = re.compile(r"^\s*(?:[-*•]|\d{1,3}[.)])\s+")
+_BULLET_RE = re.compile(r"^\s*[-*•+]\s+")
+# A sentence ends at ., ! or ? (plus closing quotes/brackets) followed by
+# whitespace and something that can start a new sentence.
+_SENTENCE_END_RE = re.compile(r"[.!?][\"”’)\]]*(?=\s+[\"“‘(\[]?[A-Z0-9])")
+_TRAILING_PUNCT_RE = re.compile(r"([.!?][\"”’)\]]*)?(\s*)$")
+_ABBREVIATIONS = {"e.g", "i.e", "etc", "al", "vs", "cf", "dr", "mr", "mrs", "ms", "prof", "fig", "no"}
+
+
+def _heading_parts(line):
+    """
+    Return (level, title) when a content line looks like a heading, else None.
+    Numbered headings take their level from the numbering depth, markdown
+    headings from the number of leading '#'. Bulleted lines are list items,
+    never headings.
+    """
+    stripped = line.strip()
+    if not stripped or _BULLET_RE.match(stripped):
+        return None
+
+    hashes = len(stripped) - len(stripped.lstrip("#"))
+    bold = stripped.startswith("**") and stripped.endswith("**") and len(stripped) > 4
+    text = stripped.lstrip("#").replace("**", "").strip()
+    if not text:
+        return None
+
+    numbered = _NUMBERED_HEADING_RE.match(text)
+    short = len(text.split()) <= 15 and not text.endswith((".", "!", "?", ";", ","))
+    if numbered and short:
+        return len(numbered.group(1).split(".")), _clean_heading(numbered.group(2))
+    if hashes:
+        return hashes, _clean_heading(text)
+    if bold or (short and len(text.split()) <= 12 and not text.endswith(":")):
+        return 1, _clean_heading(text)
+    return None
+
+
+def _section_number(line):
+    """
+    Numbering of a numbered line as a tuple of ints ("2.1 Scope" -> (2, 1)),
+    else None.
+    """
+    text = line.strip().lstrip("#").replace("**", "").strip()
+    numbered = _NUMBERED_HEADING_RE.match(text)
+    return tuple(int(n) for n in numbered.group(1).split(".")) if numbered else None
+
+
+def _ends_section(lines, index, excluded_number=None, in_list=False):
+    """
+    Whether the heading-like line at ``index`` is a real section heading:
+    marked up with '#' or bold, standing alone between blank lines, or
+    numbered as a later structure section than ``excluded_number`` (the
+    section being ended) without continuing a numbered list. Short body
+    lines and numbered list items run into their neighbours.
+    """
+    stripped = lines[index].strip()
+    if stripped.startswith("#") or (stripped.startswith("**") and stripped.endswith("**")):
+        return True
+    number = _section_number(lines[index])
+    if number and excluded_number and not in_list and number > excluded_number[:len(number)]:
+        return True
+    before = lines[index - 1].strip() if index > 0 else ""
+    after = lines[index + 1].strip() if index + 1 < len(lines) else ""
+    return not before and not after
+
+
+def _classify_content_lines(content_text):
+    """
+    Split content into lines and mark each as a heading, a citable body
+    paragraph, or a non-citable line (blank, or inside an Introduction,
+    Conclusion, Abstract or Executive Summary section). Only a real heading
+    (see ``_ends_section``) ends one of those sections; list items and short
+    body lines inside them stay non-citable.
+    """
+    lines = []
+    excluded_level = None
+    excluded_number = None
+    in_list = False
+    raw_lines = (content_text or "").split("\n")
+    for index, line in enumerate(raw_lines):
+        heading = _heading_parts(line)
+        if heading and excluded_level is not None and not _ends_section(
+            raw_lines, index, excluded_number, in_list
+        ):
+            heading = None
+        if heading:
+            level, title = heading
+            if excluded_level is None or level <= excluded_level:
+                excluded = _NO_CITATION_HEADING_RE.match(title)
+                excluded_level = level if excluded else None
+                excluded_number = _section_number(line) if excluded else None
+            lines.append({"text": line, "heading": True, "citable": False})
+        else:
+            lines.append(
+                {"text": line, "heading": False, "citable": bool(line.strip()) and excluded_level is None}
+            )
+        if line.strip():
+            in_list = not heading and (
+                _section_number(line) is not None or _LIST_MARKER_RE.match(line) is not None
+            )
+    return lines
+
+
+def _sentence_ends(paragraph):
+    """
+    Offsets just past the final punctuation of each sentence in a paragraph.
+    """
+    ends = []
+    for m in _SENTENCE_END_RE.finditer(paragraph):
+        preceding = paragraph[:m.start()].split()
+        if preceding and preceding[-1].lower().rstrip(".") in _ABBREVIATIONS:
+            continue
+        ends.append(m.end())
+    last = _TRAILING_PUNCT_RE.search(paragraph).start(2)
+    if not ends or ends[-1] < last:
+        ends.append(last)
+    return ends
+
+
+def parse_citation_list(citation_list):
+    """
+    Extract the in-text citations from Agent 4's Citation List, one per line,
+    dropping the heading, bullets and duplicates. Author-date and numeric
+    citations may sit inside other text; name-only ones (MLA) must be the
+    whole line, as in "(Khan)".
+    """
+    citations = []
+    for line in (citation_list or "").splitlines():
+        text = line.strip().strip("#").replace("**", "").strip()
+        if not text or re.match(r"^(?:in-text\s+)?citation list\b:?", text, re.IGNORECASE):
+            continue
+        if not re.match(r"^\[\d+\]", text):
+            text = _LIST_MARKER_RE.sub("", text)
+        tokens = _CITATION_TOKEN_RE.findall(text)
+        if tokens:
+            citation = tokens[-1].strip()
+        elif re.search(r"\b\d{4}[a-z]?\b", text):
+            citation = f"({text.strip('()')})"
+        elif _NAME_ONLY_CITATION_RE.fullmatch(text):
+            citation = text
+        else:
+            continue
+        if citation not in citations:
+            citations.append(citation)
+    return citations
+
+
+def _join_citations(citations):
+    if all(c.startswith("(") and c.endswith(")") for c in citations):
+        return "(" + "; ".join(c[1:-1].strip() for c in citations) + ")"
+    return ", ".join(citations)
+
+
+def _append_reference_list(document_text, reference_list):
+    references = (reference_list or "").strip()
+    if not references:
+        return document_text
+    first_line = references.splitlines()[0].strip().strip("#").replace("**", "").strip()
+    if not _REFERENCE_HEADING_RE.match(first_line):
+        references = "References\n\n" + references
+    return document_text.rstrip() + "\n\n" + references + "\n"
+
+
+def apply_citation_insertions(content_text, citations, insertions, reference_list):
+    """
+    Insert citations into ``content_text`` without touching any other text.
+
+    ``insertions`` are (sentence id, citation index) pairs such as
+    ("S4.2", 0); ids that do not exist or point into a non-citable section
+    are ignored. Any citation the model left unused is then placed locally
+    on the least-cited body paragraph, so every reference is cited at least
+    once. The reference list is appended at the end. Raises ValueError when
+    there are citations but no body paragraph that may carry them.
+    """
+    lines = _classify_content_lines(content_text)
+    citable = [i for i, line in enumerate(lines) if line["citable"]]
+    if citations and not citable:
+        raise ValueError(
+            "No body paragraph outside the Introduction, Conclusion and summaries was found "
+            "to place citations in. Check that the content's section headings are on their own lines."
+        )
+    placed = {}  # (line index, sentence index) -> [citation indexes]
+
+    for sentence_id, citation_index in insertions:
+        match = re.fullmatch(r"S?(\d+)\.(\d+)", str(sentence_id).strip().strip("[]"))
+        if not match or not 0 <= citation_index < len(citations):
+            continue
+        line_index, sentence_index = int(match.group(1)), int(match.group(2)) - 1
+        if line_index >= len(lines) or not lines[line_index]["citable"]:
+            continue
+        if not 0 <= sentence_index < len(_sentence_ends(lines[line_index]["text"])):
+            continue
+        cited = placed.setdefault((line_index, sentence_index), [])
+        if citation_index not in cited:
+            cited.append(citation_index)
+
+    used = {c for cited in placed.values() for c in cited}
+    if citable:
+        per_line = {i: 0 for i in citable}
+        for (line_index, _), cited in placed.items():
+            per_line[line_index] += len(cited)
+        for citation_index in range(len(citations)):
+            if citation_index in used:
+                continue
+            line_index = min(citable, key=lambda i: (per_line[i], i))
+            last_sentence = len(_sentence_ends(lines[line_index]["text"])) - 1
+            placed.setdefault((line_index, last_sentence), []).append(citation_index)
+            per_line[line_index] += 1
+
+    by_line = {}
+    for (line_index, sentence_index), cited in placed.items():
+        by_line.setdefault(line_index, []).append((sentence_index, cited))
+
+    for line_index, targets in by_line.items():
+        text = lines[line_index]["text"]
+        ends = _sentence_ends(text)
+        # Insert from the end so earlier offsets stay valid.
+        for sentence_index, cited in sorted(targets, reverse=True):
+            end = ends[sentence_index]
+            sentence = text[:end]
+            punct = _TRAILING_PUNCT_RE.search(sentence).group(1) or ""
+            cut = end - len(punct)
+            marker = _join_citations([citations[c] for c in cited])
+            text = text[:cut].rstrip() + " " + marker + text[cut:]
+        lines[line_index]["text"] = text
+
+    document = "\n".join(line["text"] for line in lines)
+    return _append_reference_list(document, reference_list)
+
+
+def _numbered_citable_content(lines):
+    """
+    Render headings and citable paragraphs with [S<line>.<sentence>] ids;
+    non-citable sections are left out entirely to save input tokens.
+    """
+    rendered = []
+    for index, line in enumerate(lines):
+        if line["heading"]:
+            rendered.append(line["text"].strip())
+        elif line["citable"]:
+            text = line["text"]
+            start = 0
+            sentences = []
+            for number, end in enumerate(_sentence_ends(text), start=1):
+                sentences.append(f"[S{index}.{number}] {text[start:end].strip()}")
+                start = end
+            rendered.append(" ".join(sentences))
+    return "\n".join(rendered)
+
+
+# ---------- helper: token budgeting ----------
+
+@lru_cache(maxsize=None)
+def _token_encoder():
+    """
+    tiktoken encoder when the optional package is installed, else None.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local token count: exact with tiktoken, otherwise ~4 characters a token.
+    """
+    if not text:
+        return 0
+    encoder = _token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def _split_oversized(block, max_tokens):
+    """
+    Break a single block that is over budget by lines, then by characters.
+    """
+    pieces = []
+    current = []
+    for line in block.split("\n"):
+        if estimate_tokens(line) > max_tokens:
+            step = max(1, max_tokens * 4)
+            pieces.extend(line[i:i + step] for i in range(0, len(line), step))
+            continue
+        if current and estimate_tokens("\n".join(current + [line])) > max_tokens:
+            pieces.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def chunk_text(text, max_tokens=SUMMARY_CHUNK_TOKENS):
+    """
+    Pack text into parts of at most ``max_tokens``, cutting only at blank
+    lines (paragraph and PDF page boundaries). Once a part is half full, a
+    heading starts a new part so sections are not split needlessly.
+    """
+    blocks = [b.strip("\n") for b in re.split(r"\n\s*\n", text or "") if b.strip()]
+    chunks = []
+    current = []
+    current_tokens = 0
+    for block in blocks:
+        block_tokens = estimate_tokens(block)
+        pieces = [block] if block_tokens <= max_tokens else _split_oversized(block, max_tokens)
+        for piece in pieces:
+            piece_tokens = block_tokens if len(pieces) == 1 else estimate_tokens(piece)
+            starts_section = _heading_parts(piece.split("\n", 1)[0]) is not None
+            if current and (
+                current_tokens + piece_tokens > max_tokens
+                or (starts_section and current_tokens >= max_tokens // 2)
+            ):
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _condense_attachments(attachments, model, use_cache):
+    """
+    Map step for oversized briefs: condense every part of every large
+    attachment in parallel. Short attachments (often the brief itself) are
+    kept verbatim. Returns labelled text blocks in the original order.
+    """
+    keep_verbatim = SUMMARY_CHUNK_TOKENS // 4
+    parts = []
+    for filename, text in attachments:
+        if estimate_tokens(text) <= keep_verbatim:
+            parts.append((f"File: {filename}", text, False))
+            continue
+        chunks = chunk_text(text)
+        for number, chunk in enumerate(chunks, start=1):
+            label = f"{filename} (part {number} of {len(chunks)})" if len(chunks) > 1 else filename
+            parts.append((f"Notes: {label}", chunk, True))
+
+    def condense(part):
+        label, text, needs_condensing = part
+        if not needs_condensing:
+            return f"----- {label} -----\n{text}"
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": f"----- {label} -----\n{text}"}
+                ],
+            }
+        ]
+        notes = _run_agent(
+            CONDENSE_PROMPT, messages, model, use_cache=use_cache, stage="summary.condense"
+        ).strip()
+        if not notes or notes.lower().startswith("no task-relevant details"):
+            return None
+        return f"----- {label} -----\n{notes}"
+
+    workers = max(1, min(SUMMARY_CONDENSE_CONCURRENCY, len(parts)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        blocks = list(pool.map(telemetry.bind_context(condense), parts))
+    return [block for block in blocks if block]
+
+
+# ---------- Agent 1: generate job summary ----------
+
+def generate_job_summary(
+    instruction_text,
+    uploaded_files,
+    model="gpt-4.1-mini",
+    on_text=None,
+    use_cache=True,
+    report=None,
+):
+    """
+    Agent 1. If ``report`` is a dict it is filled with the image
+    preprocessing stats (see ``extraction.preprocess_images``).
+    """
+    attachment_text_blocks = []
+    image_contents = []
+
+    documents = []
+    images = []
+    for uf in uploaded_files:
+        filename = uf.name
+        ext = os.path.splitext(filename.lower())[1]
+
+        # Images -> input_image
+        if ext in [".png", ".jpg", ".jpeg"]:
+            images.append((filename, uf.getvalue()))
+        else:
+            documents.append((filename, uf.getvalue()))
+
+    # Downscale, re-encode and de-duplicate images before base64 encoding.
+    prepared_images, image_report = preprocess_images(images)
+    if report is not None:
+        report.update(image_report)
+    for mime, raw in prepared_images:
+        b64 = base64.b64encode(raw).decode("utf-8")
+        image_contents.append(
+            {
+                "type": "input_image",
+                "image_url": f"data:{mime};base64,{b64}",
+            }
+        )
+
+    # All documents are extracted together so they parse in parallel.
+    attachments = [
+        (filename, text)
+        for (filename, _), text in zip(documents, extract_texts(documents))
+        if text
+    ]
+    for filename, text in attachments:
+        attachment_text_blocks.append(
+            f"----- File: {filename} -----\n{text}"
+        )
+
+    base_instruction = (instruction_text or "").strip()
+    if not base_instruction:
+        base_instruction = (
+            "The instructions for the writing task are in the following extracted "
+            "file contents. Please infer all possible details about the assignment."
+        )
+
+    all_attachments_text = "\n\n".join(attachment_text_blocks).strip()
+    if estimate_tokens(base_instruction) + estimate_tokens(all_attachments_text) > SUMMARY_TOKEN_BUDGET:
+        # Map-reduce: condense the attachments in parallel, then summarize
+        # the notes. Notes that are still too long are condensed again.
+        for _ in range(3):
+            attachment_text_blocks = _condense_attachments(attachments, model, use_cache)
+            all_attachments_text = "\n\n".join(attachment_text_blocks).strip()
+            if estimate_tokens(all_attachments_text) <= SUMMARY_TOKEN_BUDGET:
+                break
+            attachments = [("condensed notes", all_attachments_text)]
+        combined_text = (
+            base_instruction
+            + "\n\nThe uploaded files were too long to include in full. Below are "
+            "the short files and condensed notes of the task-relevant content of "
+            "the long ones:\n\n"
+            + all_attachments_text
+        )
+    elif all_attachments_text:
+        combined_text = (
+            base_instruction
+            + "\n\nBelow is the extracted text from the uploaded files:\n\n"
+            + all_attachments_text
+        )
+    else:
+        combined_text = base_instruction
+
+    content_items = [{"type": "input_text", "text": combined_text}]
+    content_items.extend(image_contents)
+
+    messages = [
+        {
+            "role": "user",
+            "content": content_items,
+        }
+    ]
+
+    return _run_agent(
+        SUMMARY_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="summary"
+    )
+
+
+# ---------- Agent 2: generate structure from summary ----------
+
+def generate_structure_from_summary(
+    job_summary_text, model="gpt-4.1-mini", on_text=None, use_cache=True
+):
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": job_summary_text}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        STRUCTURE_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="structure"
+    )
+
+
+# ---------- Agent 3: generate content from structure ----------
+
+def _generate_section(title, structure_text, section, model, on_text=None, use_cache=True):
+    combined = (
+        f"Title: {title or 'Not specified'}\n\n"
+        "=== FULL STRUCTURE (for context only) ===\n"
+        f"{structure_text}\n\n"
+        "=== SECTION TO WRITE ===\n"
+        f"{section['text']}\n"
+    )
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": combined}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        SECTION_CONTENT_PROMPT,
+        messages,
+        model,
+        on_text=on_text,
+        use_cache=use_cache,
+        stage="content.section",
+    ).strip()
+
+
+def _writable_sections(structure_text):
+    """
+    Parsed structure sections minus reference/bibliography sections, which
+    are produced by Agents 4 and 5.
+    """
+    preamble, sections = parse_structure_sections(structure_text)
+    return preamble, [s for s in sections if not _REFERENCE_HEADING_RE.match(s["title"])]
+
+
+class _SectionsStopped(Exception):
+    pass
+
+
+def _write_sections(
+    header, structure_text, sections, model, max_workers, on_text, use_cache, written=None
+):
+    """
+    Write ``sections`` concurrently (at most ``max_workers`` at a time) and
+    join them in order after ``header``. ``written`` maps section positions
+    to existing prose that is kept as is; only the rest go to the model.
+    """
+    written = written or {}
+    title = _structure_title(header) or header
+    buffers = [written.get(i, "") for i in range(len(sections))]
+    todo = [i for i in range(len(sections)) if i not in written]
+
+    def assemble(parts):
+        return "\n\n".join(([header] if header else []) + [p for p in parts if p])
+
+    # Set when the caller stops (e.g. on_text raised because the job was
+    # cancelled) or a section failed: running sections stop at their next
+    # chunk instead of being written and paid for.
+    stopped = threading.Event()
+
+    def buffer_writer(index):
+        if on_text is None:
+            return None
+
+        def write(text):
+            if stopped.is_set():
+                raise _SectionsStopped()
+            buffers[index] = text
+
+        return write
+
+    if todo:
+        workers = max(1, min(int(max_workers), len(todo)))
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                i: pool.submit(
+                    telemetry.bind_context(_generate_section),
+                    title,
+                    structure_text,
+                    sections[i],
+                    model,
+                    buffer_writer(i),
+                    use_cache,
+                )
+                for i in todo
+            }
+            # Workers cannot touch the UI, so queue status and partial
+            # output are reported from here while they run.
+            pending = set(futures.values())
+            while pending:
+                done, pending = wait(pending, timeout=STREAM_REFRESH_SECONDS)
+                for future in done:
+                    if future.exception() is not None:
+                        raise future.exception()
+                scheduler.report_wait()
+                if on_text is not None:
+                    on_text(assemble(buffers))
+            for i, future in futures.items():
+                buffers[i] = future.result()
+        except BaseException:
+            stopped.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+
+    return assemble(buffers)
+
+
+def generate_content_from_structure(
+    structure_text,
+    model="gpt-4.1-mini",
+    parallel=False,
+    max_workers=DEFAULT_SECTION_CONCURRENCY,
+    on_text=None,
+    use_cache=True,
+):
+    """
+    Agent 3. With ``parallel=True`` the structure is split into its top-level
+    sections, which are written concurrently (at most ``max_workers`` at a
+    time) and joined back in heading order. Reference/bibliography sections
+    are skipped because they are produced by Agents 4 and 5. Structures that
+    do not parse into at least two sections fall back to a single call.
+
+    ``on_text`` is always called from the calling thread: in parallel mode
+    the workers stream into per-section buffers and the partially written
+    document is re-assembled here.
+    """
+    if parallel:
+        preamble, sections = _writable_sections(structure_text)
+        if len(sections) >= 2:
+            title = _structure_title(preamble)
+            return _write_sections(
+                title, structure_text, sections, model, max_workers, on_text, use_cache
+            )
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": structure_text}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        CONTENT_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="content"
+    )
+
+
+def _heading_key(title: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", title.lower()).strip()
+
+
+def _section_signature(section) -> str:
+    """
+    Section block with numbering stripped, so renumbering alone (e.g. after
+    a section is inserted above) does not count as a change.
+    """
+    lines = []
+    for line in section["text"].splitlines():
+        line = line.strip().lstrip("#").replace("**", "").strip()
+        line = re.sub(r"^(?:(?:chapter|section|part)\s+)?\d{1,2}(?:\.\d+)*[.):]?\s+", "", line, flags=re.I)
+        if line:
+            lines.append(line.lower())
+    return "\n".join(lines)
+
+
+def split_content_by_sections(content_text, sections):
+    """
+    Locate each structure section's heading in the generated content, in
+    order. Returns the text before the first located section (title etc.)
+    and a dict mapping section positions to their prose, heading included.
+    Sections whose heading cannot be found are simply missing from the dict.
+    """
+    lines = (content_text or "").split("\n")
+    starts = {}
+    position = 0
+    for index, section in enumerate(sections):
+        key = _heading_key(section["title"])
+        for line_index in range(position, len(lines)):
+            heading = _heading_parts(lines[line_index])
+            if heading and _heading_key(heading[1]) == key:
+                starts[index] = line_index
+                position = line_index + 1
+                break
+
+    ordered = sorted(starts.items(), key=lambda item: item[1])
+    first = ordered[0][1] if ordered else len(lines)
+    prose = {}
+    for n, (index, start) in enumerate(ordered):
+        end = ordered[n + 1][1] if n + 1 < len(ordered) else len(lines)
+        # Trailing reference/bibliography sections in the content belong to
+        # no structure section.
+        for line_index in range(start + 1, end):
+            heading = _heading_parts(lines[line_index])
+            if heading and _REFERENCE_HEADING_RE.match(heading[1]):
+                end = line_index
+                break
+        prose[index] = "\n".join(lines[start:end]).strip()
+    return "\n".join(lines[:first]).strip(), prose
+
+
+def _renumber_prose(prose, old_number, new_number):
+    if old_number == new_number:
+        return prose
+    pattern = re.compile(rf"^(\W*(?:(?:chapter|section|part)\s+)?){re.escape(old_number)}(?=[.):\s])", re.I)
+    lines = []
+    for line in prose.split("\n"):
+        if _heading_parts(line):
+            line = pattern.sub(lambda m: m.group(1) + new_number, line, count=1)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def regenerate_changed_sections(
+    old_structure,
+    new_structure,
+    content_text,
+    model="gpt-4.1-mini",
+    max_workers=DEFAULT_SECTION_CONCURRENCY,
+    on_text=None,
+    use_cache=True,
+):
+    """
+    Agent 3, incremental: diff ``new_structure`` against the structure that
+    produced ``content_text`` and only write sections that were added or
+    whose heading, subsections or word counts changed. Unchanged sections
+    keep their current prose (including any manual edits) and everything is
+    joined back in the new order.
+
+    Returns the new content and a dict listing the ``added``, ``changed``,
+    ``removed`` and ``kept`` section titles.
+    """
+    old_preamble, old_sections = _writable_sections(old_structure)
+    new_preamble, new_sections = _writable_sections(new_structure)
+    content_header, old_prose = split_content_by_sections(content_text, old_sections)
+
+    old_by_key = {}
+    for index, section in enumerate(old_sections):
+        old_by_key.setdefault(_heading_key(section["title"]), index)
+
+    changes = {"added": [], "changed": [], "removed": [], "kept": []}
+    written = {}
+    for index, section in enumerate(new_sections):
+        old_index = old_by_key.get(_heading_key(section["title"]))
+        if old_index is None:
+            changes["added"].append(section["title"])
+        elif (
+            old_index in old_prose
+            and _section_signature(old_sections[old_index]) == _section_signature(section)
+        ):
+            written[index] = _renumber_prose(
+                old_prose[old_index], old_sections[old_index]["number"], section["number"]
+            )
+            changes["kept"].append(section["title"])
+        else:
+            changes["changed"].append(section["title"])
+
+    new_keys = {_heading_key(s["title"]) for s in new_sections}
+    changes["removed"] = [
+        s["title"] for s in old_sections if _heading_key(s["title"]) not in new_keys
+    ]
+
+    header = content_header
+    new_title = _structure_title(new_preamble)
+    if not header or _structure_title(old_preamble) != new_title:
+        header = new_title
+
+    new_content = _write_sections(
+        header, new_structure, new_sections, model, max_workers, on_text, use_cache, written
+    )
+    return new_content, changes
+
+
+def rewrite_sections(
+    structure_text,
+    content_text,
+    titles,
+    model="gpt-4.1-mini",
+    max_workers=DEFAULT_SECTION_CONCURRENCY,
+    on_text=None,
+    use_cache=False,
+):
+    """
+    Agent 3 for the sections of ``structure_text`` named in ``titles`` only
+    (e.g. ones that missed their word target); every other section keeps its
+    current prose. Sections missing from the content are written too. The
+    cache is off by default, since a cached answer would repeat the draft
+    being replaced.
+
+    Returns the new content and the same change summary as
+    ``regenerate_changed_sections``.
+    """
+    preamble, sections = _writable_sections(structure_text)
+    header, prose = split_content_by_sections(content_text, sections)
+    wanted = {_heading_key(title) for title in titles}
+    written = {
+        index: text for index, text in prose.items()
+        if _heading_key(sections[index]["title"]) not in wanted
+    }
+    changes = {
+        "added": [],
+        "changed": [s["title"] for i, s in enumerate(sections) if i not in written],
+        "removed": [],
+        "kept": [s["title"] for i, s in enumerate(sections) if i in written],
+    }
+    new_content = _write_sections(
+        header or _structure_title(preamble), structure_text, sections,
+        model, max_workers, on_text, use_cache, written,
+    )
+    return new_content, changes
+
+
+# ---------- helper: stage outputs ----------
+
+_SUMMARY_REFERENCE_STYLE_RE = re.compile(
+    r"reference style\s*[:\-–]\s*\**\s*([^;\n*]+)", re.IGNORECASE
+)
+
+
+def reference_style_from_summary(summary_text, default="Harvard"):
+    """
+    The "Reference Style:" field of an Agent 1 Job Summary, or ``default``.
+    """
+    match = _SUMMARY_REFERENCE_STYLE_RE.search(summary_text or "")
+    style = match.group(1).strip().strip(".\"'") if match else ""
+    if not style or style.lower() == "not specified":
+        return default
+    return style
+
+
+def split_references(references_text):
+    """
+    Split Agent 4 output at its "Citation List" heading into the reference
+    list and the citation list (which keeps its heading). Without the
+    heading everything is treated as the reference list.
+    """
+    if "Citation List" not in references_text:
+        return references_text, ""
+    head, tail = references_text.split("Citation List", 1)
+    return head.strip(), "Citation List" + tail.rstrip()
+
+
+# ---------- Agent 4: generate references & in-text citations list ----------
+
+def generate_references_from_content(
+    content_text,
+    reference_style,
+    total_words,
+    model="gpt-4.1",
+    on_text=None,
+    use_cache=True,
+):
+    combined = (
+        f"Reference style: {reference_style}\n"
+        f"Approximate total word count: {total_words}\n\n"
+        f"Content:\n{content_text}"
+    )
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": combined}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        REFERENCES_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="references"
+    )
+
+
+def generate_references_from_index(
+    content_text,
+    reference_style,
+    total_words,
+    model="gpt-4.1-mini",
+    on_text=None,
+    use_cache=True,
+    format_with_model=False,
+    index=None,
+):
+    """
+    Agent 4 grounded in the local reference index: the sources are the index
+    records (from MIN_REFERENCE_YEAR onwards) that best match the themes of
+    the content, about REFERENCES_PER_1000_WORDS per 1000 words, so every
+    reference can be traced to a stored record.
+
+    Styles with a local formatter (Harvard, APA, MLA, IEEE) are formatted
+    without a model call unless ``format_with_model`` is set; other styles
+    are formatted by the model, which is given only the retrieved records.
+    """
+    records = reference_index.match_references(
+        content_text, reference_index.reference_count(total_words), index=index
+    )
+    if not records:
+        raise ValueError(
+            f"No sources from {reference_index.MIN_REFERENCE_YEAR} onwards in the reference "
+            "index match this content. Import more references or let the model generate them."
+        )
+    if not format_with_model and reference_index.style_key(reference_style):
+        return reference_index.format_reference_output(records, reference_style)
+
+    fields = ("title", "authors", "year", "container", "volume", "issue", "pages", "publisher", "doi", "url")
+    sources = "\n".join(
+        json.dumps({k: r[k] for k in fields if r.get(k)}, ensure_ascii=False) for r in records
+    )
+    combined = f"Reference style: {reference_style}\n\n=== SOURCES ===\n{sources}\n"
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": combined}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        REFERENCE_FORMAT_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="references"
+    )
+
+
+# ---------- Agent 5: finalize document with in-text citations + reference list ----------
+
+def generate_final_document_with_citations(
+    content_text,
+    reference_list,
+    citation_list,
+    reference_style,
+    model="gpt-4.1",
+    on_text=None,
+    use_cache=True,
+    compact=False,
+):
+    """
+    Agent 5. By default the model re-emits the whole document with citations
+    added. With ``compact=True`` it only returns where each citation goes
+    (see CITATION_PLACEMENT_PROMPT) and the document is assembled locally by
+    ``apply_citation_insertions``, so output tokens scale with the number of
+    citations and the original wording cannot change.
+    """
+    if compact:
+        return _finalize_with_citation_positions(
+            content_text, reference_list, citation_list, reference_style, model, on_text, use_cache
+        )
+
+    combined = (
+        f"Reference style: {reference_style}\n\n"
+        "=== CONTENT (NO CITATIONS) ===\n"
+        f"{content_text}\n\n"
+        "=== REFERENCE LIST ===\n"
+        f"{reference_list}\n\n"
+        "=== CITATION LIST ===\n"
+        f"{citation_list}\n"
+    )
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": combined}
+            ],
+        }
+    ]
+
+    return _run_agent(
+        FINALIZE_PROMPT, messages, model, on_text=on_text, use_cache=use_cache, stage="final"
+    )
+
+
+def _finalize_with_citation_positions(
+    content_text, reference_list, citation_list, reference_style, model, on_text, use_cache
+):
+    citations = parse_citation_list(citation_list)
+    lines = _classify_content_lines(content_text)
+
+    insertions = []
+    if citations and any(line["citable"] for line in lines):
+        citation_block = "\n".join(f"C{i + 1}: {c}" for i, c in enumerate(citations))
+        combined = (
+            f"Reference style: {reference_style}\n\n"
+            "=== CITATION LIST ===\n"
+            f"{citation_block}\n\n"
+            "=== REFERENCE LIST ===\n"
+            f"{reference_list}\n\n"
+            "=== DOCUMENT BODY ===\n"
+            f"{_numbered_citable_content(lines)}\n"
+        )
+
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": combined}
+                ],
+            }
+        ]
+
+        raw = _run_agent(
+            CITATION_PLACEMENT_PROMPT,
+            messages,
+            model,
+            use_cache=use_cache,
+            stage="final.placement",
+            text={"format": CITATION_PLACEMENT_FORMAT},
+        )
+        try:
+            items = json.loads(raw)["insertions"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Citation placement response was not valid JSON: {e}")
+        for item in items:
+            match = re.fullmatch(r"C?(\d+)", str(item.get("citation", "")).strip())
+            if match:
+                insertions.append((item.get("sentence", ""), int(match.group(1)) - 1))
+
+    final_text = apply_citation_insertions(content_text, citations, insertions, reference_list)
+    if on_text is not None:
+        on_text(final_text)
+    return final_text
+
+
+# ---------- speculative pre-computation ----------
+
+def speculation_key(stage, input_text, **options):
+    """
+    Identity of a speculative call: the stage, its input text and any
+    options that change its output. A click only reuses a speculation whose
+    key matches what it would have sent itself.
+    """
+    payload = json.dumps([stage, input_text, options], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _speculation_pool():
+    return ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculate")
+
+
+class Speculation:
+    """
+    An agent call started in the background before the user asked for it,
+    e.g. the structure as soon as the Job Summary is ready.
+
+    ``fn(*args, **kwargs)`` runs on a shared pool at the scheduler's
+    SPECULATIVE priority, under the caller's run and session, streaming
+    into ``partial``. Its result also lands in the response cache, so even
+    a discarded speculation is not wasted if the same input comes back.
+    Once adopted, its calls are raised to INTERACTIVE priority.
+    """
+
+    def __init__(self, key, fn, *args, **kwargs):
+        self.key = key
+        self.partial = ""
+        self._adopted = False
+        self._context = None
+        self._lock = threading.Lock()
+        session = scheduler.current_session() or {}
+
+        def run():
+            with self._lock:
+                priority = scheduler.INTERACTIVE if self._adopted else scheduler.SPECULATIVE
+                scheduler.set_session(session.get("id"), priority=priority)
+                self._context = scheduler.current_session()
+            return fn(*args, on_text=self._update, **kwargs)
+
+        self.future = _speculation_pool().submit(telemetry.bind_context(run))
+
+    def _update(self, text):
+        self.partial = text
+
+    def result(self, on_text=None):
+        """
+        Wait for the output, passing the partial text to ``on_text`` (on the
+        calling thread) while it is still being written. Raises whatever
+        the background call raised.
+        """
+        while True:
+            try:
+                text = self.future.result(timeout=STREAM_REFRESH_SECONDS)
+            except FutureTimeoutError:
+                scheduler.report_wait()
+                if on_text is not None and self.partial:
+                    on_text(self.partial)
+                continue
+            if on_text is not None:
+                on_text(text)
+            return text
+
+    def adopt(self):
+        """
+        The user now waits for this output: schedule its remaining calls
+        like any interactive call.
+        """
+        with self._lock:
+            self._adopted = True
+            context = self._context
+        if context is not None:
+            scheduler.get_scheduler().promote(context, scheduler.INTERACTIVE)
+
+    def discard(self):
+        """
+        Drop the speculation; a call that has not started yet is cancelled.
+        """
+        self.future.cancel()
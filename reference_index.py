@@ -0,0 +1,711 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+REFERENCE_INDEX_PATH = os.environ.get(
+    "REFERENCE_INDEX_PATH", os.path.join(".cache", "references.sqlite3")
+)
+# Agent 4 only cites sources published after 2021.
+MIN_REFERENCE_YEAR = int(os.environ.get("MIN_REFERENCE_YEAR", "2022"))
+# Same density Agent 4 is asked for.
+REFERENCES_PER_1000_WORDS = 7
+# Search terms taken from the content.
+KEYWORD_COUNT = 24
+REFERENCE_FILE_EXTENSIONS = ["bib", "ris", "json"]
+# Styles formatted locally; others are left to the model.
+LOCAL_STYLES = ("harvard", "apa", "mla", "ieee")
+
+_STOPWORDS = frozenset(
+    """
+    a about above across after again against all also although among an and another any are
+    around as at be because been before being below between both but by can could did do does
+    doing down during each either et etc even every few for from further had has have having he
+    her here hers him his how however i if in into is it its itself just less many may might
+    more most much must my neither no nor not now of off often on once one only or other our
+    ours out over own per rather same several shall she should since so some such than that the
+    their theirs them then there these they this those though through thus to too under until
+    up upon us use used using very via was we well were what when where whether which while who
+    whom whose why will with within without would yet you your
+    chapter section introduction conclusion conclusions summary abstract executive overview
+    words word total title figure table paper study report essay discussion analysis also
+    however therefore furthermore moreover including include includes included particularly
+    various different significant significantly important key new first second third can
+    """.split()
+)
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z-]{2,}")
+_YEAR_RE = re.compile(r"\b(1[89]\d\d|20\d\d)\b")
+# BibTeX accents as Unicode combining marks, so M{\"u}ller stays Müller.
+_LATEX_ACCENTS = {
+    '"': "\u0308", "'": "\u0301", "`": "\u0300", "^": "\u0302", "~": "\u0303",
+    "=": "\u0304", ".": "\u0307", "u": "\u0306", "v": "\u030c", "H": "\u030b",
+    "c": "\u0327", "k": "\u0328",
+}
+_LATEX_ACCENT_RE = re.compile(r"\\(?:([\"'`^~=.])|([uvHck])(?=[\s{]))\s*\{?([A-Za-z])\}?")
+_LATEX_LETTERS = {
+    "ss": "ß", "ae": "æ", "AE": "Æ", "oe": "œ", "OE": "Œ", "aa": "å", "AA": "Å",
+    "o": "ø", "O": "Ø", "l": "ł", "L": "Ł", "i": "i", "j": "j",
+}
+
+
+# ---------- loaders ----------
+
+def _accent(match):
+    mark = _LATEX_ACCENTS[match.group(1) or match.group(2)]
+    return unicodedata.normalize("NFC", match.group(3) + mark)
+
+
+def _clean_latex(value):
+    for command, char in _LATEX_LETTERS.items():
+        value = re.sub(rf"\\{command}(?![A-Za-z])\s*", char, value)
+    value = _LATEX_ACCENT_RE.sub(_accent, value)
+    value = value.replace("\\&", "&").replace("---", "—").replace("--", "–").replace("~", " ")
+    value = re.sub(r"\\[A-Za-z]+\s*", "", value)
+    value = value.replace("{", "").replace("}", "")
+    return re.sub(r"\s+", " ", value).strip()
+
+
+def _parse_name(name):
+    """
+    ``[family, given]`` from "Family, Given" or "Given Family"; a name in
+    braces (an organisation) is kept whole as the family name.
+    """
+    name = name.strip()
+    if name.startswith("{") and name.endswith("}"):
+        return [_clean_latex(name), ""]
+    name = _clean_latex(name)
+    if "," in name:
+        family, given = name.split(",", 1)
+        return [family.strip(), given.strip()]
+    parts = name.split()
+    if len(parts) < 2:
+        return [name, ""]
+    return [parts[-1], " ".join(parts[:-1])]
+
+
+def _year(value):
+    match = _YEAR_RE.search(str(value or ""))
+    return int(match.group(1)) if match else None
+
+
+def _bibtex_value(text, i):
+    """
+    The BibTeX field value starting at ``text[i]`` (braced, quoted or bare)
+    and the position after it. Braces inside the value are kept.
+    """
+    while i < len(text) and text[i].isspace():
+        i += 1
+    if i < len(text) and text[i] == "{":
+        depth, start = 0, i
+        while i < len(text):
+            if text[i] == "{":
+                depth += 1
+            elif text[i] == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start + 1:i], i + 1
+            i += 1
+        return text[start + 1:], i
+    if i < len(text) and text[i] == '"':
+        depth, start = 0, i + 1
+        i += 1
+        while i < len(text):
+            if text[i] == "{":
+                depth += 1
+            elif text[i] == "}":
+                depth -= 1
+            elif text[i] == '"' and depth == 0 and text[i - 1] != "\\":
+                return text[start:i], i + 1
+            i += 1
+        return text[start:], i
+    match = re.compile(r"[^,}\s]*").match(text, i)
+    return match.group(0), match.end()
+
+
+def _bibtex_entries(text):
+    for match in re.finditer(r"@(\w+)\s*\{", text):
+        entry_type = match.group(1).lower()
+        if entry_type in ("comment", "string", "preamble"):
+            continue
+        i = text.find(",", match.end())
+        if i < 0:
+            continue
+        fields = {}
+        i += 1
+        while True:
+            field = re.compile(r"\s*,?\s*([A-Za-z][\w-]*)\s*=\s*").match(text, i)
+            if field is None:
+                break
+            value, i = _bibtex_value(text, field.end())
+            fields[field.group(1).lower()] = value
+        yield entry_type, fields
+
+
+def load_bibtex(text):
+    """
+    Records from a BibTeX export. @string macros and cross-references are
+    not expanded.
+    """
+    records = []
+    for entry_type, fields in _bibtex_entries(text):
+        authors = re.split(r"\s+and\s+", fields.get("author") or fields.get("editor") or "")
+        records.append({
+            "type": entry_type,
+            "title": _clean_latex(fields.get("title", "")),
+            "authors": [_parse_name(a) for a in authors if a.strip()],
+            "year": _year(fields.get("year") or fields.get("date")),
+            "container": _clean_latex(
+                fields.get("journal") or fields.get("journaltitle") or fields.get("booktitle") or ""
+            ),
+            "volume": _clean_latex(fields.get("volume", "")),
+            "issue": _clean_latex(fields.get("number") or fields.get("issue") or ""),
+            "pages": _clean_latex(fields.get("pages", "")),
+            "publisher": _clean_latex(
+                fields.get("publisher") or fields.get("institution") or fields.get("school") or ""
+            ),
+            "doi": _clean_latex(fields.get("doi", "")),
+            "url": fields.get("url", "").strip(),
+            "abstract": _clean_latex(fields.get("abstract", "")),
+            "keywords": _clean_latex(fields.get("keywords", "")),
+        })
+    return records
+
+
+_RIS_LINE_RE = re.compile(r"^([A-Z][A-Z0-9])  -\s?(.*)$")
+_RIS_FIELDS = {
+    "TI": "title", "T1": "title",
+    "T2": "container", "JO": "container", "JF": "container", "JA": "container", "BT": "container",
+    "VL": "volume", "IS": "issue", "PB": "publisher", "DO": "doi", "UR": "url",
+    "AB": "abstract", "N2": "abstract",
+}
+
+
+def load_ris(text):
+    """
+    Records from a RIS export (EndNote, Zotero, Scopus, Web of Science).
+    """
+    records = []
+    record = None
+    for line in text.splitlines():
+        match = _RIS_LINE_RE.match(line.rstrip())
+        if match is None:
+            continue
+        tag, value = match.group(1), match.group(2).strip()
+        if tag == "TY":
+            record = {"type": value.lower(), "authors": [], "keywords": [], "pages": ["", ""]}
+            continue
+        if record is None:
+            continue
+        if tag == "ER":
+            start, end = record.pop("pages")
+            record["pages"] = f"{start}–{end}" if start and end else start
+            record["keywords"] = ", ".join(record["keywords"])
+            records.append(record)
+            record = None
+        elif tag in ("AU", "A1"):
+            record["authors"].append(_parse_name(value))
+        elif tag in ("PY", "Y1", "DA"):
+            record["year"] = record.get("year") or _year(value)
+        elif tag == "SP":
+            record["pages"][0] = value
+        elif tag == "EP":
+            record["pages"][1] = value
+        elif tag == "KW":
+            record["keywords"].append(value)
+        elif tag in _RIS_FIELDS and not record.get(_RIS_FIELDS[tag]):
+            record[_RIS_FIELDS[tag]] = value
+    return records
+
+
+def load_csl_json(text):
+    """
+    Records from CSL-JSON (Zotero, Mendeley, citation.js exports).
+    """
+    items = json.loads(text)
+    if isinstance(items, dict):
+        items = items.get("items", [items])
+    records = []
+    for item in items:
+        issued = item.get("issued") or {}
+        date_parts = issued.get("date-parts") or [[None]]
+        authors = [
+            [a["literal"], ""] if "literal" in a else [a.get("family", ""), a.get("given", "")]
+            for a in item.get("author") or item.get("editor") or []
+        ]
+        keywords = item.get("keyword") or ""
+        records.append({
+            "type": item.get("type", ""),
+            "title": item.get("title", ""),
+            "authors": authors,
+            "year": _year(date_parts[0][0] if date_parts and date_parts[0] else None)
+                    or _year(issued.get("raw")),
+            "container": item.get("container-title", ""),
+            "volume": str(item.get("volume", "")),
+            "issue": str(item.get("issue", "")),
+            "pages": str(item.get("page", "")).replace("-", "–"),
+            "publisher": item.get("publisher", ""),
+            "doi": item.get("DOI", ""),
+            "url": item.get("URL", ""),
+            "abstract": item.get("abstract", ""),
+            "keywords": ", ".join(keywords) if isinstance(keywords, list) else keywords,
+        })
+    return records
+
+
+def load_references(filename, data):
+    """
+    Records from an exported reference file, by extension (see
+    REFERENCE_FILE_EXTENSIONS). ``data`` may be bytes or text.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig", errors="replace")
+    ext = os.path.splitext(filename.lower())[1].lstrip(".")
+    if ext == "bib":
+        records = load_bibtex(data)
+    elif ext == "ris":
+        records = load_ris(data)
+    elif ext == "json":
+        records = load_csl_json(data)
+    else:
+        raise ValueError(f"Unsupported reference file type: .{ext}")
+    return [r for r in records if r.get("title")]
+
+
+def record_id(record):
+    """
+    Stable id of a record: its DOI, or a digest of its title and year, so the
+    same source imported twice (or from two formats) is stored once.
+    """
+    doi = (record.get("doi") or "").strip().lower()
+    doi = re.sub(r"^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)", "", doi)
+    if doi:
+        return f"doi:{doi}"
+    title = re.sub(r"[^a-z0-9]+", " ", (record.get("title") or "").lower()).strip()
+    return "t:" + hashlib.sha256(f"{title}|{record.get('year')}".encode("utf-8")).hexdigest()[:16]
+
+
+# ---------- index ----------
+
+class ReferenceIndex:
+    """
+    Bibliographic records in a local SQLite file with an FTS5 full-text
+    index over titles, authors, venues, keywords and abstracts. Searches
+    are ranked by BM25 (matches in titles and keywords weigh most) and
+    take milliseconds. Safe to share between threads and sessions.
+    """
+
+    def __init__(self, path=REFERENCE_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                " id TEXT PRIMARY KEY,"
+                " year INTEGER,"
+                " data TEXT NOT NULL,"
+                " added_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5("
+                " id UNINDEXED, title, authors, container, keywords, abstract,"
+                " tokenize = 'porter unicode61')"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, records):
+        """
+        Store ``records``. A source already in the index is updated, keeping
+        fields the new copy lacks. Returns how many records were new.
+        """
+        added = 0
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            for record in records:
+                rid = record_id(record)
+                row = conn.execute("SELECT data FROM records WHERE id = ?", (rid,)).fetchone()
+                if row is None:
+                    added += 1
+                else:
+                    # Keep details only the earlier copy had.
+                    earlier = json.loads(row[0])
+                    record = dict(record, **{k: v for k, v in earlier.items() if v and not record.get(k)})
+                conn.execute(
+                    "INSERT OR REPLACE INTO records (id, year, data, added_at) VALUES (?, ?, ?, ?)",
+                    (rid, record.get("year"), json.dumps(record, ensure_ascii=False), now),
+                )
+                conn.execute("DELETE FROM records_fts WHERE id = ?", (rid,))
+                conn.execute(
+                    "INSERT INTO records_fts (id, title, authors, container, keywords, abstract)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        rid,
+                        record.get("title", ""),
+                        " ".join(" ".join(a) for a in record.get("authors", [])),
+                        record.get("container", ""),
+                        record.get("keywords", ""),
+                        record.get("abstract", ""),
+                    ),
+                )
+        return added
+
+    def count(self, min_year=None):
+        with self._lock, self._connect() as conn:
+            if min_year is None:
+                return conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            return conn.execute(
+                "SELECT COUNT(*) FROM records WHERE year >= ?", (min_year,)
+            ).fetchone()[0]
+
+    def search(self, terms, limit=10, min_year=MIN_REFERENCE_YEAR):
+        """
+        The ``limit`` best records matching any of ``terms`` (words or
+        phrases), published in or after ``min_year``, best first. Each
+        record carries its ``id`` and BM25 ``score`` (lower is better).
+        """
+        terms = [re.sub(r"[^\w\s-]", " ", t).strip() for t in terms]
+        query = " OR ".join(f'"{t}"' for t in terms if t)
+        if not query:
+            return []
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT r.id, r.data, bm25(records_fts, 0.0, 10.0, 1.0, 2.0, 5.0, 1.0) AS score"
+                " FROM records_fts JOIN records r ON r.id = records_fts.id"
+                " WHERE records_fts MATCH ? AND r.year >= ?"
+                " ORDER BY score LIMIT ?",
+                (query, min_year or 0, limit),
+            ).fetchall()
+        return [dict(json.loads(data), id=rid, score=score) for rid, data, score in rows]
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM records")
+            conn.execute("DELETE FROM records_fts")
+
+
+@lru_cache(maxsize=None)
+def get_reference_index():
+    """
+    Process-wide reference index shared by all sessions.
+    """
+    return ReferenceIndex()
+
+
+# ---------- matching ----------
+
+def extract_keywords(text, limit=KEYWORD_COUNT):
+    """
+    The themes of ``text`` as search terms: its most frequent two-word
+    phrases (seen at least twice) followed by its most frequent words,
+    leaving out stop words and generic academic vocabulary.
+    """
+    words = [w.lower().strip("-") for w in _WORD_RE.findall(text or "")]
+    content_words = [w for w in words if len(w) >= 4 and w not in _STOPWORDS]
+    unigrams = Counter(content_words)
+    bigrams = Counter(
+        f"{a} {b}"
+        for a, b in zip(words, words[1:])
+        if len(a) >= 3 and len(b) >= 3 and a not in _STOPWORDS and b not in _STOPWORDS
+    )
+    terms = [p for p, n in bigrams.most_common(limit // 3) if n >= 2]
+    for word, _ in unigrams.most_common(limit):
+        if len(terms) >= limit:
+            break
+        terms.append(word)
+    return terms
+
+
+def reference_count(total_words):
+    return max(1, round((total_words or 0) / 1000 * REFERENCES_PER_1000_WORDS))
+
+
+def match_references(content_text, count, index=None, min_year=MIN_REFERENCE_YEAR, keywords=None):
+    """
+    Up to ``count`` records from the index (the shared one by default) that
+    best match the themes of ``content_text``.
+    """
+    index = index or get_reference_index()
+    if keywords is None:
+        keywords = extract_keywords(content_text)
+    return index.search(keywords, limit=count, min_year=min_year)
+
+
+# ---------- formatting ----------
+
+def style_key(reference_style):
+    """
+    The locally supported style named by ``reference_style`` (e.g. "APA 7th"
+    → "apa"), or None.
+    """
+    style = (reference_style or "").lower()
+    for key in LOCAL_STYLES:
+        if key in style:
+            return key
+    return None
+
+
+def _initials(given, spaced=False):
+    parts = [p for p in re.split(r"[\s.]+", given or "") if p]
+    initials = [
+        "-".join(f"{piece[0]}." for piece in part.split("-") if piece)
+        for part in parts
+    ]
+    return (" " if spaced else "").join(initials)
+
+
+def _join(names, last, separator=", "):
+    if len(names) <= 1:
+        return "".join(names)
+    return separator.join(names[:-1]) + last + names[-1]
+
+
+def _author_list(authors, style):
+    if not authors:
+        return ""
+    if style == "ieee":
+        names = [f"{_initials(g, spaced=True)} {f}".strip() for f, g in authors]
+        return _join(names, ", and " if len(names) > 2 else " and ")
+    if style == "mla":
+        family, given = authors[0]
+        first = f"{family}, {given}".strip(", ")
+        if len(authors) == 1:
+            return first
+        if len(authors) == 2:
+            family, given = authors[1]
+            return f"{first}, and {given} {family}".replace("  ", " ")
+        return f"{first}, et al"
+    names = [f"{f}, {_initials(g)}".strip(", ") for f, g in authors]
+    if style == "apa":
+        return _join(names, ", & ")
+    return _join(names, " and ")
+
+
+def _sentence(text):
+    text = (text or "").strip()
+    return text if not text or text[-1] in ".?!" else text + "."
+
+
+def _doi_url(record):
+    doi = re.sub(r"^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)", "", (record.get("doi") or "").strip(), flags=re.I)
+    return f"https://doi.org/{doi}" if doi else (record.get("url") or "")
+
+
+def format_reference(record, style, number=None, year_label=None):
+    """
+    Reference list entry for ``record`` in a local style (see
+    LOCAL_STYLES). ``year_label`` overrides the year (e.g. "2023a").
+    """
+    year = year_label or (str(record["year"]) if record.get("year") else "n.d.")
+    authors = _author_list(record.get("authors"), style)
+    title = (record.get("title") or "").strip().rstrip(".")
+    container = record.get("container") or ""
+    volume, issue, pages = record.get("volume"), record.get("issue"), record.get("pages")
+    publisher = record.get("publisher") or ""
+    link = _doi_url(record)
+
+    if style == "ieee":
+        parts = [f'{authors}, "{title},"' if authors else f'"{title},"']
+        if container:
+            parts.append(f"{container},")
+        if volume:
+            parts.append(f"vol. {volume},")
+        if issue:
+            parts.append(f"no. {issue},")
+        if pages:
+            parts.append(f"pp. {pages},")
+        if publisher and not container:
+            parts.append(f"{publisher},")
+        parts.append(f"{year}.")
+        if record.get("doi"):
+            parts.append(f"doi: {link.removeprefix('https://doi.org/')}.")
+        elif link:
+            parts.append(f"[Online]. Available: {link}")
+        return f"[{number}] " + " ".join(parts)
+
+    if style == "mla":
+        parts = [_sentence(authors)] if authors else []
+        parts.append(f'"{title}."')
+        details = [container] if container else []
+        if volume:
+            details.append(f"vol. {volume}")
+        if issue:
+            details.append(f"no. {issue}")
+        if publisher and not container:
+            details.append(publisher)
+        details.append(year)
+        if pages:
+            details.append(f"pp. {pages}")
+        parts.append(", ".join(details) + ".")
+        if link:
+            parts.append(link.removeprefix("https://") + ".")
+        return " ".join(parts)
+
+    if style == "apa":
+        parts = [f"{_sentence(authors)} ({year})." if authors else f"{_sentence(title)} ({year})."]
+        if authors:
+            parts.append(_sentence(title))
+        source = container
+        if source and volume:
+            source += f", {volume}"
+            if issue:
+                source += f"({issue})"
+        if source and pages:
+            source += f", {pages}"
+        if source:
+            parts.append(source + ".")
+        elif publisher:
+            parts.append(_sentence(publisher))
+        if link:
+            parts.append(link)
+        return " ".join(parts)
+
+    # Harvard
+    parts = [f"{authors} ({year})" if authors else f"{title} ({year})"]
+    if authors:
+        parts.append(f"'{title}'," if container else f"{title}.")
+    if container:
+        source = container
+        if volume:
+            source += f", {volume}"
+            if issue:
+                source += f"({issue})"
+        if pages:
+            source += f", pp. {pages}"
+        parts.append(source + ".")
+    elif publisher:
+        parts.append(_sentence(publisher))
+    if link:
+        parts.append(f"Available at: {link}.")
+    return " ".join(parts)
+
+
+def _short_title(title, max_words=4):
+    words = (title or "").split(":")[0].split()
+    return " ".join(words[:max_words]).rstrip(".,;")
+
+
+def in_text_citation(record, style, number=None, year_label=None, short_title=False):
+    """
+    In-text citation for ``record``, following Agent 4's rules: up to three
+    authors by surname, four or more as "First et al.", then the year;
+    MLA by surname only, plus a short title with ``short_title`` (for
+    authors with several works); IEEE by number.
+    """
+    if style == "ieee":
+        return f"[{number}]"
+    year = year_label or (str(record["year"]) if record.get("year") else "n.d.")
+    surnames = [f for f, _ in record.get("authors") or [] if f]
+    if not surnames:
+        words = (record.get("title") or "").split()
+        name = " ".join(words[:4]) + ("..." if len(words) > 4 else "")
+    elif len(surnames) >= 4 or (style == "mla" and len(surnames) >= 3):
+        name = f"{surnames[0]} et al."
+    else:
+        name = _join(surnames, " and ")
+    if style == "mla":
+        if short_title and surnames and record.get("title"):
+            return f"({name}, *{_short_title(record['title'])}*)"
+        return f"({name})"
+    return f"({name}, {year})"
+
+
+def format_reference_output(records, reference_style):
+    """
+    Reference List and Citation List for ``records`` in the layout Agent 4
+    produces, formatted locally. Author-date styles are ordered A–Z by
+    first author and same author-year pairs get "a", "b" suffixes; MLA
+    citations of the same authors get a short title; IEEE keeps the given
+    (relevance) order.
+    """
+    style = style_key(reference_style)
+    if style is None:
+        raise ValueError(f"No local formatter for reference style {reference_style!r}.")
+
+    def sort_key(record):
+        authors = record.get("authors") or [[record.get("title", ""), ""]]
+        return (authors[0][0].lower(), record.get("year") or 0, (record.get("title") or "").lower())
+
+    records = list(records) if style == "ieee" else sorted(records, key=sort_key)
+    year_labels = [None] * len(records)
+    short_titles = [False] * len(records)
+    if style in ("harvard", "apa", "mla"):
+        groups = {}
+        for i, record in enumerate(records):
+            groups.setdefault(in_text_citation(record, style), []).append(i)
+        for indexes in groups.values():
+            if len(indexes) > 1 and style == "mla":
+                for i in indexes:
+                    short_titles[i] = True
+            elif len(indexes) > 1:
+                for letter, i in zip("abcdefghijklmnopqrstuvwxyz", indexes):
+                    year_labels[i] = f"{records[i].get('year') or 'n.d.'}{letter}"
+
+    entries = [
+        format_reference(r, style, number=i + 1, year_label=year_labels[i])
+        for i, r in enumerate(records)
+    ]
+    citations = [
+        in_text_citation(r, style, number=i + 1, year_label=year_labels[i], short_title=short_titles[i])
+        for i, r in enumerate(records)
+    ]
+    return "Reference List\n\n" + "\n\n".join(entries) + "\n\nCitation List\n\n" + "\n".join(citations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the local reference index.")
+    parser.add_argument("--index", default=REFERENCE_INDEX_PATH, help="index file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("import", help="import BibTeX, RIS or CSL-JSON files")
+    load.add_argument("files", nargs="+")
+    search = commands.add_parser("search", help="show the records matching a text file or query")
+    search.add_argument("query", help="a text file (e.g. generated content) or search words")
+    search.add_argument("--count", type=int, default=10)
+    search.add_argument("--style", default="Harvard")
+    commands.add_parser("stats", help="count the records")
+    args = parser.parse_args(argv)
+
+    index = ReferenceIndex(args.index)
+    if args.command == "import":
+        for path in args.files:
+            with open(path, "rb") as f:
+                records = load_references(path, f.read())
+            print(f"{path}: {len(records)} record(s), {index.add(records)} new")
+    elif args.command == "search":
+        if os.path.exists(args.query):
+            with open(args.query, encoding="utf-8") as f:
+                keywords = extract_keywords(f.read())
+        else:
+            keywords = args.query.split()
+        print("Keywords:", ", ".join(keywords), file=sys.stderr)
+        records = index.search(keywords, limit=args.count)
+        if style_key(args.style):
+            print(format_reference_output(records, args.style))
+        else:
+            for record in records:
+                print(record["id"], record.get("year"), record.get("title"))
+    else:
+        print(f"{index.count()} record(s), {index.count(MIN_REFERENCE_YEAR)} from {MIN_REFERENCE_YEAR} onwards")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "responses.sqlite3")
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 72 * 3600
+
+
+def _normalize_text(text: str) -> str:
+    """
+    Whitespace-insensitive form of an input so trivial edits (trailing
+    spaces, CRLF line endings, blank lines at the ends) still hit the cache.
+    """
+    lines = (text or "").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def _digest_content_item(item):
+    if item.get("type") == "input_text":
+        return {"type": "input_text", "text": _normalize_text(item.get("text", ""))}
+    if item.get("type") == "input_image":
+        image_url = item.get("image_url", "")
+        return {
+            "type": "input_image",
+            "sha256": hashlib.sha256(image_url.encode("utf-8")).hexdigest(),
+        }
+    return item
+
+
+def make_cache_key(instructions, model, messages, **params) -> str:
+    """
+    Content address of an agent call: a SHA-256 over the agent prompt, the
+    model, the normalized input text and digests of any attached images.
+    Extra request parameters (e.g. a response format) are included too.
+    """
+    normalized_messages = [
+        {
+            "role": message.get("role"),
+            "content": [_digest_content_item(item) for item in message.get("content", [])],
+        }
+        for message in messages
+    ]
+    payload = {
+        "instructions": _normalize_text(instructions),
+        "model": model,
+        "input": normalized_messages,
+        "params": params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Disk-backed store of agent responses in a local SQLite file.
+
+    Entries expire ``ttl_seconds`` after they were written, and once the
+    stored text exceeds ``max_bytes`` the least recently used entries are
+    evicted. Safe to share between threads and Streamlit sessions.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """
+        Return the cached text for ``key``, or None on a miss or expired entry.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def put(self, key, value):
+        if not value:
+            return
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+            # Keep the most recently used entries whose running size fits.
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM ("
+                "  SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS running"
+                "  FROM responses)"
+                " WHERE running > ?)",
+                (self.max_bytes,),
+            )
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
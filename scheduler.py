@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import itertools
+import threading
+import contextvars
+from functools import lru_cache
+
+# Priorities, most urgent first: a user waiting on a step, unattended
+# (background / headless) jobs, and work started on a guess.
+INTERACTIVE = 0
+BATCH = 1
+SPECULATIVE = 2
+
+# Requests and tokens per minute per model: (RPM, TPM). Set these to the
+# organisation's limits, e.g. OPENAI_RATE_LIMITS='{"gpt-4.1": [500, 30000]}'.
+# Models without an entry are not throttled.
+MODEL_RATE_LIMITS = {
+    "gpt-4.1": (5000, 450_000),
+    "gpt-4.1-mini": (5000, 2_000_000),
+    "gpt-4.1-nano": (5000, 2_000_000),
+    "gpt-4o": (5000, 450_000),
+    "gpt-4o-mini": (5000, 2_000_000),
+}
+MODEL_RATE_LIMITS.update(
+    (model, tuple(limits))
+    for model, limits in json.loads(os.environ.get("OPENAI_RATE_LIMITS") or "{}").items()
+)
+# Fraction of each limit this process uses, leaving room for other clients
+# of the same organisation.
+RATE_LIMIT_HEADROOM = float(os.environ.get("OPENAI_RATE_LIMIT_HEADROOM", "0.9"))
+# How often a waiting caller re-reports its queue position.
+STATUS_INTERVAL_SECONDS = 0.5
+
+_session = contextvars.ContextVar("scheduler_session", default=None)
+
+
+def set_session(session_id, priority=INTERACTIVE, on_wait=None):
+    """
+    Queue model calls made from this thread (and workers started with
+    ``telemetry.bind_context``) under ``session_id`` at ``priority``.
+
+    ``on_wait(status)`` is called on this thread while its calls are queued,
+    with a dict of ``waiting`` (calls of this session in the queue),
+    ``position`` (1-based place of the first of them) and ``eta_seconds``;
+    and with None once nothing is waiting any more.
+    """
+    _session.set(
+        {
+            "id": session_id,
+            "priority": priority,
+            "on_wait": on_wait,
+            "thread": threading.get_ident(),
+            "last_status": None,
+        }
+    )
+
+
+def current_session():
+    return _session.get()
+
+
+class TokenBucket:
+    """
+    Continuously refilling allowance of ``per_minute`` units, holding at most
+    one minute's worth. The level may go negative when a call turns out to
+    have used more than was reserved for it.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until ``amount`` (capped at the capacity) is available.
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        self.level = min(self.capacity, self.level - amount)
+
+
+class _Ticket:
+    __slots__ = ("model", "tokens", "priority", "session", "seq", "granted", "context")
+
+    def __init__(self, model, tokens, priority, session, seq, context=None):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.session = session
+        self.seq = seq
+        self.granted = False
+        self.context = context
+
+
+class Scheduler:
+    """
+    Process-wide gate in front of the API. Each model has a request bucket
+    and a token bucket sized from its RPM/TPM limits; a call waits until
+    both can cover it, so sessions share the limits at a steady rate
+    instead of bursting into 429s.
+
+    Waiting calls are served by priority, then by fair share: within a
+    priority the session that has been granted the fewest tokens since it
+    started waiting goes first, so one session's parallel sections cannot
+    starve another user's single call. A session joining the queue starts
+    level with the least-served waiting session rather than at zero.
+    """
+
+    def __init__(self, limits=None, headroom=RATE_LIMIT_HEADROOM):
+        self._limits = dict(MODEL_RATE_LIMITS if limits is None else limits)
+        self._headroom = headroom
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._waiting = {}
+        self._served = {}
+        self._paused_until = {}
+        self._seq = itertools.count()
+
+    def _model_buckets(self, model):
+        if model not in self._buckets:
+            rpm, tpm = self._limits[model]
+            self._buckets[model] = (
+                TokenBucket(rpm * self._headroom),
+                TokenBucket(tpm * self._headroom),
+            )
+        return self._buckets[model]
+
+    def _key(self, ticket):
+        return (ticket.priority, self._served.get(ticket.session, 0.0), ticket.seq)
+
+    def _delay(self, ticket, now):
+        requests, tokens = self._model_buckets(ticket.model)
+        return max(
+            self._paused_until.get(ticket.model, 0.0) - now,
+            requests.wait_time(1, now),
+            tokens.wait_time(ticket.tokens, now),
+        )
+
+    def _try_grant(self, ticket):
+        """
+        Grant ``ticket`` if it is first in line and the buckets allow it.
+        Returns None when granted, else the seconds worth waiting.
+        """
+        now = time.monotonic()
+        waiting = self._waiting[ticket.model]
+        head = min(waiting, key=self._key)
+        delay = self._delay(head, now)
+        if head is not ticket or delay > 0:
+            return max(delay, 0.01)
+
+        requests, tokens = self._model_buckets(ticket.model)
+        requests.take(1, now)
+        tokens.take(ticket.tokens, now)
+        waiting.remove(ticket)
+        ticket.granted = True
+        self._served[ticket.session] = self._served.get(ticket.session, 0.0) + ticket.tokens
+        self._forget_idle_session(ticket.session)
+        self._cond.notify_all()
+        return None
+
+    def _forget_idle_session(self, session):
+        if not any(t.session == session for q in self._waiting.values() for t in q):
+            self._served.pop(session, None)
+
+    def acquire(self, model, tokens):
+        """
+        Block until a call of about ``tokens`` tokens to ``model`` may be
+        sent, reporting queue status through the session's ``on_wait``.
+        """
+        if model not in self._limits:
+            return
+        context = _session.get() or {}
+        session = context.get("id")
+        priority = context.get("priority", INTERACTIVE)
+
+        with self._cond:
+            if session not in self._served:
+                self._served[session] = min(self._served.values(), default=0.0)
+            ticket = _Ticket(model, tokens, priority, session, next(self._seq), context)
+            self._waiting.setdefault(model, []).append(ticket)
+
+        try:
+            while True:
+                with self._cond:
+                    deadline = time.monotonic() + STATUS_INTERVAL_SECONDS
+                    while True:
+                        delay = self._try_grant(ticket)
+                        remaining = deadline - time.monotonic()
+                        if delay is None or remaining <= 0:
+                            break
+                        self._cond.wait(min(delay, remaining))
+                    if ticket.granted:
+                        break
+                    status = self._status_locked(session)
+                _report(context, status)
+        finally:
+            with self._cond:
+                if not ticket.granted:
+                    self._waiting[model].remove(ticket)
+                    self._forget_idle_session(session)
+                    self._cond.notify_all()
+        _report(context, self.status(session))
+
+    def promote(self, context, priority=INTERACTIVE):
+        """
+        Raise the calls made under ``context`` (as returned by
+        ``current_session``) to ``priority``: those already waiting and
+        those made from now on, e.g. once the user waits on a speculation.
+        """
+        with self._cond:
+            context["priority"] = min(context.get("priority", INTERACTIVE), priority)
+            for waiting in self._waiting.values():
+                for ticket in waiting:
+                    if ticket.context is context:
+                        ticket.priority = min(ticket.priority, priority)
+            self._cond.notify_all()
+
+    def settle(self, model, reserved_tokens, used_tokens):
+        """
+        Correct the token bucket once a call's real usage is known.
+        """
+        if model not in self._limits or used_tokens is None:
+            return
+        with self._cond:
+            self._model_buckets(model)[1].adjust(used_tokens - reserved_tokens)
+            self._cond.notify_all()
+
+    def pause(self, model, seconds):
+        """
+        Hold all calls to ``model`` for ``seconds``, e.g. after the API
+        answered 429 despite the buckets (other clients share the limit).
+        """
+        if model not in self._limits:
+            return
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._paused_until[model] = max(self._paused_until.get(model, 0.0), until)
+            self._cond.notify_all()
+
+    def _status_locked(self, session):
+        now = time.monotonic()
+        status = None
+        for model, waiting in self._waiting.items():
+            ordered = sorted(waiting, key=self._key)
+            positions = [i for i, t in enumerate(ordered) if t.session == session]
+            if not positions:
+                continue
+            ahead = ordered[: positions[-1] + 1]
+            requests, tokens = self._model_buckets(model)
+            requests._refill(now)
+            tokens._refill(now)
+            eta = max(
+                self._paused_until.get(model, 0.0) - now,
+                (len(ahead) - requests.level) / requests.rate,
+                (sum(t.tokens for t in ahead) - tokens.level) / tokens.rate,
+                0.0,
+            )
+            if status is None:
+                status = {"waiting": 0, "position": positions[0] + 1, "eta_seconds": eta}
+            status["waiting"] += len(positions)
+            status["position"] = min(status["position"], positions[0] + 1)
+            status["eta_seconds"] = max(status["eta_seconds"], eta)
+        return status
+
+    def status(self, session):
+        """
+        Queue status of ``session`` (see ``set_session``), or None when it
+        has nothing waiting.
+        """
+        with self._cond:
+            return self._status_locked(session)
+
+
+def _report(context, status):
+    on_wait = context.get("on_wait")
+    if on_wait is None or context.get("thread") != threading.get_ident():
+        return
+    shown = None if status is None else (
+        status["waiting"], status["position"], round(status["eta_seconds"])
+    )
+    if shown != context.get("last_status"):
+        context["last_status"] = shown
+        on_wait(status)
+
+
+def report_wait():
+    """
+    Pass the current session's queue status to its ``on_wait``. Callers that
+    wait on worker threads (e.g. parallel sections) call this from the
+    session's own thread while they wait.
+    """
+    context = _session.get()
+    if context is not None:
+        _report(context, get_scheduler().status(context["id"]))
+
+
+@lru_cache(maxsize=None)
+def get_scheduler():
+    """
+    Process-wide scheduler shared by all sessions.
+    """
+    return Scheduler()
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import datetime
+import threading
+import contextvars
+from collections import OrderedDict
+
+# One JSON line per model call is appended to a daily file in this directory;
+# set PIPELINE_TRACE_DIR to an empty string to keep traces in memory only.
+TRACE_DIR = os.environ.get("PIPELINE_TRACE_DIR", "traces")
+# Runs kept in memory for the UI panel (oldest are dropped first).
+MAX_RUNS_IN_MEMORY = 200
+
+# USD per 1M tokens: (input, cached input, output). Update when pricing
+# changes; unknown models are recorded with a cost of None.
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+_current_run = contextvars.ContextVar("pipeline_run_id", default=None)
+_lock = threading.Lock()
+_runs = OrderedDict()
+
+
+def set_current_run(run_id):
+    """
+    Attribute model calls made from this thread (and workers started with
+    ``bind_context``) to ``run_id``.
+    """
+    _current_run.set(run_id)
+
+
+def current_run():
+    return _current_run.get()
+
+
+def bind_context(fn):
+    """
+    Wrap ``fn`` so it sees the caller's context (the current run id) when it
+    runs on a worker thread. Each call gets its own copy of the context, so
+    the wrapper can be used with ``pool.map``.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def estimate_cost(model, input_tokens, output_tokens, cached_tokens=0):
+    prices = MODEL_PRICES.get(model)
+    if prices is None or input_tokens is None or output_tokens is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cached_tokens = cached_tokens or 0
+    return (
+        (input_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + output_tokens * output_price
+    ) / 1_000_000
+
+
+def usage_fields(usage):
+    """
+    Token counts from a Responses API ``usage`` object (None when missing).
+    """
+    if usage is None:
+        return {"input_tokens": None, "output_tokens": None, "cached_tokens": None}
+    details = getattr(usage, "input_tokens_details", None)
+    return {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+    }
+
+
+def record_call(stage, model, started_at, wall_seconds, ttft_seconds=None, usage=None,
+                cache_hit=False, streamed=False, error=None, **extra):
+    """
+    Store one model call under the current run and append it to the trace
+    file. Returns the record.
+    """
+    tokens = usage_fields(usage)
+    record = {
+        "run_id": current_run(),
+        "stage": stage,
+        "model": model,
+        "started_at": datetime.datetime.fromtimestamp(started_at, datetime.timezone.utc).isoformat(),
+        "wall_seconds": round(wall_seconds, 4),
+        "ttft_seconds": None if ttft_seconds is None else round(ttft_seconds, 4),
+        **tokens,
+        "cost_usd": 0.0 if cache_hit else estimate_cost(
+            model, tokens["input_tokens"], tokens["output_tokens"], tokens["cached_tokens"]
+        ),
+        "cache_hit": cache_hit,
+        "streamed": streamed,
+        "status": "error" if error else "ok",
+        "error": str(error) if error else None,
+        **extra,
+    }
+
+    with _lock:
+        run = _runs.setdefault(record["run_id"], [])
+        run.append(record)
+        _runs.move_to_end(record["run_id"])
+        while len(_runs) > MAX_RUNS_IN_MEMORY:
+            _runs.popitem(last=False)
+        if TRACE_DIR:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            filename = f"agent_calls-{datetime.date.today().isoformat()}.jsonl"
+            with open(os.path.join(TRACE_DIR, filename), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return record
+
+
+def run_records(run_id):
+    with _lock:
+        return list(_runs.get(run_id, []))
+
+
+def summarize_by_stage(records):
+    """
+    Per-stage totals: calls, cache hits, errors, retries, wall time, tokens
+    and cost. Stages appear in the order they were first called.
+    """
+    stages = OrderedDict()
+    for r in records:
+        s = stages.setdefault(
+            r["stage"],
+            {
+                "stage": r["stage"],
+                "calls": 0,
+                "cache_hits": 0,
+                "errors": 0,
+                "retries": 0,
+                "wall_seconds": 0.0,
+                "max_ttft_seconds": None,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cached_tokens": 0,
+                "cost_usd": 0.0,
+            },
+        )
+        s["calls"] += 1
+        s["cache_hits"] += int(bool(r["cache_hit"]))
+        s["errors"] += int(r["status"] == "error")
+        s["retries"] += max(0, (r.get("attempts") or 1) - 1)
+        s["wall_seconds"] += r["wall_seconds"]
+        if r["ttft_seconds"] is not None:
+            s["max_ttft_seconds"] = max(s["max_ttft_seconds"] or 0.0, r["ttft_seconds"])
+        for key in ("input_tokens", "output_tokens", "cached_tokens", "cost_usd"):
+            s[key] += r.get(key) or 0
+    return list(stages.values())
+
+
+class CallTimer:
+    """
+    Tiny helper for measuring a call: ``started_at`` (epoch seconds),
+    ``elapsed()`` and ``mark_first_token()`` / ``ttft``.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.ttft = None
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def mark_first_token(self):
+        if self.ttft is None:
+            self.ttft = self.elapsed()
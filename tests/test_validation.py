@@ -0,0 +1,36 @@
+import pytest
+
+import validation
+
+CITATION_LIST = "Citation List\n\n(Smith, 2020)\n(Khan, 2021)\n"
+
+
+def test_numbered_headings_without_blank_lines():
+    final = (
+        "1. Introduction\n"
+        "This report looks at remote work.\n"
+        "\n"
+        "2. Literature Review\n"
+        "Remote work raises output (Smith, 2020).\n"
+        "\n"
+        "3. Conclusion\n"
+        "Remote work helps (Khan, 2021).\n"
+        "\n"
+        "References\n"
+        "\n"
+        "Khan, A. (2021) Title.\n"
+    )
+    report = validation.check_citations(final, CITATION_LIST)
+    assert report["uncited"] == []
+    assert [m["section"] for m in report["misplaced"]] == ["Conclusion"]
+
+    fixed = validation.fix_citations(final, CITATION_LIST)
+    assert "Remote work helps." in fixed
+    report = validation.check_citations(fixed, CITATION_LIST)
+    assert report["misplaced"] == [] and report["uncited"] == []
+
+
+def test_fix_citations_refuses_without_body_paragraphs():
+    final = "Introduction\n\nRemote work raises output (Smith, 2020).\n"
+    with pytest.raises(ValueError):
+        validation.fix_citations(final, CITATION_LIST)
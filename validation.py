@@ -0,0 +1,338 @@
+import re
+import time
+from functools import lru_cache
+
+import pipeline
+
+# Agent 3 is asked to stay within 5% of each section's word target.
+WORD_COUNT_TOLERANCE = 0.05
+
+_PAREN_GROUP_RE = re.compile(r"\(([^()]*)\)")
+_NUMERIC_GROUP_RE = re.compile(r"\[(\d+(?:\s*[,–-]\s*\d+)*)\]")
+_AUTHOR_YEAR_RE = re.compile(r"^(.+?),?\s+(\d{4}[a-z]?|n\.d\.)$")
+# An MLA citation: capitalized surnames joined by "and", "&" or commas,
+# optionally "et al." and a page number.
+_NAME_ONLY_RE = re.compile(
+    r"^([A-Z][\w'’-]*(?:(?:,?\s+(?:and|&)\s+|,\s*|\s+)[A-Z][\w'’-]*){0,5}(?:\s+et al\.)?)(?:\s+[\d–-]+)?$"
+)
+_NON_AUTHOR_WORDS = {"figure", "fig", "table", "appendix", "section", "chapter", "equation", "see", "note"}
+_LOCATOR_RE = re.compile(r",?\s*(?:p|pp|para|ch|chap)\.?\s*[\d–-]+$", re.IGNORECASE)
+_CITATION_PREFIX_RE = re.compile(r"^(?:see also|see|e\.g\.,?|cf\.)\s+", re.IGNORECASE)
+_TOTAL_WORDS_RE = re.compile(r"total\s+word\s+count\s*[:\-–]?\s*\**\s*(\d[\d,]*)", re.IGNORECASE)
+
+
+def _normalize(text):
+    text = text.lower().replace("&", " and ")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def _citation_piece(piece):
+    piece = _CITATION_PREFIX_RE.sub("", piece.strip())
+    return _LOCATOR_RE.sub("", piece).strip()
+
+
+def _numbers(group):
+    numbers = []
+    for part in re.split(r"\s*,\s*", group):
+        bounds = re.split(r"\s*[–-]\s*", part)
+        if len(bounds) == 2 and int(bounds[0]) <= int(bounds[1]):
+            numbers.extend(range(int(bounds[0]), int(bounds[1]) + 1))
+        else:
+            numbers.append(int(bounds[0]))
+    return numbers
+
+
+class CitationMatcher:
+    """
+    All in-text citations of a Citation List compiled into one regular
+    expression, so a document is scanned once however many references
+    there are.
+
+    Author-date citations match inside grouped parentheses ("(A, 2023; B,
+    2022)"), in narrative form ("A (2023)") and with page locators; "&" and
+    "and", and commas between names, are interchangeable. Numeric citations
+    match inside brackets, including lists and ranges ("[1, 3–5]").
+    Name-only citations (MLA) match when the name closes a parenthesis,
+    optionally followed by a page number ("(Khan 45)").
+    """
+
+    def __init__(self, citations):
+        self.citations = list(citations)
+        self._keys = {}
+        self._numbers = {}
+        self._name_only = False
+        patterns = []
+        initials = set()
+        for index, citation in enumerate(self.citations):
+            numeric = re.fullmatch(r"\[(\d+)\]", citation.strip())
+            if numeric:
+                self._numbers[int(numeric.group(1))] = index
+                continue
+            inner = _citation_piece(citation.strip().strip("()"))
+            match = _AUTHOR_YEAR_RE.match(inner)
+            name, year = (match.group(1), match.group(2)) if match else (inner, None)
+            words = [
+                r"(?:and|&)" if word.lower() in ("and", "&")
+                else r"al\.?" if word.lower() == "al."
+                else re.escape(word)
+                for word in name.replace(",", " ").split()
+            ]
+            if not words:
+                continue
+            name_pattern = r",?\s+".join(words)
+            if year:
+                patterns.append(rf"{name_pattern}(?:,?\s+|\s+\(){re.escape(year)}(?!\w)")
+            else:
+                # Name-only styles (MLA): the name closes a parenthesis,
+                # possibly followed by a page number.
+                self._name_only = True
+                patterns.append(rf"{name_pattern}(?=\s*[\d–-]*\s*[;)])")
+            self._keys[_normalize(f"{name} {year or ''}")] = index
+            initial = name.replace(",", " ").split()[0][:1]
+            initials.update((initial.lower(), initial.upper()))
+        patterns.sort(key=len, reverse=True)
+        self._regex = None
+        if patterns:
+            # Only word starts with a known first letter try the alternatives.
+            first = re.escape("".join(sorted(initials)))
+            alternatives = "|".join(f"(?:{p})" for p in patterns)
+            self._regex = re.compile(rf"(?<!\w)(?=[{first}])(?:{alternatives})", re.IGNORECASE)
+
+    def _index(self, text):
+        return self._keys.get(_normalize(_citation_piece(text)))
+
+    def find(self, text):
+        """
+        (citation index, start, end) of every known citation in ``text``.
+        """
+        found = []
+        if self._regex is not None:
+            for m in self._regex.finditer(text):
+                index = self._index(m.group(0))
+                if index is not None:
+                    found.append((index, m.start(), m.end()))
+        if self._numbers:
+            for m in _NUMERIC_GROUP_RE.finditer(text):
+                for number in _numbers(m.group(1)):
+                    if number in self._numbers:
+                        found.append((self._numbers[number], m.start(), m.end()))
+        return found
+
+    def unknown(self, text):
+        """
+        Citations in ``text`` that look like author-date or numeric
+        citations, or name-only ones when the list has any, but are not in
+        the Citation List.
+        """
+        unknown = []
+        for m in _PAREN_GROUP_RE.finditer(text):
+            for piece in m.group(1).split(";"):
+                piece = _citation_piece(piece)
+                match = _AUTHOR_YEAR_RE.match(piece)
+                if match and match.group(1)[:1].isupper() and self._index(piece) is None:
+                    unknown.append(f"({piece})")
+                elif not match and self._name_only:
+                    name = _NAME_ONLY_RE.match(piece)
+                    # All-caps words are acronyms, and "(Table 2)" is no citation.
+                    if (
+                        name
+                        and not name.group(1).isupper()
+                        and name.group(1).split()[0].lower() not in _NON_AUTHOR_WORDS
+                        and self._index(name.group(1)) is None
+                    ):
+                        unknown.append(f"({name.group(1)})")
+        if self._numbers or not self._keys:
+            for m in _NUMERIC_GROUP_RE.finditer(text):
+                unknown.extend(f"[{n}]" for n in _numbers(m.group(1)) if n not in self._numbers)
+        return unknown
+
+    def remove(self, text):
+        """
+        ``text`` without its parenthetical and numeric citations that are in
+        the Citation List. Narrative citations ("A (2023)") are part of the
+        sentence and are left alone.
+        """
+        def strip_group(m):
+            pieces = [p.strip() for p in m.group(1).split(";")]
+            kept = [p for p in pieces if self._index(p) is None]
+            if len(kept) == len(pieces):
+                return m.group(0)
+            return f"({'; '.join(kept)})" if kept else ""
+
+        def strip_numeric(m):
+            if all(n in self._numbers for n in _numbers(m.group(1))):
+                return ""
+            return m.group(0)
+
+        cleaned = _PAREN_GROUP_RE.sub(strip_group, text)
+        cleaned = _NUMERIC_GROUP_RE.sub(strip_numeric, cleaned)
+        if cleaned == text:
+            return text
+        cleaned = re.sub(r"[ \t]+([.,;:!?])", r"\1", cleaned)
+        return re.sub(r"(?<=\S)[ \t]{2,}", " ", cleaned)
+
+
+@lru_cache(maxsize=32)
+def _matcher(citations):
+    return CitationMatcher(citations)
+
+
+def _body_words(text):
+    """
+    Words of ``text`` outside its heading lines.
+    """
+    return sum(
+        len(line.split())
+        for line in (text or "").split("\n")
+        if not pipeline._heading_parts(line)
+    )
+
+
+def _word_status(target, words, tolerance):
+    if words is None:
+        return "missing", None
+    if not target:
+        return "no target", None
+    deviation = (words - target) / target
+    if deviation < -tolerance:
+        return "short", deviation
+    if deviation > tolerance:
+        return "long", deviation
+    return "ok", deviation
+
+
+def check_word_counts(structure_text, content_text, tolerance=WORD_COUNT_TOLERANCE):
+    """
+    Words written under each structure section (headings excluded) against
+    its target. Returns ``sections`` (one row per writable section with
+    ``number``, ``title``, ``target``, ``words``, ``status`` and
+    ``deviation``) and the ``total`` row.
+    """
+    preamble, sections = pipeline._writable_sections(structure_text)
+    _, prose = pipeline.split_content_by_sections(content_text, sections)
+    rows = []
+    for index, section in enumerate(sections):
+        words = _body_words(prose[index]) if index in prose else None
+        status, deviation = _word_status(section["words"], words, tolerance)
+        rows.append({
+            "number": section["number"],
+            "title": section["title"],
+            "target": section["words"],
+            "words": words,
+            "status": status,
+            "deviation": deviation,
+        })
+
+    match = _TOTAL_WORDS_RE.search(preamble)
+    target = int(match.group(1).replace(",", "")) if match else sum(s["words"] or 0 for s in sections)
+    words = _body_words(content_text)
+    status, deviation = _word_status(target, words, tolerance)
+    total = {"target": target or None, "words": words, "status": status, "deviation": deviation}
+    return {"sections": rows, "total": total}
+
+
+def _reference_list_start(lines):
+    for index, line in enumerate(lines):
+        heading = pipeline._heading_parts(line["text"]) if line["heading"] else None
+        if heading and pipeline._REFERENCE_HEADING_RE.match(heading[1]):
+            return index
+    return len(lines)
+
+
+def check_citations(final_text, citation_list):
+    """
+    Match the in-text citations of the final document (up to its reference
+    list) against the Citation List. Returns ``citations`` (each with its
+    number of ``uses``), ``uncited`` citations, ``unknown`` citations not in
+    the list, and ``misplaced`` ones: lines in an Introduction, Conclusion,
+    Abstract or Executive Summary that carry citations.
+    """
+    citations = pipeline.parse_citation_list(citation_list)
+    matcher = _matcher(tuple(citations))
+    lines = pipeline._classify_content_lines(final_text)
+    uses = [0] * len(citations)
+    unknown = []
+    misplaced = []
+    section = ""
+    for index, line in enumerate(lines[:_reference_list_start(lines)]):
+        if line["heading"]:
+            heading = pipeline._heading_parts(line["text"])
+            section = heading[1] if heading else section
+            continue
+        found = matcher.find(line["text"])
+        for citation_index, _, _ in found:
+            uses[citation_index] += 1
+        if found and not line["citable"]:
+            misplaced.append({
+                "line": index,
+                "section": section,
+                "citations": sorted({citations[c] for c, _, _ in found}),
+            })
+        for citation in matcher.unknown(line["text"]):
+            if citation not in unknown:
+                unknown.append(citation)
+
+    return {
+        "citations": [{"citation": c, "uses": n} for c, n in zip(citations, uses)],
+        "uncited": [c for c, n in zip(citations, uses) if n == 0],
+        "unknown": unknown,
+        "misplaced": misplaced,
+    }
+
+
+def validate(structure_text="", content_text="", final_text="", citation_list="", tolerance=WORD_COUNT_TOLERANCE):
+    """
+    Local checks of the pipeline outputs, without model calls: word counts
+    of the content against the structure (when both are given) and the
+    citations of the final document against the Citation List (when both
+    are given). ``seconds`` is how long the checks took.
+    """
+    started = time.perf_counter()
+    report = {"sections": [], "total": None, "citations": [], "uncited": [], "unknown": [], "misplaced": []}
+    if structure_text and content_text:
+        report.update(check_word_counts(structure_text, content_text, tolerance))
+    if final_text and citation_list:
+        report.update(check_citations(final_text, citation_list))
+    report["seconds"] = time.perf_counter() - started
+    return report
+
+
+def fix_citations(final_text, citation_list):
+    """
+    Repair what ``check_citations`` finds without a model call: citations in
+    sections that must not have any are removed, and citations that are
+    never used are added to the least-cited body paragraphs (as in compact
+    mode). All other text, including the reference list, is unchanged.
+    Raises ValueError, changing nothing, when the document has no body
+    paragraph that may carry citations: its sections could not be told
+    apart, and removing would strip every citation.
+    """
+    citations = pipeline.parse_citation_list(citation_list)
+    matcher = _matcher(tuple(citations))
+    lines = pipeline._classify_content_lines(final_text)
+    end = _reference_list_start(lines)
+    if citations and not any(line["citable"] for line in lines[:end]):
+        raise ValueError(
+            "No body paragraph outside the Introduction, Conclusion and summaries was found, "
+            "so citations were left as they are. Check that the section headings are on their own lines."
+        )
+
+    body = []
+    used = set()
+    for line in lines[:end]:
+        text = line["text"]
+        if not line["heading"] and not line["citable"]:
+            text = matcher.remove(text)
+        else:
+            used.update(c for c, _, _ in matcher.find(text))
+        body.append(text)
+    body_text = "\n".join(body)
+
+    missing = [c for i, c in enumerate(citations) if i not in used]
+    if missing:
+        body_text = pipeline.apply_citation_insertions(body_text, missing, [], "")
+
+    references = "\n".join(line["text"] for line in lines[end:]).strip()
+    if not references:
+        return body_text
+    return body_text.rstrip() + "\n\n" + references + "\n"